@@ -3,26 +3,33 @@
 import shared.custom_fields as custom_fields
 import shared.globals
 import shared.shared_sd as shared_sd
+import instrumentation
 import linaro_shared
+import profiler
 
 CAPABILITIES = [
     "COMMENT",
     "CREATE"
 ]
 
+@instrumentation.instrumented
 def comment(ticket_data):
     """ Triggered when a comment is posted """
     _, keyword = shared_sd.central_comment_handler(
-        [], ["help", "retry"])
+        [], ["help", "retry", "profile"])
 
     if keyword == "help":
         shared_sd.post_comment(("All bot commands must be internal comments and the first word/phrase in the comment.\r\n\r\n"
                                "Valid commands are:\r\n"
-                               "* retry to ask the bot to process the request again after issues have been resolved."), False)
+                               "* retry to ask the bot to process the request again after issues have been resolved.\r\n"
+                               "* profile to run the request again without making any changes and attach a performance profile."), False)
     elif keyword == "retry":
         print("add_engineer processing retry keyword & triggering create function")
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
 
+@instrumentation.instrumented
 def create(ticket_data):
     """ Triggered when the ticket is created """
     cf_engineering_team = custom_fields.get("Engineering Team")
@@ -4,7 +4,14 @@ import shared.custom_fields as custom_fields
 import shared.globals
 import shared.shared_ldap as shared_ldap
 import shared.shared_sd as shared_sd
+import directory_replica
+import dn_util
+import group_expansion
+import idempotency
+import instrumentation
 import linaro_shared
+import profiler
+import work_queue
 
 CAPABILITIES = [
     "COMMENT",
@@ -18,10 +25,13 @@ IT_BOT = (
 )
 WONT_DO = "Won't Do"
 
+@work_queue.queued
+@instrumentation.instrumented
+@idempotency.deduplicated
 def comment(ticket_data):
     """ Triggered when a comment is posted """
     last_comment, keyword = shared_sd.central_comment_handler(
-        ["add", "remove"], ["help", "retry"], False)
+        ["add", "remove"], ["help", "retry", "profile"], False)
 
     if keyword == "help":
         shared_sd.post_comment(
@@ -29,12 +39,19 @@ def comment(ticket_data):
              " word/phrase in the comment.\r\n\r\n"
              "Valid commands are:\r\n"
              "* retry to ask the bot to process the request again after issues"
-             " have been resolved."),
+             " have been resolved.\r\n"
+             "* profile to run the request again without making any changes"
+             " and attach a performance profile."),
             False)
         return
 
     if keyword == "retry":
-        create(ticket_data)
+        if not idempotency.is_repeated_command(ticket_data, keyword):
+            create(ticket_data)
+        return
+
+    if keyword == "profile":
+        profiler.profile(create, ticket_data)
         return
 
     if (linaro_shared.ok_to_process_public_comment(last_comment) and
@@ -58,7 +75,7 @@ def process_public_comment(ticket_data, last_comment, keyword):
     if not group_sanity_check(result):
         return True
     if ("owner" in result[0] and
-            shared_ldap.reporter_is_group_owner(result[0].owner.values) and
+            group_expansion.reporter_is_owner(result[0].owner.values) and
             keyword in ("add", "remove")):
         distinguished = result[0].entry_dn
         grp_name = shared_ldap.extract_id_from_dn(distinguished)
@@ -67,6 +84,8 @@ def process_public_comment(ticket_data, last_comment, keyword):
         return True
     return False
 
+@work_queue.queued
+@instrumentation.instrumented
 def create(ticket_data):
     """ Triggered when the issue is created """
     cf_approvers = custom_fields.get("Approvers")
@@ -100,7 +119,7 @@ def create(ticket_data):
         shared_sd.resolve_ticket(WONT_DO)
         return
 
-    if shared_ldap.reporter_is_group_owner(group_obj.owner.values):
+    if group_expansion.reporter_is_owner(group_obj.owner.values):
         shared_sd.transition_request_to("In progress")
         return
 
@@ -110,6 +129,9 @@ def create(ticket_data):
     shared_sd.assign_approvers(group_obj.owner.values, cf_approvers)
     shared_sd.transition_request_to("Needs approval")
 
+@work_queue.queued
+@instrumentation.instrumented
+@idempotency.deduplicated
 def transition(status_to, ticket_data):
     """
     If the status is "In Progress", trigger the membership change. This
@@ -136,7 +158,7 @@ def action_group_membership_change(email_address, group_obj, ticket_data):
     change_to_make = shared_sd.get_field(ticket_data, cf_add_remove)["value"]
     batch_process_membership_changes(email_address, changes, True, change_to_make)
     # Need to check if the requester is a group owner ...
-    if "owner" in group_obj and shared_ldap.reporter_is_group_owner(
+    if "owner" in group_obj and group_expansion.reporter_is_owner(
             group_obj.owner.values):
         shared_sd.post_comment(
             ("As you are an owner of this group, you can make further changes"
@@ -171,12 +193,12 @@ def batch_process_membership_changes(
     change_made = False
 
     # We need a list of current members to sanity check the request.
-    _, result = shared_ldap.find_group(
+    _, result = directory_replica.find_group(
         email_address, ["uniqueMember"])
     if len(result) == 1 and "uniqueMember" in result[0]:
-        members = result[0].uniqueMember.values
+        members = dn_util.MemberSet(result[0].uniqueMember.values)
     else:
-        members = []
+        members = dn_util.MemberSet()
 
     group_cn = shared_ldap.extract_id_from_dn(result[0].entry_dn)
     response = ""
@@ -216,7 +238,8 @@ def batch_process_membership_changes(
                 else:
                     response += "Adding %s\r\n" % email_address
                     shared_ldap.add_to_group(group_cn, result)
-                    members.append(result)
+                    directory_replica.refresh_group(group_cn, result)
+                    members.add(result)
                     change_made = True
             elif keyword == "remove":
                 if result is None:
@@ -226,7 +249,8 @@ def batch_process_membership_changes(
                 elif result in members:
                     response += "Removing %s\r\n" % email_address
                     shared_ldap.remove_from_group(group_cn, result)
-                    members.remove(result)
+                    directory_replica.refresh_group(group_cn, result)
+                    members.discard(result)
                     change_made = True
                 else:
                     response += (
@@ -250,7 +274,7 @@ def get_group_details(ticket_data):
     cf_group_email_address = custom_fields.get("Group Email Address")
     group_email_address = shared_sd.get_field(
         ticket_data, cf_group_email_address).strip().lower()
-    return shared_ldap.find_group(
+    return directory_replica.find_group(
         group_email_address, ['owner'])
 
 def group_sanity_check(ldap_obj):
@@ -294,5 +318,5 @@ def find_member_change(person):
     """ Get the LDAP object from the email address or UID """
     person = linaro_shared.cleanup_if_markdown(person)
     if "@" in person:
-        return shared_ldap.find_single_object_from_email(person)
+        return directory_replica.find_single_object_from_email(person)
     return shared_ldap.find_from_attribute("uid", person)
@@ -0,0 +1,191 @@
+"""
+The approvers for a member of staff: their manager, the Exec they report
+up to and who to fall back to when there is no manager.
+
+Working out the Exec means walking up the manager attributes one LDAP read
+at a time. Instead, this file is run on a schedule:
+
+    python approval_chain.py refresh
+
+to read every account and the Exec group in a couple of searches and
+store, for each account, the answer to that walk. lookup() then answers
+from the stored table. If the table is missing or hasn't been refreshed
+for STALE_AFTER seconds, or the person isn't in it, the answer is worked
+out from LDAP as before.
+
+A manager who is leaving is still recorded as the manager of the people
+who reported to them, but their account has moved to ou=leavers so the
+walk can't continue past them. The chain records that manager as the
+leaver so that the handler can say why there is no Exec and try another
+route.
+"""
+
+import sys
+import time
+
+from shared import shared_ldap
+
+import directory_replica
+import directory_search
+import linaro_shared
+import local_state
+
+TABLE_FILE = "approval_chain.json"
+# The table is no longer trusted once it is this old (in seconds).
+STALE_AFTER = 60 * 60
+ACCOUNTS_BASE = "ou=accounts,dc=linaro,dc=org"
+LEAVERS_OU = "ou=leavers"
+# Who approves when someone doesn't have a manager.
+FALLBACK_APPROVER = "diane.cheshire@linaro.org"
+# How long lookup_many allows for the accounts that aren't in the table.
+LOOKUP_DEADLINE = 60
+
+# In-memory copy of the table and the time it was loaded from disk.
+TABLE = None
+TABLE_LOADED = 0
+
+
+class Chain:  # pylint: disable=too-few-public-methods
+    """
+    The email addresses of a person's manager and Exec (either can be
+    None), the fallback approver and the DN of the manager in the reporting
+    line who is leaving, if that stopped the Exec from being found.
+    """
+    __slots__ = ("manager", "exec", "fallback", "leaver")
+
+    def __init__(self, manager, exec_email, leaver=None):
+        self.manager = manager
+        self.exec = exec_email
+        self.fallback = FALLBACK_APPROVER
+        self.leaver = leaver
+
+
+def get_table():
+    """ Return the table if it is fresh enough to be used. """
+    global TABLE, TABLE_LOADED  # pylint: disable=global-statement
+    # Other processes refresh the file so re-read it every so often.
+    if TABLE is None or time.time() - TABLE_LOADED > 60:
+        TABLE = local_state.load_state(TABLE_FILE)
+        TABLE_LOADED = time.time()
+    if TABLE is None or time.time() - TABLE["refreshed"] > STALE_AFTER:
+        return None
+    return TABLE
+
+
+def lookup(dn):
+    """ Return the Chain for the account with this DN. """
+    if dn is None:
+        return Chain(None, None)
+    table = get_table()
+    if table is not None:
+        found = table["chains"].get(directory_replica.normalise(dn))
+        if found is not None:
+            return Chain(*found)
+    return Chain(shared_ldap.get_manager_from_dn(dn), linaro_shared.get_exec_from_dn(dn))
+
+
+def lookup_many(dns):
+    """
+    Return the Chain for each of the DNs, keyed by DN. Accounts that aren't
+    in the table are worked out from LDAP at the same time as each other.
+    """
+    chains = {}
+    missing = {}
+    table = get_table()
+    for dn in set(dns):
+        found = None
+        if table is not None:
+            found = table["chains"].get(directory_replica.normalise(dn))
+        if found is not None:
+            chains[dn] = Chain(*found)
+        else:
+            missing[dn] = (lookup, (dn,))
+    if missing:
+        found = linaro_shared.run_concurrently(missing, LOOKUP_DEADLINE)
+        if found is None:
+            # Treat anyone who took too long as having no manager or Exec.
+            found = {dn: Chain(None, None) for dn in missing}
+        chains.update(found)
+    return chains
+
+
+def build_chains(people, execs, leavers):
+    """
+    Work out the chain for everyone. people maps each normalised DN to its
+    email address and normalised manager DN, execs is the set of the Exec
+    group's members and leavers maps the RDNs of leavers' accounts to their
+    DNs.
+    """
+    # Normalised DN -> (Exec email, leaver DN) for everyone above whom the
+    # walk has already been done.
+    above = {}
+
+    def exec_above(ndn):
+        # Walk up until reaching someone whose result is known, then fill in
+        # the result for everyone on the way.
+        path = []
+        seen = set()
+        result = (None, None)
+        while ndn not in above:
+            if ndn in seen:
+                # A loop in the reporting structure.
+                break
+            seen.add(ndn)
+            path.append(ndn)
+            manager = people[ndn][1]
+            if manager is None:
+                break
+            if manager not in people:
+                # The manager's account has gone; if it has been moved to
+                # the leavers, say so.
+                result = (None, leavers.get(manager.split(",", 1)[0]))
+                break
+            if manager in execs:
+                result = (people[manager][0], None)
+                break
+            ndn = manager
+        else:
+            result = above[ndn]
+        for walked in path:
+            above[walked] = result
+        return result
+
+    chains = {}
+    for ndn, (_, manager) in people.items():
+        manager_email = None
+        if manager is not None and manager in people:
+            manager_email = people[manager][0]
+        exec_email, leaver = exec_above(ndn)
+        chains[ndn] = [manager_email, exec_email, leaver]
+    return chains
+
+
+def refresh():
+    """ Rebuild the table from every account and the Exec group. """
+    people = {}
+    leavers = {}
+    for dn, attributes in directory_search.paged_search(
+            "(objectClass=inetOrgPerson)", ["mail", "manager"], ACCOUNTS_BASE):
+        ndn = directory_replica.normalise(dn)
+        rdn, parent = ndn.split(",", 1)
+        if parent.startswith(LEAVERS_OU + ","):
+            leavers[rdn] = dn
+            continue
+        mail = attributes.get("mail") or [None]
+        manager = attributes.get("manager")
+        if isinstance(manager, list):
+            manager = manager[0] if manager else None
+        people[ndn] = (
+            mail[0] if isinstance(mail, list) else mail,
+            directory_replica.normalise(manager) if manager else None)
+    _, result = shared_ldap.find_group("exec", ["uniqueMember"])
+    execs = {directory_replica.normalise(member) for member in result[0].uniqueMember.values}
+    chains = build_chains(people, execs, leavers)
+    local_state.save_state(TABLE_FILE, {"refreshed": time.time(), "chains": chains})
+    print(f"approval_chain: stored chains for {len(chains)} accounts")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["refresh"]:
+        sys.exit("Usage: approval_chain.py refresh")
+    refresh()
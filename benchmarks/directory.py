@@ -0,0 +1,198 @@
+"""
+A synthetic copy of Linaro Login held in an ldap3 MOCK_SYNC connection.
+
+The directory is generated from a seed so that every run sees exactly the
+same entries:
+
+* staff.NNNNN accounts under ou=staff, arranged in a management tree with
+  MANAGER_FAN_OUT reports per manager, with a proportion of leavers under
+  ou=leavers.
+* group-NNNNN mailing groups under ou=mailing whose sizes follow a
+  long-tailed distribution capped at the requested maximum, each with one
+  to three owners. group-00000 always has the maximum number of members.
+* the security groups that handlers check (employees, its, ...).
+
+Account N is the manager of accounts 8N+1 to 8N+8, so staff.00000 is at
+the top of the tree.
+"""
+
+import copy
+import random
+
+from ldap3 import MOCK_SYNC, NONE, Connection, Server
+
+BASE = "dc=linaro,dc=org"
+STAFF_OU = f"ou=staff,ou=accounts,{BASE}"
+LEAVERS_OU = f"ou=leavers,ou=accounts,{BASE}"
+MAILING_OU = f"ou=mailing,ou=groups,{BASE}"
+SECURITY_OU = f"ou=security,ou=groups,{BASE}"
+CONTAINERS = [
+    BASE,
+    f"ou=accounts,{BASE}",
+    STAFF_OU,
+    LEAVERS_OU,
+    f"ou=mail-contacts-unsynced,ou=accounts,{BASE}",
+    f"ou=groups,{BASE}",
+    MAILING_OU,
+    SECURITY_OU
+]
+BIND_DN = f"cn=benchmark,{BASE}"
+BIND_PASSWORD = "benchmark"
+MANAGER_FAN_OUT = 8
+# One account in this many is a leaver.
+LEAVER_EVERY = 20
+TEAMS = ["Kernel", "Toolchain", "LAVA", "IT Services", "Builds", "Security", "Android"]
+# The members of the "its" group are the first few accounts.
+ITS_MEMBERS = 10
+
+
+def staff_uid(number):
+    """ Return the uid of a synthetic account. """
+    return f"staff.{number:05d}"
+
+
+def staff_dn(number):
+    """ Return the DN of a synthetic account. """
+    ou = LEAVERS_OU if is_leaver(number) else STAFF_OU
+    return f"uid={staff_uid(number)},{ou}"
+
+
+def is_leaver(number):
+    """ Is the synthetic account a leaver? Nobody near the top of the tree leaves. """
+    return number > ITS_MEMBERS and number % LEAVER_EVERY == 0
+
+
+def group_cn(number):
+    """ Return the cn of a synthetic mailing group. """
+    return f"group-{number:05d}"
+
+
+class Directory:
+    """ The synthetic directory and the mock connection that serves it. """
+
+    def __init__(self, staff, groups, max_members, seed=1):
+        self.staff = staff
+        self.groups = groups
+        self.max_members = max_members
+        self.random = random.Random(seed)
+        self.server = Server("benchmark", get_info=NONE)
+        self.connection = Connection(
+            self.server,
+            user=BIND_DN,
+            password=BIND_PASSWORD,
+            client_strategy=MOCK_SYNC)
+        self.member_of = {}
+        self.populate()
+        self.connection.bind()
+        self.snapshot = copy.deepcopy(dict(self.server.dit))
+
+    def connect(self):
+        """
+        Open another connection to the mock directory. The entries belong to
+        the server so every connection sees the same directory, and a
+        handler that closes its connection doesn't affect the others.
+        """
+        connection = Connection(
+            self.server,
+            user=BIND_DN,
+            password=BIND_PASSWORD,
+            client_strategy=MOCK_SYNC)
+        connection.bind()
+        return connection
+
+    def add(self, dn, attributes):
+        """ Add an entry to the mock directory. """
+        self.connection.strategy.add_entry(dn, attributes)
+
+    def populate(self):
+        """ Generate all of the entries. """
+        for dn in CONTAINERS:
+            name, value = dn.split(",")[0].split("=")
+            self.add(dn, {"objectClass": ["top", "organizationalUnit"], name: value})
+        self.add(BIND_DN, {"objectClass": ["person"], "cn": "benchmark",
+                           "userPassword": BIND_PASSWORD})
+        groups = self.mailing_groups()
+        groups.update(self.security_groups())
+        for number in range(self.staff):
+            self.add(staff_dn(number), self.account(number))
+        for dn, attributes in groups.items():
+            self.add(dn, attributes)
+
+    def account(self, number):
+        """ Return the attributes of a synthetic account. """
+        uid = staff_uid(number)
+        attributes = {
+            "objectClass": ["top", "inetOrgPerson", "posixAccount"],
+            "uid": uid,
+            "cn": f"Staff {number:05d}",
+            "givenName": "Staff",
+            "sn": f"{number:05d}",
+            "displayName": f"Staff {number:05d}",
+            "mail": f"{uid}@linaro.org",
+            "title": "Engineer",
+            "departmentNumber": TEAMS[number % len(TEAMS)],
+            "employeeType": "Contractor" if number % 7 == 0 else "Employee",
+            "uidNumber": str(10000 + number),
+            "gidNumber": "10000",
+            "homeDirectory": f"/home/{uid}",
+            "memberOf": self.member_of.get(staff_dn(number), [])
+        }
+        if number > 0:
+            attributes["manager"] = staff_dn((number - 1) // MANAGER_FAN_OUT)
+        return attributes
+
+    def group_size(self):
+        """ Pick a group size: mostly small, with a long tail of big groups. """
+        return min(self.max_members, int(self.random.paretovariate(1.2) * 3))
+
+    def mailing_groups(self):
+        """ Return the attributes of the synthetic mailing groups, keyed by DN. """
+        groups = {}
+        for number in range(self.groups):
+            cn = group_cn(number)
+            dn = f"cn={cn},{MAILING_OU}"
+            # group-00000 is always as big as allowed so that payloads can
+            # rely on there being a large group.
+            size = self.max_members if number == 0 else self.group_size()
+            members = self.random.sample(range(self.staff), min(self.staff, size))
+            owners = self.random.sample(range(self.staff), self.random.randint(1, 3))
+            member_dns = [staff_dn(member) for member in members]
+            for member_dn in member_dns:
+                self.member_of.setdefault(member_dn, []).append(dn)
+            groups[dn] = {
+                "objectClass": ["top", "groupOfUniqueNames", "extensibleObject"],
+                "cn": cn,
+                "displayName": f"Group {number:05d}",
+                "description": f"Synthetic group {number}",
+                "mail": f"{cn}@lists.linaro.org",
+                # Empty groups have a single empty member, as on Linaro Login.
+                "uniqueMember": member_dns or [""],
+                "owner": [staff_dn(owner) for owner in owners]
+            }
+        return groups
+
+    def security_groups(self):
+        """ Return the attributes of the security groups handlers check, keyed by DN. """
+        employees = [
+            staff_dn(number) for number in range(self.staff)
+            if number % 7 != 0 and not is_leaver(number)
+        ]
+        its = [staff_dn(number) for number in range(min(self.staff, ITS_MEMBERS))]
+        groups = {}
+        for cn, members in (("employees", employees), ("its", its), ("hackbox-users", its)):
+            dn = f"cn={cn},{SECURITY_OU}"
+            for member_dn in members:
+                self.member_of.setdefault(member_dn, []).append(dn)
+            groups[dn] = {
+                "objectClass": ["top", "groupOfNames", "groupOfUniqueNames"],
+                "cn": cn,
+                "member": members,
+                "uniqueMember": members,
+                "owner": its[:1]
+            }
+        return groups
+
+    def reset(self):
+        """ Undo any changes made by a handler. """
+        self.server.dit.clear()
+        self.server.dit.update(copy.deepcopy(self.snapshot))
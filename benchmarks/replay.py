@@ -0,0 +1,282 @@
+"""
+Replay a stream of webhook events through the handlers under load.
+
+    python benchmarks/replay.py EVENTS.jsonl [--rate N | --speed N]
+                                [--concurrency N] [--repeat N] [--limit N]
+                                [--field-map FILE] [--reset] [--output FILE]
+
+EVENTS.jsonl has one event per line:
+
+    {"handler": "add_remove_group_members", "event": "create",
+     "ticket_data": {...}, "offset": 12.5}
+
+"event" is create, comment, transition (with "status_to") or jira_hook
+(with "changelog"). "ticket_data" is the ticket as delivered in the
+webhook. "offset" is the optional number of seconds after the start of
+the capture at which the event arrived. A line without "ticket_data" is
+treated as a benchmark payload (see benchmarks/payloads) so that
+synthetic traffic can be mixed in.
+
+Events are dispatched to --concurrency worker processes, each with its
+own copy of the synthetic directory and its own Service Desk stub (see
+run.py), in one of three ways:
+
+* --rate N: N events per second, ignoring the offsets;
+* --speed N: at the captured offsets, N times faster than real time;
+* neither: all at once, which measures the maximum throughput.
+
+Processes are used rather than threads because the framework keeps the
+ticket being processed in module globals. Events for the same ticket may
+run at the same time in different workers, as they can when the work
+queue is not in use.
+
+For each handler and event, the report gives the throughput, the error
+rate and the latency percentiles measured from when the event was due to
+be dispatched, so that time spent waiting for a free worker is included.
+The service time (the handler alone) is reported alongside it.
+
+Captured tickets use the real custom field IDs. Use --field-map to give
+a JSON file mapping field names to the IDs used in the capture, so that
+the stub serves the same IDs.
+"""
+
+import argparse
+import contextlib
+import copy
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+
+import run
+# run.py puts the repository and the framework on the path.
+import work_queue
+
+from directory import Directory
+from service_desk_stub import ServiceDeskStub
+
+# How long to wait for the workers to build their directories.
+STARTUP_TIMEOUT = 600
+# Give up if no event has finished for this long.
+RESULT_TIMEOUT = 600
+# How often to check that the workers are still running while waiting.
+POLL_INTERVAL = 5
+
+
+def load_events(path, repeat, limit):
+    """ Read the events, repeating the stream if asked to. """
+    with open(path, encoding="utf-8") as handle:
+        events = [json.loads(line) for line in handle if line.strip() != ""]
+    replayed = []
+    for lap in range(repeat):
+        for event in events:
+            event = copy.deepcopy(event)
+            if lap > 0 and "ticket_data" in event:
+                # Repeats of a captured event would otherwise be skipped as
+                # duplicate deliveries.
+                fields = event["ticket_data"].setdefault("fields", {})
+                fields["updated"] = f"{fields.get('updated')}#{lap}"
+            replayed.append(event)
+    if limit is not None:
+        replayed = replayed[:limit]
+    return replayed
+
+
+def schedule(events, rate, speed):
+    """ Return the number of seconds after the start at which each event is due. """
+    if rate is not None:
+        return [number / rate for number in range(len(events))]
+    if speed is not None:
+        first = min((event.get("offset", 0) for event in events), default=0)
+        return [(event.get("offset", 0) - first) / speed for event in events]
+    return [0.0] * len(events)
+
+
+def prepare(event, number, stub):
+    """ Return the ticket data and comments for an event, pointed at the stub. """
+    if "ticket_data" not in event:
+        return run.make_ticket(event, number, stub)
+    ticket_data = event["ticket_data"]
+    issue_id = ticket_data.get("id", str(number))
+    ticket_data["self"] = f"{stub.url}/rest/api/2/issue/{issue_id}"
+    comments = []
+    if "comment" in ticket_data:
+        comments.append(ticket_data["comment"])
+    return ticket_data, comments
+
+
+def worker_main(settings, tasks, results):
+    """ Build a directory and stub, then handle events until told to stop. """
+    directory = Directory(
+        settings["staff"], settings["groups"], settings["max_members"], settings["seed"])
+    stub = ServiceDeskStub(settings["sd_latency"], settings["field_ids"])
+    state_directory = tempfile.mkdtemp()
+    run.set_up(directory, state_directory)
+    results.put(("ready", os.getpid()))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        number, event, due = task
+        if settings["reset"]:
+            directory.reset()
+        ticket_data, comments = prepare(event, number, stub)
+        run.use_ticket(ticket_data, comments, stub)
+        error = None
+        output = (contextlib.nullcontext() if settings["verbose"]
+                  else contextlib.redirect_stdout(io.StringIO()))
+        with output:
+            started = time.time()
+            try:
+                handler = importlib.import_module(event["handler"])
+                run.call_handler(handler, event, ticket_data)
+            except Exception as caught:  # pylint: disable=broad-except
+                error = repr(caught)
+            finished = time.time()
+        results.put(("done", (f"{event['handler']}.{event['event']}", due, started, finished, error)))
+    stub.close()
+
+
+def next_result(results, workers, timeout):
+    """
+    Wait for the next message from the workers, giving up if one of them
+    has died or nothing arrives within the timeout.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return results.get(timeout=min(POLL_INTERVAL, max(deadline - time.time(), 0)))
+        except queue.Empty:
+            pass
+        dead = [worker for worker in workers if worker.exitcode not in (None, 0)]
+        if dead != []:
+            sys.exit(f"Worker {dead[0].pid} died with exit code {dead[0].exitcode}")
+        if time.time() >= deadline:
+            sys.exit(f"No result from the workers for {timeout} seconds")
+
+
+def summarise(outcomes, elapsed):
+    """ Return the results for each handler and event. """
+    by_name = {}
+    for name, due, started, finished, error in outcomes:
+        by_name.setdefault(name, []).append((finished - due, finished - started, error))
+    summary = {}
+    for name, runs in sorted(by_name.items()):
+        latencies = [latency for latency, _, _ in runs]
+        services = [service for _, service, _ in runs]
+        errors = [error for _, _, error in runs if error is not None]
+        summary[name] = {
+            "events": len(runs),
+            "throughput": len(runs) / elapsed if elapsed else None,
+            "errors": len(errors),
+            "error_rate": len(errors) / len(runs),
+            "first_error": errors[0] if errors else None,
+            "latency_p50": work_queue.percentile(latencies, 0.5),
+            "latency_p95": work_queue.percentile(latencies, 0.95),
+            "latency_p99": work_queue.percentile(latencies, 0.99),
+            "latency_max": max(latencies),
+            "service_p50": work_queue.percentile(services, 0.5),
+            "service_p95": work_queue.percentile(services, 0.95)
+        }
+    return summary
+
+
+def report(summary, offered, achieved):
+    """ Print the results. """
+    print(f"Offered {offered:.2f} events/s, completed {achieved:.2f} events/s")
+    print(f"{'handler':40} {'events':>6} {'per s':>7} {'errors':>7} {'p50 ms':>9} "
+          f"{'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'svc p50':>9} {'svc p95':>9}")
+    for name, result in summary.items():
+        print(f"{name:40} {result['events']:6d} {result['throughput']:7.2f} "
+              f"{result['error_rate'] * 100:6.1f}% "
+              f"{run.milliseconds(result['latency_p50'])} "
+              f"{run.milliseconds(result['latency_p95'])} "
+              f"{run.milliseconds(result['latency_p99'])} "
+              f"{run.milliseconds(result['latency_max'])} "
+              f"{run.milliseconds(result['service_p50'])} "
+              f"{run.milliseconds(result['service_p95'])}")
+        if result["first_error"] is not None:
+            print(f"{'':40} first error: {result['first_error']}")
+
+
+def main():
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(description="Replay webhook events through the handlers.")
+    parser.add_argument("events", help="JSONL file of events to replay")
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument("--rate", type=float, help="events per second")
+    pacing.add_argument("--speed", type=float, help="replay the captured offsets N times faster")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--staff", type=int, default=5000)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--max-members", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--sd-latency", type=float, default=0.0)
+    parser.add_argument("--field-map", help="JSON file mapping custom field names to IDs")
+    parser.add_argument("--reset", action="store_true",
+                        help="reset the directory before every event")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show handler output")
+    args = parser.parse_args()
+
+    events = load_events(args.events, args.repeat, args.limit)
+    if not events:
+        parser.error("no events to replay")
+    due = schedule(events, args.rate, args.speed)
+    field_ids = None
+    if args.field_map is not None:
+        with open(args.field_map, encoding="utf-8") as handle:
+            field_ids = json.load(handle)
+    settings = {
+        "staff": args.staff,
+        "groups": args.groups,
+        "max_members": args.max_members,
+        "seed": args.seed,
+        "sd_latency": args.sd_latency,
+        "field_ids": field_ids,
+        "reset": args.reset,
+        "verbose": args.verbose
+    }
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=worker_main, args=(settings, tasks, results), daemon=True)
+        for _ in range(args.concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        next_result(results, workers, STARTUP_TIMEOUT)
+    print(f"Started {args.concurrency} workers; replaying {len(events)} events")
+
+    start = time.time()
+    for number, (event, offset) in enumerate(zip(events, due), start=1):
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        tasks.put((number, event, start + offset))
+    for _ in workers:
+        tasks.put(None)
+    outcomes = [next_result(results, workers, RESULT_TIMEOUT)[1] for _ in events]
+    elapsed = time.time() - start
+    for worker in workers:
+        worker.join()
+
+    summary = summarise(outcomes, elapsed)
+    offered = len(events) / due[-1] if due[-1] > 0 else float("inf")
+    report(summary, offered, len(events) / elapsed)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump({"settings": vars(args), "results": summary}, handle, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
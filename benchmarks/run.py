@@ -0,0 +1,318 @@
+"""
+Time the handlers against a synthetic directory and a stub Service Desk.
+
+    python benchmarks/run.py [--staff N] [--groups N] [--max-members N]
+                             [--iterations N] [--warmup N] [--payload NAME ...]
+                             [--sd-latency SECONDS] [--output FILE]
+                             [--compare FILE] [--verbose]
+
+Each payload in benchmarks/payloads describes one handler call: the
+handler, the event, the reporter, the custom field values and, for
+comment and transition events, the comment or new status. Every payload
+is run --iterations times (after --warmup untimed runs) against:
+
+* the synthetic directory in benchmarks/directory.py, served by ldap3
+  MOCK_SYNC connections handed out by a replacement for
+  shared_ldap.get_ldap_connection, and reset to its original contents
+  before every run;
+* the Service Desk stub in benchmarks/service_desk_stub.py;
+* offline stand-ins for Vault, SSH, email and the Google API, which can't
+  be reached from a benchmark.
+
+The report gives the latency percentiles for each payload along with the
+number of remote calls made per run, as counted by the instrumentation
+module, and the number of HTTP requests the stub received. --output saves
+the results as JSON and --compare prints the change from a saved run.
+
+The framework is expected to be checked out next to this repository, as
+for pylint; set SD_WEBHOOK_FRAMEWORK to use a different location.
+"""
+
+# pylint: disable=wrong-import-position
+
+import argparse
+import contextlib
+import glob
+import importlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRAMEWORK = os.environ.get(
+    "SD_WEBHOOK_FRAMEWORK", os.path.join(REPOSITORY, "..", "sd-webhook-framework"))
+sys.path[:0] = [REPOSITORY, FRAMEWORK]
+
+import shared.email
+import shared.globals
+from shared import shared_google, shared_ldap, shared_vault
+
+import instrumentation
+import linaro_shared
+import work_queue
+
+from directory import Directory
+from service_desk_stub import FIELD_IDS, ServiceDeskStub
+
+PAYLOADS = os.path.join(REPOSITORY, "benchmarks", "payloads")
+BOT_NAME = "it.support.bot"
+
+
+def offline_ssh(host, user, key, timeout, command, port=22):
+    """ Pretend that the SSH command worked. """
+    _ = (host, user, key, timeout, command, port)
+    return ("", "", 0)
+
+
+def offline_secret(path, key="pw"):
+    """ Return a placeholder instead of reading Vault. """
+    _ = (path, key)
+    return "benchmark"
+
+
+def offline_email(*args, **kwargs):
+    """ Don't send email. """
+    _ = (args, kwargs)
+
+
+def offline_group_alias(email_address):
+    """ Report that no Google group has the address as an alias. """
+    _ = email_address
+
+
+# Remote services that can't be used from a benchmark. The stand-ins are
+# still counted as calls.
+OFFLINE = [
+    (linaro_shared, "ssh", "ssh", offline_ssh),
+    (shared_vault, "get_secret", "vault.get_secret", offline_secret),
+    (shared.email, "send_email_parts", "email.send_email_parts", offline_email),
+    (shared_google, "check_group_alias", "google.check_group_alias", offline_group_alias)
+]
+
+
+def set_up(directory, state_directory):
+    """ Point the handlers at the synthetic directory and the offline services. """
+    shared.globals.CONFIGURATION = {
+        "bot_name": BOT_NAME,
+        "bot_password": "benchmark",
+        "state_directory": state_directory
+    }
+    instrumentation.install()
+    # A new connection each time, as in production, so that code which closes
+    # the connection it was given doesn't break everything that follows.
+    shared_ldap.get_ldap_connection = directory.connect
+    for module, name, call, replacement in OFFLINE:
+        setattr(module, name, instrumentation.wrap(call, replacement))
+
+
+def load_payloads(names):
+    """ Return the requested payloads (or all of them), keyed by name. """
+    payloads = {}
+    for path in sorted(glob.glob(os.path.join(PAYLOADS, "*.json"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if not names or name in names:
+            with open(path, encoding="utf-8") as handle:
+                payloads[name] = json.load(handle)
+    return payloads
+
+
+def user(uid):
+    """ Return a Jira user object for a synthetic account. """
+    return {"accountId": uid, "emailAddress": f"{uid}@linaro.org", "displayName": uid}
+
+
+def make_ticket(payload, number, stub):
+    """
+    Build the ticket data for one run. Each run gets its own key and
+    "updated" value so that idempotency checks and step journals from one
+    run don't affect the next.
+    """
+    issue_id = 100000 + number
+    fields = {FIELD_IDS[name]: value for name, value in payload["fields"].items()}
+    fields.update({
+        "summary": payload.get("description", ""),
+        "reporter": user(payload["reporter"]),
+        "status": {"name": payload.get("status", "Open")},
+        "updated": f"benchmark-{number}",
+        "attachment": []
+    })
+    ticket_data = {
+        "id": str(issue_id),
+        "key": f"BENCH-{number}",
+        "self": f"{stub.url}/rest/api/2/issue/{issue_id}",
+        "fields": fields
+    }
+    comments = []
+    if "comment" in payload:
+        comment = {
+            "id": str(issue_id),
+            "body": payload["comment"]["body"],
+            "public": payload["comment"]["public"],
+            "author": user(payload["comment"]["author"])
+        }
+        ticket_data["comment"] = comment
+        comments.append(comment)
+    return ticket_data, comments
+
+
+def use_ticket(ticket_data, comments, stub):
+    """ Serve the ticket from the stub and make it the one being processed. """
+    stub.serve_ticket(ticket_data, comments)
+    shared.globals.TICKET_DATA = ticket_data
+    shared.globals.TICKET = ticket_data["key"]
+    shared.globals.PROJECT = ticket_data["key"].split("-")[0]
+    shared.globals.ROOT_URL = stub.url
+    shared.globals.REPORTER = ticket_data["fields"]["reporter"]["emailAddress"]
+
+
+def call_handler(handler, payload, ticket_data):
+    """ Call the handler's entry point for the payload's event. """
+    event = payload["event"]
+    if event == "transition":
+        return handler.transition(payload["status_to"], ticket_data)
+    if event == "jira_hook":
+        return handler.jira_hook(ticket_data, payload.get("changelog", {}))
+    return getattr(handler, event)(ticket_data)
+
+
+def run_once(name, payload, number, directory, stub, verbose):
+    """ Run a payload once, returning the time taken, the calls made and any error. """
+    directory.reset()
+    stub.take_counts()
+    ticket_data, comments = make_ticket(payload, number, stub)
+    use_ticket(ticket_data, comments, stub)
+    handler = importlib.import_module(payload["handler"])
+    error = None
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output, instrumentation.recording(name) as invocation:
+        started = time.perf_counter()
+        try:
+            call_handler(handler, payload, ticket_data)
+        except Exception as caught:  # pylint: disable=broad-except
+            error = repr(caught)
+        elapsed = time.perf_counter() - started
+    calls = {call: total["count"] for call, total in invocation.totals.items()}
+    return elapsed, calls, stub.take_counts(), error
+
+
+def summarise(timings, calls, requests, errors):
+    """ Return the results for one payload. """
+    runs = len(timings)
+    call_types = sorted({call for run in calls for call in run})
+    request_types = sorted({request for run in requests for request in run})
+    return {
+        "runs": runs,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50": work_queue.percentile(timings, 0.5),
+        "p90": work_queue.percentile(timings, 0.9),
+        "p99": work_queue.percentile(timings, 0.99),
+        "max": max(timings),
+        "calls": sum(sum(run.values()) for run in calls) / runs,
+        "calls_by_type": {
+            call: sum(run.get(call, 0) for run in calls) / runs for call in call_types
+        },
+        "http_requests": sum(sum(run.values()) for run in requests) / runs,
+        "http_requests_by_type": {
+            request: sum(run.get(request, 0) for run in requests) / runs
+            for request in request_types
+        }
+    }
+
+
+def milliseconds(seconds):
+    """ Format a time for the report. """
+    return f"{seconds * 1000:9.1f}"
+
+
+def report(results, baseline):
+    """ Print the results, with the change from the baseline if there is one. """
+    print(f"{'payload':40} {'runs':>5} {'errors':>6} {'p50 ms':>9} {'p90 ms':>9} "
+          f"{'p99 ms':>9} {'max ms':>9} {'calls':>7} {'http':>7}")
+    for name, result in results.items():
+        print(f"{name:40} {result['runs']:5d} {result['errors']:6d} "
+              f"{milliseconds(result['p50'])} {milliseconds(result['p90'])} "
+              f"{milliseconds(result['p99'])} {milliseconds(result['max'])} "
+              f"{result['calls']:7.1f} {result['http_requests']:7.1f}")
+        before = baseline.get(name)
+        if before is not None:
+            changes = []
+            for measure in ("p50", "p90", "p99", "calls", "http_requests"):
+                if before.get(measure):
+                    change = (result[measure] - before[measure]) / before[measure] * 100
+                    changes.append(f"{measure} {change:+.1f}%")
+            print(f"{'':40} vs baseline: {', '.join(changes)}")
+        if result["first_error"] is not None:
+            print(f"{'':40} first error: {result['first_error']}")
+    print()
+    print("Calls per run:")
+    for name, result in results.items():
+        calls = ", ".join(
+            f"{call} {count:g}" for call, count in result["calls_by_type"].items())
+        print(f"  {name}: {calls}")
+
+
+def main():
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(description="Benchmark the handlers offline.")
+    parser.add_argument("--staff", type=int, default=5000)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--max-members", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--payload", action="append", default=[],
+                        help="only run this payload (may be repeated)")
+    parser.add_argument("--sd-latency", type=float, default=0.0,
+                        help="seconds added to every Service Desk response")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare with results saved by --output")
+    parser.add_argument("--verbose", action="store_true", help="show handler output")
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.payload)
+    if not payloads:
+        parser.error("no matching payloads")
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as handle:
+            baseline = json.load(handle)["results"]
+
+    started = time.perf_counter()
+    directory = Directory(args.staff, args.groups, args.max_members, args.seed)
+    print(f"Built a directory of {args.staff} accounts and {args.groups} groups "
+          f"in {time.perf_counter() - started:.1f}s")
+    stub = ServiceDeskStub(args.sd_latency)
+    results = {}
+    number = 0
+    with tempfile.TemporaryDirectory() as state_directory:
+        set_up(directory, state_directory)
+        for name, payload in payloads.items():
+            timings, calls, requests, errors = [], [], [], []
+            for iteration in range(args.warmup + args.iterations):
+                number += 1
+                elapsed, run_calls, run_requests, error = run_once(
+                    name, payload, number, directory, stub, args.verbose)
+                if iteration < args.warmup:
+                    continue
+                timings.append(elapsed)
+                calls.append(run_calls)
+                requests.append(run_requests)
+                if error is not None:
+                    errors.append(error)
+            results[name] = summarise(timings, calls, requests, errors)
+    stub.close()
+
+    report(results, baseline)
+    if args.output is not None:
+        settings = {key: value for key, value in vars(args).items()
+                    if key not in ("output", "compare", "verbose")}
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump({"settings": settings, "results": results}, handle, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
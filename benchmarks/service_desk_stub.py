@@ -0,0 +1,168 @@
+"""
+A local HTTP server that stands in for the Jira Service Desk API.
+
+Ticket reads are answered from the payload being benchmarked, account
+lookups treat the account ID as the uid of a synthetic account, and every
+write is accepted without doing anything. Each request is counted by
+method and path (with ticket keys and numbers replaced by placeholders)
+so that the number of Service Desk calls a handler makes can be reported.
+An optional delay can be added to every response to approximate the
+latency of the real service.
+"""
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The custom fields used by the handlers and the IDs the stub gives them.
+FIELD_NAMES = [
+    "Added / Removed",
+    "Approvers",
+    "Assignee/Member Engineer",
+    "Email Address",
+    "Email Address(es) of Users (Legacy ITS)",
+    "Email Address(es) of Users",
+    "Employee/Contractor",
+    "Engineer Type",
+    "Engineering Team",
+    "Executive Approvers",
+    "External Account / Contact",
+    "Family Name",
+    "First Name (migrated)",
+    "First Name",
+    "Group / List Description",
+    "Group / List Name",
+    "Group Email Address",
+    "Group Owner(s)",
+    "Member Company Name",
+    "New job title",
+    "Reports To"
+]
+FIELD_IDS = {name: f"customfield_{10100 + index}" for index, name in enumerate(FIELD_NAMES)}
+# Transitions offered for every ticket.
+STATUSES = [
+    "Open", "In Progress", "Needs approval", "Waiting for support",
+    "Waiting for Support", "Waiting for customer", "Resolved", "Declined"
+]
+# Turns a path into the form used to count requests.
+PLACEHOLDERS = [
+    (re.compile(r"/[A-Z][A-Z0-9]+-\d+"), "/{key}"),
+    (re.compile(r"/\d+"), "/{id}"),
+    (re.compile(r"accountId=[^&]+"), "accountId={id}"),
+]
+
+
+def path_template(path):
+    """ Return the path with the variable parts replaced by placeholders. """
+    for pattern, replacement in PLACEHOLDERS:
+        path = pattern.sub(replacement, path)
+    return path
+
+
+class ServiceDeskStub:
+    """ The stub server and the ticket it is currently serving. """
+
+    def __init__(self, delay=0.0, field_ids=None):
+        self.delay = delay
+        self.field_ids = FIELD_IDS if field_ids is None else field_ids
+        self.ticket = None
+        self.comments = []
+        self.counts = {}
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """ Route each request to the stub. """
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """ Answer a read. """
+                stub.respond(self, "GET")
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """ Accept a write. """
+                stub.respond(self, "POST")
+
+            def do_PUT(self):  # pylint: disable=invalid-name
+                """ Accept a write. """
+                stub.respond(self, "PUT")
+
+            def do_DELETE(self):  # pylint: disable=invalid-name
+                """ Accept a write. """
+                stub.respond(self, "DELETE")
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                """ Keep the benchmark output readable. """
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def serve_ticket(self, ticket_data, comments):
+        """ Set the ticket and comments returned by reads. """
+        self.ticket = ticket_data
+        self.comments = comments
+
+    def take_counts(self):
+        """ Return the request counts since the last call and reset them. """
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def respond(self, request, method):
+        """ Count the request and send the response. """
+        path = request.path
+        with self.lock:
+            name = f"{method} {path_template(path.split('?')[0])}"
+            self.counts[name] = self.counts.get(name, 0) + 1
+        length = int(request.headers.get("Content-Length") or 0)
+        if length:
+            request.rfile.read(length)
+        if self.delay:
+            time.sleep(self.delay)
+        status, body = self.route(method, path)
+        payload = b"" if body is None else json.dumps(body).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def route(self, method, path):
+        """ Work out the response for a request. """
+        if method != "GET":
+            return (204, None) if method in ("PUT", "DELETE") else (201, {})
+        if path.startswith("/rest/api/2/field"):
+            return 200, [
+                {"id": field_id, "name": name, "custom": True}
+                for name, field_id in self.field_ids.items()
+            ]
+        if "/comment" in path:
+            return 200, {
+                "size": len(self.comments),
+                "isLastPage": True,
+                "values": self.comments,
+                "comments": self.comments
+            }
+        if "/transition" in path:
+            transitions = [
+                {"id": str(index + 1), "name": status, "to": {"name": status}}
+                for index, status in enumerate(STATUSES)
+            ]
+            return 200, {"values": transitions, "transitions": transitions}
+        if "accountId=" in path:
+            # Payloads use the uid of a synthetic account as the account ID.
+            account_id = path.split("accountId=")[1].split("&")[0]
+            return 200, {
+                "accountId": account_id,
+                "emailAddress": f"{account_id}@linaro.org",
+                "displayName": account_id
+            }
+        if "/rest/api/2/issue/" in path or "/rest/servicedeskapi/request/" in path:
+            return 200, self.ticket
+        return 200, {}
+
+    def close(self):
+        """ Stop the server. """
+        self.server.shutdown()
@@ -0,0 +1,185 @@
+"""
+Time the SSH path used to trigger GCDS against a local stub server.
+
+    python benchmarks/ssh_benchmark.py [--iterations N] [--commands-per-connection N]
+                                       [--latency S] [--auth-latency S] [--hang S]
+                                       [--stdout-size BYTES] [--stderr-size BYTES]
+                                       [--exit-status N] [--timeout S]
+                                       [--host-key FILE] [--trigger]
+
+By default each iteration opens a connection, runs
+--commands-per-connection commands through linaro_shared.exec_command
+and closes it. The time is split into:
+
+* connect: TCP connection, key exchange and authentication;
+* command: opening the channel and starting the command;
+* drain: reading the output and exit status in exec_command.
+
+Setting --commands-per-connection above 1 shows what reusing a connection
+would save. --trigger instead times linaro_shared.trigger_google_sync as a
+whole, pointed at the stub, which includes loading the key and posting
+the result comment (to a no-op).
+
+The stub's behaviour (latency, output sizes, exit status and hanging) is
+set from the command line; see ssh_stub.py.
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+import paramiko
+
+import run
+# run.py puts the repository and the framework on the path.
+import linaro_shared
+import work_queue
+from shared import shared_sd, shared_vault
+
+from ssh_stub import Behaviour, SSHStub
+
+USER = "it-support-bot"
+COMMAND = "benchmark"
+
+
+def private_key_text(key):
+    """ Return a paramiko key as the PEM text that linaro_shared.ssh expects. """
+    text = io.StringIO()
+    key.write_private_key(text)
+    return text.getvalue()
+
+
+def timed_connection(stub, client_key, commands, timeout, expected):
+    """
+    Connect, run the commands and disconnect, returning the connect time,
+    the command and drain times for each command, and the number of
+    commands whose output or exit status was wrong.
+    """
+    client = paramiko.SSHClient()
+    client.get_host_keys().add(f"[127.0.0.1]:{stub.port}", "ssh-rsa", stub.host_key)
+    started = time.perf_counter()
+    client.connect(
+        "127.0.0.1", port=stub.port, username=USER, pkey=client_key,
+        allow_agent=False, look_for_keys=False)
+    connect = time.perf_counter() - started
+
+    # Time how long exec_command spends starting the command so that the
+    # rest of linaro_shared.exec_command can be counted as draining.
+    original = client.exec_command
+    command_times = []
+
+    def exec_command(command):
+        started = time.perf_counter()
+        result = original(command)
+        command_times.append(time.perf_counter() - started)
+        return result
+    client.exec_command = exec_command
+
+    timings = []
+    wrong = 0
+    for _ in range(commands):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            stdout, stderr, status = linaro_shared.exec_command(client, COMMAND, timeout)
+        total = time.perf_counter() - started
+        timings.append((command_times[-1], total - command_times[-1]))
+        if (len(stdout), len(stderr), status) != expected:
+            wrong += 1
+    client.close()
+    return connect, timings, wrong
+
+
+def time_trigger(stub, client_key, iterations):
+    """ Time linaro_shared.trigger_google_sync against the stub. """
+    linaro_shared.HOST_KEYS["127.0.0.1"] = stub.host_key_base64
+    linaro_shared.GCDS_HOST = "127.0.0.1"
+    linaro_shared.GCDS_PORT = stub.port
+    pem = private_key_text(client_key)
+    shared_vault.get_secret = lambda path, key="pw": pem
+    shared_sd.post_comment = lambda comment, public: None
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            linaro_shared.trigger_google_sync()
+        timings.append(time.perf_counter() - started)
+    return {"trigger": timings}
+
+
+def time_phases(stub, client_key, args):
+    """ Time the connect, command and drain phases separately. """
+    expected = (args.stdout_size, args.stderr_size, args.exit_status)
+    phases = {"connect": [], "command": [], "drain": [], "per command": []}
+    wrong = 0
+    for _ in range(args.iterations):
+        started = time.perf_counter()
+        connect, timings, bad = timed_connection(
+            stub, client_key, args.commands_per_connection, args.timeout, expected)
+        elapsed = time.perf_counter() - started
+        phases["connect"].append(connect)
+        phases["command"].extend(command for command, _ in timings)
+        phases["drain"].extend(drain for _, drain in timings)
+        phases["per command"].append(elapsed / args.commands_per_connection)
+        wrong += bad
+    if wrong:
+        print(f"{wrong} commands returned the wrong output or exit status")
+    return phases
+
+
+def report(phases):
+    """ Print the percentiles for each phase. """
+    print(f"{'phase':12} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for phase, timings in phases.items():
+        print(f"{phase:12} {len(timings):6d} "
+              f"{run.milliseconds(work_queue.percentile(timings, 0.5))} "
+              f"{run.milliseconds(work_queue.percentile(timings, 0.95))} "
+              f"{run.milliseconds(work_queue.percentile(timings, 0.99))} "
+              f"{run.milliseconds(max(timings))}")
+
+
+def main():
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(description="Benchmark the GCDS SSH path locally.")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--commands-per-connection", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds before each command produces output")
+    parser.add_argument("--auth-latency", type=float, default=0.0)
+    parser.add_argument("--hang", type=float, default=0.0,
+                        help="extra seconds each command hangs for")
+    parser.add_argument("--stdout-size", type=int, default=4096)
+    parser.add_argument("--stderr-size", type=int, default=0)
+    parser.add_argument("--exit-status", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=100,
+                        help="timeout passed to exec_command")
+    parser.add_argument("--host-key", help="RSA private key file for the stub's host key")
+    parser.add_argument("--trigger", action="store_true",
+                        help="time trigger_google_sync as a whole")
+    args = parser.parse_args()
+
+    host_key = None
+    if args.host_key is not None:
+        host_key = paramiko.RSAKey.from_private_key_file(args.host_key)
+    behaviour = Behaviour(
+        auth_latency=args.auth_latency,
+        latency=args.latency,
+        hang=args.hang,
+        stdout_size=args.stdout_size,
+        stderr_size=args.stderr_size,
+        exit_status=args.exit_status)
+    stub = SSHStub(behaviour, host_key)
+    client_key = paramiko.RSAKey.generate(2048)
+    try:
+        if args.trigger:
+            phases = time_trigger(stub, client_key, args.iterations)
+        else:
+            phases = time_phases(stub, client_key, args)
+    finally:
+        stub.close()
+    report(phases)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
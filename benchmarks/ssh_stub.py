@@ -0,0 +1,140 @@
+"""
+A local SSH server that stands in for the host used to trigger GCDS.
+
+It accepts any public key, and every command it is asked to run waits for
+the configured latency, optionally hangs, writes the configured amount of
+output to stdout and stderr and then exits with the configured status.
+The host key is generated when the server starts unless one is given.
+"""
+
+import socket
+import threading
+import time
+
+import paramiko
+
+# Each line of generated output is this long, including the newline.
+LINE_LENGTH = 80
+# Output is sent in chunks of this size.
+CHUNK_SIZE = 32 * 1024
+
+
+class Behaviour:  # pylint: disable=too-few-public-methods
+    """
+    How the stub responds: auth_latency is the time before authentication
+    succeeds, latency the time before a command starts producing output and
+    hang an additional delay before any output, for simulating a stuck
+    command. The sizes are in bytes.
+    """
+
+    def __init__(self, auth_latency=0.0, latency=0.0, hang=0.0,
+                 stdout_size=0, stderr_size=0, exit_status=0):
+        # pylint: disable=too-many-arguments
+        self.auth_latency = auth_latency
+        self.latency = latency
+        self.hang = hang
+        self.stdout_size = stdout_size
+        self.stderr_size = stderr_size
+        self.exit_status = exit_status
+
+
+def generated_output(size):
+    """ Return size bytes of line-oriented output. """
+    line = b"x" * (LINE_LENGTH - 1) + b"\n"
+    return (line * (size // LINE_LENGTH + 1))[:size]
+
+
+class StubServer(paramiko.ServerInterface):
+    """ The server side of one SSH connection. """
+
+    def __init__(self, behaviour):
+        super().__init__()
+        self.behaviour = behaviour
+
+    def get_allowed_auths(self, username):
+        """ Only public key authentication is offered. """
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        """ Accept any key, after the configured delay. """
+        time.sleep(self.behaviour.auth_latency)
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        """ Only session channels are needed to run commands. """
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        """ Respond to the command in the background so the transport isn't blocked. """
+        threading.Thread(target=self.run_command, args=(channel,), daemon=True).start()
+        return True
+
+    def run_command(self, channel):
+        """ Produce the configured response to a command. """
+        behaviour = self.behaviour
+        time.sleep(behaviour.latency + behaviour.hang)
+        stdout = generated_output(behaviour.stdout_size)
+        stderr = generated_output(behaviour.stderr_size)
+        try:
+            for offset in range(0, max(len(stdout), len(stderr)), CHUNK_SIZE):
+                if offset < len(stdout):
+                    channel.sendall(stdout[offset:offset + CHUNK_SIZE])
+                if offset < len(stderr):
+                    channel.sendall_stderr(stderr[offset:offset + CHUNK_SIZE])
+            channel.send_exit_status(behaviour.exit_status)
+        except (EOFError, OSError, paramiko.SSHException):
+            # The client gave up waiting.
+            pass
+        finally:
+            channel.close()
+
+
+class SSHStub:
+    """ Listen on a local port and serve each connection with a StubServer. """
+
+    def __init__(self, behaviour, host_key=None):
+        self.behaviour = behaviour
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(100)
+        self.port = self.listener.getsockname()[1]
+        self.running = True
+        threading.Thread(target=self.accept_connections, daemon=True).start()
+
+    @property
+    def host_key_base64(self):
+        """ The public host key in the form used by linaro_shared.HOST_KEYS. """
+        return self.host_key.get_base64()
+
+    def accept_connections(self):
+        """ Hand each incoming connection to its own thread. """
+        while self.running:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        """ Run the SSH protocol on a connection until the client goes away. """
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=StubServer(self.behaviour))
+            while transport.is_active():
+                # Channels are handled by check_channel_exec_request; this
+                # just stops them piling up in the accept queue.
+                transport.accept(1)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            transport.close()
+
+    def close(self):
+        """ Stop accepting connections. """
+        self.running = False
+        self.listener.close()
@@ -1,75 +1,197 @@
 """
 Because this ticket uses a multi-user picker, there is the possibility that
-the users report to different managers. So, if the ticket is submitted by
-someone who reports to an Exec, we go straight to Executive Approval,
-otherwise we get their manager's approval.
+the users report to different managers. The managers and Execs for
+everyone picked are looked up together and each manager is asked to
+approve once, however many of the people they manage have been picked.
+If the ticket is submitted by the manager of everyone picked, or they
+all report to an Exec, we go straight to Executive Approval.
 """
 
 import shared.custom_fields as custom_fields
 import shared.globals
-import shared.shared_ldap as shared_ldap
 import shared.shared_sd as shared_sd
+import approval_chain
+import instrumentation
 import linaro_shared
+import profiler
 
 CAPABILITIES = [
     "COMMENT",
     "CREATE"
 ]
 
+# The multi-user picker holding the people whose team is changing. If the
+# project doesn't have a field with this name, IT Services are told and no
+# approvals are routed.
+STAFF_PICKER = "Staff Members"
+STAFF_BASE = "ou=staff,ou=accounts,dc=linaro,dc=org"
+# How long to allow for looking up the picked people's email addresses.
+LOOKUP_DEADLINE = 60
+
+@instrumentation.instrumented
 def comment(ticket_data):
     """ Triggered when a comment is posted """
     _, keyword = shared_sd.central_comment_handler(
-        [], ["help", "retry"])
+        [], ["help", "retry", "profile"])
 
     if keyword == "help":
         shared_sd.post_comment(("All bot commands must be internal comments and the first word/phrase in the comment.\r\n\r\n"
                                "Valid commands are:\r\n"
-                               "* retry to ask the bot to process the request again after issues have been resolved."), False)
+                               "* retry to ask the bot to process the request again after issues have been resolved.\r\n"
+                               "* profile to run the request again without making any changes and attach a performance profile."), False)
     elif keyword == "retry":
         print("bulk_modify_team processing retry keyword & triggering create function")
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
 
 
+@instrumentation.instrumented
 def create(ticket_data):
     """ Create event triggered. """
-    staff_dn = shared_ldap.find_single_object_from_email(shared.globals.REPORTER)
-    # Get the manager of the person who created this ticket.
-    mgr_email = shared_ldap.get_manager_from_dn(staff_dn)
-    if mgr_email is None:
-        # Fall back to getting Diane to approve the ticket
-        mgr_email = "diane.cheshire@linaro.org"
-    # Get their Exec
-    exec_email = linaro_shared.get_exec_from_dn(staff_dn)
-    if exec_email is not None:
-        cf_exec_approvers = custom_fields.get("Executive Approvers")
-        shared_sd.assign_approvers([exec_email], cf_exec_approvers)
-    else:
+    cf_staff = custom_fields.get(STAFF_PICKER)
+    if cf_staff is None:
+        # Without the picker there's no way to tell who else needs approval.
         shared_sd.post_comment(
-            "[~philip.colmer@linaro.org] Cannot find an exec for %s"
-            % staff_dn, False
-        )
-    # If the ticket wasn't created by the manager, get the manager to approve
-    # it.
-    if mgr_email != exec_email:
+            "[~philip.colmer@linaro.org] The approvals have not been routed "
+            "because there is no '%s' field. Use retry once the field has "
+            "been added to the request type." % STAFF_PICKER, False)
+        return
+    emails, unresolved = picked_people(ticket_data, cf_staff)
+    if emails == [] and unresolved == []:
+        # Nobody picked, so route the approval for the reporter as before.
+        emails = [shared.globals.REPORTER]
+    dns = find_dns(emails)
+    unresolved += [
+        "Cannot find %s in LDAP" % email for email in emails if email.lower() not in dns
+    ]
+    if unresolved != []:
+        # Routing for only some of the people picked would let the others
+        # skip their manager's and Exec's approval.
+        shared_sd.post_comment(
+            "[~philip.colmer@linaro.org] The approvals have not been routed "
+            "because not everyone picked could be found. Use retry once this "
+            "has been fixed.\r\n%s" % "\r\n".join(unresolved), False)
+        return
+    chains = approval_chain.lookup_many(dns.values())
+    managers, execs, problems = route_approvals(emails, dns, chains)
+    if problems != []:
         shared_sd.post_comment(
-            "As you do not report to an Exec, %s will be asked to "
-            "approve or decline your request." % mgr_email,
+            "[~philip.colmer@linaro.org] %s" % "\r\n".join(problems), False)
+
+    if execs != {}:
+        cf_exec_approvers = custom_fields.get("Executive Approvers")
+        shared_sd.assign_approvers(sorted(execs), cf_exec_approvers)
+    # Managers approve first unless the person who created the ticket
+    # manages everyone picked, or they all report directly to an Exec.
+    if managers != {}:
+        shared_sd.post_comment(
+            "The following people will be asked to approve or decline your "
+            "request:\r\n%s" % approver_list(managers),
             True
         )
-        if exec_email is not None:
+        if execs != {}:
             shared_sd.post_comment(
-                "If that approval is given, %s will then be asked to approve "
-                "or decline your request." % exec_email,
+                "If those approvals are given, the following people will then "
+                "be asked to approve or decline your request:\r\n%s"
+                % approver_list(execs),
                 True
             )
         cf_approvers = custom_fields.get("Approvers")
-        shared_sd.assign_approvers([mgr_email], cf_approvers)
+        shared_sd.assign_approvers(sorted(managers), cf_approvers)
         shared_sd.transition_request_to("Needs Approval")
     else:
-        if exec_email is not None:
+        if execs != {}:
             shared_sd.post_comment(
-                "%s will be asked to approve or decline your "
-                "request." % exec_email,
+                "The following people will be asked to approve or decline "
+                "your request:\r\n%s" % approver_list(execs),
                 True
             )
         shared_sd.transition_request_to("Executive Approval")
+
+
+def picked_people(ticket_data, cf_staff):
+    """
+    Return the email addresses of the people picked on the ticket and a
+    description of each picked person whose address couldn't be found.
+    """
+    picked = shared_sd.get_field(ticket_data, cf_staff)
+    if picked is None:
+        return [], []
+    emails = [user["emailAddress"] for user in picked if "emailAddress" in user]
+    # Look up the addresses that the picker doesn't include all at once.
+    missing = {user["accountId"]: user for user in picked if "emailAddress" not in user}
+    if missing == {}:
+        return emails, []
+    accounts = linaro_shared.run_concurrently(
+        {
+            account_id: (shared_sd.find_account_from_id, (account_id,))
+            for account_id in missing
+        },
+        LOOKUP_DEADLINE)
+    if accounts is None:
+        return emails, [
+            "Timed out looking up the email address of %s" % describe(user)
+            for user in missing.values()
+        ]
+    unresolved = []
+    for account_id, account in accounts.items():
+        if account is None or "emailAddress" not in account:
+            unresolved.append(
+                "Cannot find the email address of %s" % describe(missing[account_id]))
+        else:
+            emails.append(account["emailAddress"])
+    return emails, unresolved
+
+
+def describe(user):
+    """ Name a picked user in a comment. """
+    return user.get("displayName", user["accountId"])
+
+
+def find_dns(emails):
+    """
+    Find the accounts for the email addresses in batched searches. Returns
+    a dict mapping the lower case addresses that were found onto the DNs.
+    """
+    dns = {}
+    for entry in linaro_shared.find_matching_any(
+            [("mail", email) for email in emails], ["mail"], base=STAFF_BASE):
+        for mail in entry.mail.values:
+            dns[mail.lower()] = entry.entry_dn
+    return dns
+
+
+def route_approvals(emails, dns, chains):
+    """
+    Group the people by who needs to approve the change for them. Returns
+    the manager and Exec approvers, each as a dict mapping the approver
+    onto the people they are approving for, and any problems to report.
+    """
+    managers = {}
+    execs = {}
+    problems = []
+    for email in emails:
+        dn = dns[email.lower()]
+        chain = chains[dn]
+        manager = chain.manager
+        if manager is None:
+            # Fall back to getting Diane to approve the ticket
+            manager = chain.fallback
+        if chain.exec is not None:
+            execs.setdefault(chain.exec, []).append(email)
+        elif chain.leaver is not None:
+            problems.append(
+                "Cannot find an exec for %s because %s is leaving" % (dn, chain.leaver))
+        else:
+            problems.append("Cannot find an exec for %s" % dn)
+        if manager not in (chain.exec, shared.globals.REPORTER):
+            managers.setdefault(manager, []).append(email)
+    return managers, execs, problems
+
+
+def approver_list(approvers):
+    """ Format the approvers and the people they are approving for. """
+    return "\r\n".join(
+        "* %s (for %s)" % (approver, ", ".join(people))
+        for approver, people in sorted(approvers.items()))
@@ -1,6 +1,10 @@
 """ Handler to create external users or accounts. """
 
+import csv
+import io
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 import shared.custom_fields as custom_fields
 import shared.email
@@ -8,7 +12,13 @@ import shared.globals
 import shared.shared_ldap as shared_ldap
 import shared.shared_sd as shared_sd
 
+import directory_replica
+import directory_search
+import instrumentation
 import linaro_shared
+import profiler
+import step_journal
+import work_queue
 
 # Define what this handler can handle.
 CAPABILITIES = [
@@ -17,27 +27,59 @@ CAPABILITIES = [
 ]
 
 WONT_DO = "Won't Do"
+STAFF_OU = "ou=staff,ou=accounts,dc=linaro,dc=org"
+THE_REST_OU = "ou=the-rest,ou=accounts,dc=linaro,dc=org"
 
+# Bulk mode creates accounts in parallel but keeps the number of
+# concurrent LDAP connections modest.
+BULK_WORKERS = 4
+# Column headings accepted in a bulk CSV, with case, spaces and punctuation
+# ignored, mapped onto the equivalent form field.
+BULK_COLUMNS = {
+    "emailaddress": "email",
+    "email": "email",
+    "firstname": "first_name",
+    "givenname": "first_name",
+    "familyname": "surname",
+    "surname": "surname",
+    "lastname": "surname",
+}
+
+@work_queue.queued
+@instrumentation.instrumented
 def comment(ticket_data):
     """ Comment handler """
     last_comment, keyword = shared_sd.central_comment_handler(
         [],
-        ["help", "retry"]
+        ["help", "retry", "profile"]
     )
     if keyword == "help":
         shared_sd.post_comment(
             "All bot commands must be internal comments and the first "
             "word/phrase in the comment.\r\n\r\n"
             "Valid commands are:\r\n"
-            "* retry to ask the bot to process the request again after issues have been resolved.",
+            "* retry to ask the bot to process the request again after issues have been resolved.\r\n"
+            "* profile to run the request again without making any changes and attach a "
+            "performance profile.",
             False)
     elif keyword == "retry":
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
     elif last_comment is not None and last_comment['public']:
         shared_sd.deassign_ticket_if_appropriate(comment)
 
+@work_queue.queued
+@instrumentation.instrumented
 def create(ticket_data):
     """ Ticket creation handler. """
+    # If a CSV file has been attached, create an account for each row in it
+    # rather than using the form fields.
+    attachment = linaro_shared.get_csv_attachment(ticket_data)
+    if attachment is not None:
+        create_bulk(ticket_data, attachment)
+        return
+
     cf_email_address = custom_fields.get("Email Address")
     email_address = shared_sd.get_field(
         ticket_data, cf_email_address)
@@ -54,7 +96,12 @@ def create(ticket_data):
 
     shared_sd.set_summary(f"Create external user/account for {email_address}")
 
-    if not ok_to_proceed(email_address):
+    # If this is a retry after the account was created, the policy checks
+    # would now fail because the account exists, so go straight to the
+    # remaining steps.
+    journal = step_journal.journal(ticket_data)
+    created = journal.done("create_account")
+    if not created and not ok_to_proceed(email_address):
         return
 
     cf_first_name = custom_fields.get("First Name")
@@ -66,8 +113,8 @@ def create(ticket_data):
     surname = shared_sd.get_field(
         ticket_data, cf_family_name).strip()
 
-    uid = shared_ldap.calculate_uid(first_name, surname)
-    if uid is None:
+    uid = None if created else shared_ldap.calculate_uid(first_name, surname)
+    if not created and uid is None:
         shared_sd.post_comment("It has not been possible to create the account as requested.", True)
         shared_sd.post_comment(f"Cannot calculated UID for '{first_name}' '{surname}'", False)
         shared_sd.resolve_ticket("Declined")
@@ -76,110 +123,312 @@ def create(ticket_data):
     md5_password = None
     cf_account_type = custom_fields.get("External Account / Contact")
     account_type = shared_sd.get_field(ticket_data, cf_account_type)["value"]
-    if account_type != "Contact":
-        _, md5_password = linaro_shared.make_password()
-    account_dn = shared_ldap.create_account(
-        first_name,
-        surname,
-        email_address,
-        md5_password
-    )
-    if account_dn is None:
-        shared_sd.post_comment(
-            "Sorry but something went wrong while creating the entry",
-            True)
-        shared_sd.transition_request_to("Waiting for support")
-        shared_sd.assign_issue_to(None)
-        return
+    if created:
+        account_dn = journal.result("create_account")
+    else:
+        if account_type != "Contact":
+            _, md5_password = linaro_shared.make_password()
+        account_dn = shared_ldap.create_account(
+            first_name,
+            surname,
+            email_address,
+            md5_password
+        )
+        directory_replica.refresh(account_dn)
+        if account_dn is None:
+            shared_sd.post_comment(
+                "Sorry but something went wrong while creating the entry",
+                True)
+            shared_sd.transition_request_to("Waiting for support")
+            shared_sd.assign_issue_to(None)
+            return
+        journal.record("create_account", account_dn)
 
-    shared_sd.post_comment(
-        f"{account_type} created at {account_dn}",
-        True
-    )
+        shared_sd.post_comment(
+            f"{account_type} created at {account_dn}",
+            True
+        )
 
     if account_type != "Contact":
-        send_new_account_email(
+        journal.run(
+            "email",
+            send_new_account_email,
             first_name,
             surname,
             email_address,
             account_dn
         )
 
+    journal.finish()
     shared_sd.resolve_ticket()
 
 def ok_to_proceed(email_address):
     """ Enforce company policy rules. """
-    # Is the email address already present in LDAP?
-    check = shared_ldap.find_from_email(email_address)
-    if check is None:
-        check = shared_ldap.find_from_attribute("cn", email_address)
-    if check is not None:
-        response = (
-            "Cannot fulfil this request because the email address is "
-            f"already being used by {check}"
-        )
-        shared_sd.post_comment(response, True)
+    # Is the email address already present in LDAP, either as an entry or as
+    # the backup address for an account?
+    conflicts = find_conflicts([email_address])
+    if email_address in conflicts:
+        shared_sd.post_comment(
+            f"Cannot fulfil this request because {conflicts[email_address]}", True)
         shared_sd.resolve_ticket(WONT_DO)
         return False
 
-    check = shared_ldap.find_from_attribute("passwordSelfResetBackupMail", email_address)
-    if check is not None:
-        dup_email = shared_ldap.get_object(check, ["mail"])
-        if dup_email.mail.values != []:
-            dup_email = dup_email.mail.values[0]
-        else:
-            # No email address so provide the DN instead
-            dup_email = check
-
-        response = (
-            "Cannot fulfil this request because there is a Linaro "
-            f"account associated with the email address ({dup_email})"
-        )
-        shared_sd.post_comment(response, True)
+    problem = ou_policy_problem(
+        linaro_shared.find_best_ou_for_email(email_address),
+        linaro_shared.find_best_ou_for_email(shared.globals.REPORTER))
+    if problem is not None:
+        shared_sd.post_comment(problem, True)
         shared_sd.resolve_ticket(WONT_DO)
         return False
 
-    org_unit = shared_ldap.find_best_ou_for_email(email_address)
-    if org_unit == "ou=staff,ou=accounts,dc=linaro,dc=org":
-        shared_sd.post_comment(
+    return True
+
+def ou_policy_problem(org_unit, reporter_ou):
+    """
+    Check the OU for the new entry against the reporter's OU. Returns the
+    reason the entry cannot be created or None if it is OK.
+    """
+    if org_unit == STAFF_OU:
+        return (
             "Cannot fulfil this request because the email address is "
-            "reserved for Linaro staff.",
-            True)
-        shared_sd.resolve_ticket(WONT_DO)
-        return False
+            "reserved for Linaro staff.")
 
     # Who is asking for this account? If staff, they can create any account.
     # If not, the OU must match.
-    reporter_ou = shared_ldap.find_best_ou_for_email(shared.globals.REPORTER)
-    if reporter_ou != "ou=staff,ou=accounts,dc=linaro,dc=org":
-        if org_unit == "ou=the-rest,ou=accounts,dc=linaro,dc=org":
-            shared_sd.post_comment(
-                "Only Linaro staff and Linaro Members can create additional accounts.",
-                True)
-            shared_sd.resolve_ticket(WONT_DO)
-            return False
+    if reporter_ou != STAFF_OU:
+        if org_unit == THE_REST_OU:
+            return "Only Linaro staff and Linaro Members can create additional accounts."
         if reporter_ou != org_unit:
-            shared_sd.post_comment(
+            return (
                 "Cannot fulfil this request because you can "
-                "only create accounts/contacts for your own organisation.",
-                True)
-            shared_sd.resolve_ticket(WONT_DO)
-            return False
+                "only create accounts/contacts for your own organisation.")
+    return None
 
-    return True
+def create_bulk(ticket_data, attachment):
+    """ Create an account or contact for each row of a CSV attachment. """
+    content = linaro_shared.read_attachment(attachment)
+    rows = None
+    if content is not None:
+        rows = parse_bulk_rows(content)
+    if not rows:
+        shared_sd.post_comment(
+            f"It has not been possible to read any accounts from {attachment['filename']}. "
+            "The file must have a heading row with the columns 'Email Address', "
+            "'First Name' and 'Family Name'.",
+            True)
+        shared_sd.resolve_ticket("Declined")
+        return
 
-def send_new_account_email(first_name, surname, email_address, account_dn):
-    """ Send the new account email. """
-    uid = shared_ldap.extract_id_from_dn(account_dn)
-    # Read in the template email.
+    shared_sd.set_summary(
+        f"Create {len(rows)} external users/accounts from {attachment['filename']}")
+
+    cf_account_type = custom_fields.get("External Account / Contact")
+    account_type = shared_sd.get_field(ticket_data, cf_account_type)["value"]
+
+    check_bulk_policy([row for row in rows if row["result"] is None])
+    to_create = [row for row in rows if row["result"] is None]
+    create_bulk_accounts(to_create, account_type)
+
+    created = [row for row in to_create if row["dn"] is not None]
+    if account_type != "Contact" and created != []:
+        templates = read_email_templates()
+        for row in created:
+            send_new_account_email(
+                row["first_name"],
+                row["surname"],
+                row["email"],
+                row["dn"],
+                templates
+            )
+
+    shared_sd.post_comment(
+        f"{len(created)} of {len(rows)} entries created:\r\n" +
+        linaro_shared.results_table(
+            ["Email address", "First name", "Family name", "Result"],
+            [
+                [row["email"], row["first_name"], row["surname"], row["result"]]
+                for row in rows
+            ]),
+        True)
+
+    if any(row["dn"] is None for row in to_create):
+        # Policy failures are for the customer to sort out but a failure to
+        # create an entry needs IT Services to investigate.
+        shared_sd.transition_request_to("Waiting for support")
+        shared_sd.assign_issue_to(None)
+    else:
+        shared_sd.resolve_ticket()
+
+def parse_bulk_rows(content):
+    """
+    Turn the CSV content into a list of rows to be processed. Rows that
+    can't be processed have their result set to the reason why.
+    """
+    reader = csv.reader(io.StringIO(content))
+    headings = next(reader, None)
+    if headings is None:
+        return None
+    columns = {}
+    for index, heading in enumerate(headings):
+        key = BULK_COLUMNS.get(re.sub(r"[^a-z]", "", heading.lower()))
+        if key is not None and key not in columns:
+            columns[key] = index
+    if "email" not in columns or "surname" not in columns:
+        return None
+
+    rows = []
+    seen = set()
+    for line in reader:
+        fields = {
+            key: line[index].strip() if index < len(line) else ""
+            for key, index in columns.items()
+        }
+        if not any(fields.values()):
+            # Skip blank lines
+            continue
+        email_address = linaro_shared.cleanup_if_markdown(fields["email"]).lower()
+        if email_address != "":
+            email_address = shared_ldap.cleanup_if_gmail(email_address)
+        row = {
+            "email": email_address,
+            "first_name": fields.get("first_name", ""),
+            "surname": fields["surname"],
+            "dn": None,
+            "result": None
+        }
+        if email_address == "" or row["surname"] == "":
+            row["result"] = "An email address and a family name must be provided."
+        elif email_address in seen:
+            row["result"] = "This email address appears more than once in the file."
+        seen.add(email_address)
+        rows.append(row)
+    return rows
+
+def check_bulk_policy(rows):
+    """ Apply the company policy rules to all of the rows at once. """
+    conflicts = find_conflicts([row["email"] for row in rows])
+    reporter_ou = linaro_shared.find_best_ou_for_email(shared.globals.REPORTER)
+    for row in rows:
+        if row["email"] in conflicts:
+            row["result"] = f"Cannot fulfil this request because {conflicts[row['email']]}"
+        else:
+            row["result"] = ou_policy_problem(
+                linaro_shared.find_best_ou_for_email(row["email"]), reporter_ou)
+
+def find_conflicts(email_addresses):
+    """
+    Check the email addresses against the mail, cn and backup email
+    attributes of existing LDAP entries with a single OR filter (batched for
+    large lists). Returns a dict mapping each address that cannot be used to
+    the reason why.
+    """
+    wanted = set(email_addresses)
+    clauses = [
+        (attribute, email_address)
+        for email_address in sorted(wanted)
+        for attribute in ("mail", "cn", "passwordSelfResetBackupMail")
+    ]
+    in_use = {}
+    backup = {}
+    for entry in linaro_shared.find_matching_any(
+            clauses, ["mail", "cn", "passwordSelfResetBackupMail"]):
+        mail = directory_search.entry_values(entry, "mail")
+        for value in mail + directory_search.entry_values(entry, "cn"):
+            if value.lower() in wanted:
+                in_use.setdefault(value.lower(), entry.entry_dn)
+        for value in directory_search.entry_values(entry, "passwordSelfResetBackupMail"):
+            if value.lower() in wanted:
+                # No email address so provide the DN instead
+                backup.setdefault(value.lower(), mail[0] if mail != [] else entry.entry_dn)
+
+    conflicts = {}
+    for email_address in wanted:
+        if email_address in in_use:
+            conflicts[email_address] = (
+                f"the email address is already being used by {in_use[email_address]}")
+        elif email_address in backup:
+            conflicts[email_address] = (
+                "there is a Linaro account associated with the email address "
+                f"({backup[email_address]})")
+    return conflicts
+
+def create_bulk_accounts(rows, account_type):
+    """ Create the LDAP entries for the rows using a bounded pool of workers. """
+    # Rows that calculate the same UID would race for it if they were
+    # created at the same time, so they share a worker and are created one
+    # after the other. Different names can reduce to the same UID, so the
+    # rows are grouped by the UID rather than by the name.
+    by_uid = {}
+    with ThreadPoolExecutor(max_workers=BULK_WORKERS) as pool:
+        for row, uid in zip(rows, pool.map(bulk_row_uid, rows)):
+            if uid is not None:
+                by_uid.setdefault(uid, []).append(row)
+        for future in [
+                pool.submit(create_bulk_group_of_rows, group, account_type)
+                for group in by_uid.values()]:
+            future.result()
+
+def bulk_row_uid(row):
+    """
+    Return the UID that creating the row's entry would use, or None (having
+    set the row's result) if there isn't one.
+    """
+    try:
+        uid = shared_ldap.calculate_uid(row["first_name"] or None, row["surname"])
+    except Exception as exc:  # pylint: disable=broad-except
+        row["result"] = f"Failed to create the entry: {exc}"
+        return None
+    if uid is None:
+        row["result"] = f"Cannot calculate a UID for '{row['first_name']}' '{row['surname']}'."
+    return uid
+
+def create_bulk_group_of_rows(rows, account_type):
+    """ Sequentially create the entries for a list of rows. """
+    for row in rows:
+        try:
+            create_bulk_account(row, account_type)
+        except Exception as exc:  # pylint: disable=broad-except
+            row["result"] = f"Failed to create the entry: {exc}"
+
+def create_bulk_account(row, account_type):
+    """ Create the LDAP entry for a single row. """
+    first_name = row["first_name"]
+    if first_name == "":
+        first_name = None
+    md5_password = None
+    if account_type != "Contact":
+        _, md5_password = linaro_shared.make_password()
+    row["dn"] = shared_ldap.create_account(
+        first_name,
+        row["surname"],
+        row["email"],
+        md5_password
+    )
+    directory_replica.refresh(row["dn"])
+    if row["dn"] is None:
+        row["result"] = "Something went wrong while creating the entry."
+    else:
+        row["result"] = f"{account_type} created at {row['dn']}"
+
+def read_email_templates():
+    """ Read in the template emails, returning the text and HTML versions. """
     file_dir = os.path.dirname(os.path.abspath(__file__))
     with open(f"{file_dir}/create_external_user_email.txt", "r", encoding="utf-8") as email_file:
         text_body = email_file.read()
     with open(f"{file_dir}/create_external_user_email.html", "r", encoding="utf-8") as email_file:
         html_body = email_file.read()
+    return text_body, html_body
+
+def send_new_account_email(first_name, surname, email_address, account_dn, templates=None):
+    """ Send the new account email. """
+    uid = shared_ldap.extract_id_from_dn(account_dn)
+    # Read in the template email unless the caller already has.
+    if templates is None:
+        templates = read_email_templates()
+    text_body, html_body = templates
     # Substitute the parameters
     name = first_name
-    if name == "":
+    if name in (None, ""):
         name = surname
     text_body = text_body.format(
         name,
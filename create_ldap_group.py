@@ -1,48 +1,94 @@
 """ Handler to create a new LDAP group. """
 
+import csv
+import io
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import shared.custom_fields as custom_fields
 import shared.globals
-import shared.shared_google as shared_google
 import shared.shared_ldap as shared_ldap
 import shared.shared_sd as shared_sd
 
+import directory_replica
+import directory_search
+import google_alias_index
+import instrumentation
 import linaro_shared
+import membership_sketch
+import profiler
+import step_journal
+import work_queue
 
 CAPABILITIES = [
     "COMMENT",
     "CREATE"
 ]
 
+# How long, in seconds, the pre-flight checks are allowed to take.
+PREFLIGHT_DEADLINE = 30
+# How many groups are created at the same time in bulk mode.
+BULK_WORKERS = 4
+# Column headings accepted in a bulk CSV, with case, spaces and punctuation
+# ignored.
+BULK_COLUMNS = {
+    "name": "name",
+    "grouplistname": "name",
+    "description": "description",
+    "grouplistdescription": "description",
+    "email": "email",
+    "emailaddress": "email",
+    "groupemailaddress": "email",
+    "owners": "owners",
+    "groupowners": "owners",
+}
+ITS_GROUP = "cn=its,ou=mailing,ou=groups,dc=linaro,dc=org"
 
+
+@work_queue.queued
+@instrumentation.instrumented
 def comment(ticket_data):
     """ Comment handler. """
     last_comment, keyword = shared_sd.central_comment_handler(
         [],
-        ["help", "retry"]
+        ["help", "retry", "profile"]
     )
     if keyword == "help":
         shared_sd.post_comment(
             "All bot commands must be internal comments and the first "
             "word/phrase in the comment.\r\n\r\n"
             "Valid commands are:\r\n"
-            "* retry to ask the bot to process the request again after issues have been resolved.",
+            "* retry to ask the bot to process the request again after issues have been resolved.\r\n"
+            "* profile to run the request again without making any changes and attach a "
+            "performance profile.",
             False)
     elif keyword == "retry":
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
     elif last_comment is not None and last_comment['public']:
         shared_sd.deassign_ticket_if_appropriate(comment)
 
 
+@work_queue.queued
+@instrumentation.instrumented
 def create(ticket_data):
     """ Create handler. """
-    if not shared_ldap.is_user_in_group("employees", shared.globals.REPORTER):
-        shared_sd.post_comment(
-            "Sorry but only Linaro employees can use this Service Request.",
-            True)
-        shared_sd.resolve_ticket("Declined")
+    # A CSV attachment switches the handler into bulk mode, creating a group
+    # for each row instead of using the form fields.
+    attachment = linaro_shared.get_csv_attachment(ticket_data)
+    if attachment is not None:
+        create_bulk(attachment)
+        return
+
+    # If this is a retry after the group was created, the pre-flight checks
+    # would now fail because the group exists, so just do the steps that
+    # remain.
+    journal = step_journal.journal(ticket_data)
+    if journal.done("create_group"):
+        group_name, group_email_address, group_domain = journal.result("create_group")
+        finish_group_creation(journal, group_name, group_email_address, group_domain)
         return
 
     cf_group_name = custom_fields.get("Group / List Name")
@@ -52,6 +98,44 @@ def create(ticket_data):
 
     group_display_name = shared_sd.get_field(
         ticket_data, cf_group_name)
+    group_description = shared_sd.get_field(ticket_data, cf_group_description)
+    owners = []
+    group_owners = shared_sd.get_field(ticket_data, cf_group_owners)
+    if group_owners is not None:
+        owners = [owner for owner in group_owners.split("\r\n") if owner != ""]
+
+    # None of the pre-flight checks depend on each other so they are run at
+    # the same time rather than one after the other.
+    checks = {
+        "employee": (membership_sketch.is_user_in_group, ("employees", shared.globals.REPORTER))
+    }
+    if group_display_name is not None and group_description is not None:
+        group_display_name = group_display_name.strip()
+        group_name, group_email_address, group_domain = group_addressing(
+            group_display_name,
+            shared_sd.get_field(ticket_data, cf_group_email_address))
+        checks["email"] = (shared_ldap.find_from_email, (group_email_address,))
+        checks["name"] = (shared_ldap.find_from_attribute, ("cn", group_name))
+        checks["alias"] = (google_alias_index.check_group_alias, (group_email_address,))
+        checks["owners"] = (find_owner_dns, (owners,))
+    results = linaro_shared.run_concurrently(checks, PREFLIGHT_DEADLINE)
+    if results is None:
+        shared_sd.post_comment(
+            "Sorry but something went wrong while checking the request. "
+            "IT Services will investigate further.", True)
+        shared_sd.post_comment(
+            f"Pre-flight checks did not complete within {PREFLIGHT_DEADLINE} seconds.",
+            False)
+        shared_sd.transition_request_to("Waiting for Support")
+        return
+
+    if not results["employee"]:
+        shared_sd.post_comment(
+            "Sorry but only Linaro employees can use this Service Request.",
+            True)
+        shared_sd.resolve_ticket("Declined")
+        return
+
     if group_display_name is None:
         shared_sd.post_comment(
             "Sorry but a display name must be provided.",
@@ -60,7 +144,6 @@ def create(ticket_data):
         shared_sd.resolve_ticket("Declined")
         return
 
-    group_description = shared_sd.get_field(ticket_data, cf_group_description)
     if group_description is None:
         shared_sd.post_comment(
             "Sorry but a group description must be provided.",
@@ -69,29 +152,9 @@ def create(ticket_data):
         shared_sd.resolve_ticket("Declined")
         return
 
-    group_display_name = group_display_name.strip()
-    group_lower_name = group_display_name.lower()
-    # Take the group name, make it lower case, replace spaces with hyphens and
-    # remove any other potentially troublesome characters.
-    group_name = re.sub(r"\s+", '-', group_lower_name)
-    group_name = re.sub(r"[^\w\s-]", '', group_name)
-    group_email_address = shared_sd.get_field(
-        ticket_data, cf_group_email_address)
-    if group_email_address is None:
-        group_email_address = group_name + "@linaro.org"
-        group_domain = "linaro.org"
-    else:
-        group_email_address = group_email_address.strip().lower()
-        # Check we have a domain
-        if "@" not in group_email_address:
-            group_email_address += "@linaro.org"
-            group_domain = "linaro.org"
-        else:
-            group_domain = group_email_address.split('@')[1]
-
     shared_sd.set_summary(f"Create LDAP group for {group_email_address}")
 
-    result = shared_ldap.find_from_email(group_email_address)
+    result = results["email"]
     if result is not None:
         reply = (
             f"Cannot create this group because the email address ('{group_email_address}') is "
@@ -100,7 +163,7 @@ def create(ticket_data):
         shared_sd.resolve_ticket("Won't Do")
         return
 
-    result = shared_ldap.find_from_attribute("cn", group_name)
+    result = results["name"]
     if result is not None:
         reply = (
             f"Cannot create this group because the name ('{group_name}') is already "
@@ -109,7 +172,7 @@ def create(ticket_data):
         shared_sd.resolve_ticket("Won't Do")
         return
 
-    google = shared_google.check_group_alias(group_email_address)
+    google = results["alias"]
     if google is not None:
         shared_sd.post_comment(
             "Cannot create this group because the email address is an alias "
@@ -127,10 +190,7 @@ def create(ticket_data):
         shared_sd.resolve_ticket("Won't Do")
         return
 
-    owner_list = []
-    group_owners = shared_sd.get_field(ticket_data, cf_group_owners)
-    if group_owners is not None:
-        owner_list = process_group_owners(group_owners)
+    owner_list = process_group_owners(owners, results["owners"])
     if not owner_list:
         owner_list = handle_empty_owners()
 
@@ -148,8 +208,18 @@ def create(ticket_data):
         shared_sd.post_comment(json.dumps(result), False)
         shared_sd.transition_request_to("Waiting for Support")
         return
+    journal.record("create_group", [group_name, group_email_address, group_domain])
+    finish_group_creation(journal, group_name, group_email_address, group_domain)
 
-    linaro_shared.trigger_google_sync()
+
+def finish_group_creation(journal, group_name, group_email_address, group_domain):
+    """ Sync the new group to Google and tell the reporter about it. """
+    directory_replica.refresh_group(group_name)
+    if journal.run("sync", linaro_shared.trigger_google_sync) is False:
+        # The journal is kept so that "retry" triggers the sync again.
+        shared_sd.transition_request_to("Waiting for support")
+        shared_sd.assign_issue_to(None)
+        return
 
     # If the user has specified a custom email address, the URL for the group
     # uses *that* instead of the group's name. So, basically, always use the
@@ -171,30 +241,269 @@ def create(ticket_data):
             group_name
         ), True)
 
+    journal.finish()
     shared_sd.resolve_ticket()
 
 
-def process_group_owners(data):
+def create_bulk(attachment):
+    """ Create a group for each row of a CSV attachment. """
+    if not membership_sketch.is_user_in_group("employees", shared.globals.REPORTER):
+        shared_sd.post_comment(
+            "Sorry but only Linaro employees can use this Service Request.",
+            True)
+        shared_sd.resolve_ticket("Declined")
+        return
+
+    content = linaro_shared.read_attachment(attachment)
+    rows = None
+    if content is not None:
+        rows = parse_bulk_rows(content)
+    if not rows:
+        shared_sd.post_comment(
+            f"It has not been possible to read any groups from {attachment['filename']}. "
+            "The file must have a heading row with 'Name' and 'Description' columns "
+            "and, optionally, 'Email Address' and 'Owners' columns.",
+            True)
+        shared_sd.resolve_ticket("Declined")
+        return
+
+    shared_sd.set_summary(f"Create {len(rows)} LDAP groups from {attachment['filename']}")
+
+    check_bulk_rows([row for row in rows if row["result"] is None])
+    to_create = [row for row in rows if row["result"] is None]
+    with ThreadPoolExecutor(max_workers=BULK_WORKERS) as pool:
+        for future in [pool.submit(create_bulk_group, row) for row in to_create]:
+            future.result()
+
+    created = [row for row in to_create if row["created"]]
+    # One sync covers all of the new groups.
+    if created != []:
+        linaro_shared.trigger_google_sync()
+
+    shared_sd.post_comment(
+        f"{len(created)} of {len(rows)} groups created:\r\n" +
+        linaro_shared.results_table(
+            ["Name", "Email address", "Owners", "Result"],
+            [
+                [row["display_name"], row["email"], ", ".join(row["owner_names"]), row["result"]]
+                for row in rows
+            ]) +
+        "\r\nIMPORTANT! Do not change group membership via Google."
+        " It MUST be done via the [Add/Remove Users from Group|"
+        "https://linaro-servicedesk.atlassian.net/servicedesk/customer/portal/32/group/116/create/551]"
+        " request otherwise changes will be lost.",
+        True)
+
+    if any(not row["created"] for row in to_create):
+        shared_sd.transition_request_to("Waiting for Support")
+    else:
+        shared_sd.resolve_ticket()
+
+
+def parse_bulk_rows(content):
+    """
+    Turn the CSV content into a list of groups to be created. Rows that
+    can't be processed have their result set to the reason why.
+    """
+    reader = csv.reader(io.StringIO(content))
+    headings = next(reader, None)
+    if headings is None:
+        return None
+    columns = {}
+    for index, heading in enumerate(headings):
+        key = BULK_COLUMNS.get(re.sub(r"[^a-z]", "", heading.lower()))
+        if key is not None and key not in columns:
+            columns[key] = index
+    if "name" not in columns or "description" not in columns:
+        return None
+
+    rows = []
+    for line in reader:
+        fields = {
+            key: line[index].strip() if index < len(line) else ""
+            for key, index in columns.items()
+        }
+        if not any(fields.values()):
+            # Skip blank lines
+            continue
+        row = {
+            "display_name": fields["name"],
+            "description": fields["description"],
+            "name": None,
+            "email": fields.get("email", ""),
+            "domain": None,
+            "owners": [
+                owner for owner in re.split(r"[\s,;]+", fields.get("owners", ""))
+                if owner != ""
+            ],
+            "owner_names": [],
+            "owner_dns": [],
+            "created": False,
+            "result": None
+        }
+        if row["display_name"] == "" or row["description"] == "":
+            row["result"] = "A name and a description must be provided."
+        elif "=" in row["display_name"] or "=" in row["description"]:
+            row["result"] = (
+                "Due to a Google limitation, the name and description cannot "
+                "use the equal sign.")
+        else:
+            row["name"], row["email"], row["domain"] = group_addressing(
+                row["display_name"], row["email"] if row["email"] != "" else None)
+        rows.append(row)
+    return rows
+
+
+def check_bulk_rows(rows):
+    """
+    Check that the names and email addresses are unique, using batched
+    searches for all of the rows at once, and resolve the owners.
+    """
+    # Names and addresses must also be unique within the file.
+    seen = set()
+    for row in rows:
+        if row["name"] in seen or row["email"] in seen:
+            row["result"] = "The name or email address appears more than once in the file."
+        seen.update((row["name"], row["email"]))
+
+    in_use = {}
+    for entry in linaro_shared.find_matching_any(
+            [("mail", row["email"]) for row in rows] + [("cn", row["name"]) for row in rows],
+            ["mail", "cn"]):
+        for value in directory_search.entry_values(entry, "mail") + \
+                directory_search.entry_values(entry, "cn"):
+            in_use.setdefault(value.lower(), entry.entry_dn)
+
+    aliases = linaro_shared.run_concurrently(
+        {
+            row["email"]: (google_alias_index.check_group_alias, (row["email"],))
+            for row in rows
+        },
+        PREFLIGHT_DEADLINE)
+    owner_dns = find_owner_dns(
+        [owner for row in rows for owner in row["owners"]] + [shared.globals.REPORTER])
+
+    for row in rows:
+        if row["result"] is not None:
+            continue
+        if row["email"] in in_use:
+            row["result"] = (
+                "The email address is already being used by the LDAP object "
+                f"{in_use[row['email']]}")
+        elif row["name"] in in_use:
+            row["result"] = (
+                f"The name ('{row['name']}') is already being used by the LDAP object "
+                f"{in_use[row['name']]}")
+        elif aliases is None:
+            row["result"] = "Unable to check whether the email address is a Google alias."
+        elif aliases[row["email"]] is not None:
+            row["result"] = (
+                f"The email address is an alias for the group {aliases[row['email']]}")
+        else:
+            resolve_bulk_owners(row, owner_dns)
+
+
+def resolve_bulk_owners(row, owner_dns):
+    """ Work out the owner DNs for a row, falling back as for a single group. """
+    for owner in row["owners"]:
+        result = owner_dns.get(owner.lower())
+        if result is None:
+            row["owner_names"].append(f"{owner} (not found)")
+        elif ",ou=security," not in result:
+            row["owner_names"].append(owner)
+            row["owner_dns"].append(result)
+    if row["owner_dns"] == []:
+        reporter = owner_dns.get(shared.globals.REPORTER.lower())
+        if reporter is not None:
+            row["owner_names"].append(shared.globals.REPORTER)
+            row["owner_dns"].append(reporter)
+        else:
+            row["owner_names"].append("its")
+            row["owner_dns"].append(ITS_GROUP)
+
+
+def create_bulk_group(row):
+    """ Create the mailing and security groups for a single row. """
+    try:
+        result = shared_ldap.create_group(
+            row["name"],
+            row["description"],
+            row["display_name"],
+            row["email"],
+            row["owner_dns"]
+        )
+    except Exception as exc:  # pylint: disable=broad-except
+        result = str(exc)
+    if result is None:
+        directory_replica.refresh_group(row["name"])
+        row["created"] = True
+        row["result"] = (
+            f"Created. Posting settings: https://groups.google.com/a/{row['domain']}/g/"
+            f"{row['email'].split('@')[0]}/settings#posting")
+    else:
+        row["result"] = f"Something went wrong while creating the group: {json.dumps(result)}"
+
+
+def group_addressing(group_display_name, group_email_address):
+    """
+    Work out the group's name, email address and domain from the display
+    name and the (optional) email address provided on the form.
+    """
+    group_lower_name = group_display_name.lower()
+    # Take the group name, make it lower case, replace spaces with hyphens and
+    # remove any other potentially troublesome characters.
+    group_name = re.sub(r"\s+", '-', group_lower_name)
+    group_name = re.sub(r"[^\w\s-]", '', group_name)
+    if group_email_address is None:
+        group_email_address = group_name + "@linaro.org"
+        group_domain = "linaro.org"
+    else:
+        group_email_address = group_email_address.strip().lower()
+        # Check we have a domain
+        if "@" not in group_email_address:
+            group_email_address += "@linaro.org"
+            group_domain = "linaro.org"
+        else:
+            group_domain = group_email_address.split('@')[1]
+    return group_name, group_email_address, group_domain
+
+
+def find_owner_dns(owners):
+    """
+    Look up all of the requested owners in one search, returning a dict
+    mapping the lower case email address onto the DN.
+    """
+    owner_dns = {}
+    if owners == []:
+        return owner_dns
+    matches = linaro_shared.find_matching_any(
+        [("mail", owner.strip().lower()) for owner in owners],
+        ["mail"])
+    for entry in matches:
+        for mail in directory_search.entry_values(entry, "mail"):
+            owner_dns.setdefault(mail.lower(), entry.entry_dn)
+    return owner_dns
+
+
+def process_group_owners(owners, owner_dns):
     """
     We ask for owners as email addresses but LDAP needs the DN for the
     appropriate object
     """
     owner_list = []
-    owners = data.split("\r\n")
     for owner in owners:
-        if owner != "":
-            result = shared_ldap.find_from_email(owner)
-            if result is None:
+        result = owner_dns.get(owner.strip().lower())
+        if result is None:
+            shared_sd.post_comment(
+                f"Unable to add {owner} as an owner as the email address "
+                "cannot be found in Linaro Login.", True)
+        else:
+            # Need to make sure we append the mailing group if it
+            # is a group!
+            if ",ou=security," not in result:
+                owner_list.append(result)
                 shared_sd.post_comment(
-                    f"Unable to add {owner} as an owner as the email address "
-                    "cannot be found in Linaro Login.", True)
-            else:
-                # Need to make sure we append the mailing group if it
-                # is a group!
-                if ",ou=security," not in result:
-                    owner_list.append(result)
-                    shared_sd.post_comment(
-                        f"Adding {owner} as an owner.", True)
+                    f"Adding {owner} as an owner.", True)
     return owner_list
 
 
@@ -218,4 +527,4 @@ def handle_empty_owners():
         "been able to find any of the specified email addresses in "
         "Linaro Login. Consequently, IT Services will need to manage "
         "it in the interim.", True)
-    return ["cn=its,ou=mailing,ou=groups,dc=linaro,dc=org"]
+    return [ITS_GROUP]
@@ -1,9 +1,19 @@
 """This code handles the delete LDAP group request type."""
 
+import time
+
 import shared.globals
+from ldap3.utils.conv import escape_filter_chars
 from shared import custom_fields, shared_ldap, shared_sd
 
+import directory_replica
+import dn_util
+import group_expansion
+import instrumentation
 import linaro_shared
+import membership_sketch
+import profiler
+import work_queue
 
 CAPABILITIES = [
     "CREATE",
@@ -11,9 +21,11 @@ CAPABILITIES = [
     "TRANSITION"
 ]
 
+@work_queue.queued
+@instrumentation.instrumented
 def comment(ticket_data):
     """Triggered when a comment is posted."""
-    last_comment, keyword = shared_sd.central_comment_handler([], ["help", "retry"])
+    last_comment, keyword = shared_sd.central_comment_handler([], ["help", "retry", "profile"])
 
     if last_comment is None or keyword == "help":
         shared_sd.post_comment(
@@ -21,10 +33,14 @@ def comment(ticket_data):
              "word/phrase in the comment.\r\n\r\n"
              "Valid commands are:\r\n"
              "* retry to ask the bot to process the request again after "
-             "issues have been resolved."), False)
+             "issues have been resolved.\r\n"
+             "* profile to run the request again without making any "
+             "changes and attach a performance profile."), False)
     elif keyword == "retry":
         shared_sd.transition_request_to("Open")
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
     elif linaro_shared.ok_to_process_public_comment(last_comment):
         shared_sd.deassign_ticket_if_appropriate(last_comment)
 
@@ -33,8 +49,13 @@ IT_BOT = (
     'uid=it.support.bot,ou=mail-contacts-unsynced,'
     'ou=accounts,dc=linaro,dc=org'
 )
+GROUPS_BASE = "ou=groups,dc=linaro,dc=org"
+# How long, in seconds, each phase of the deletion is allowed to take.
+PHASE_DEADLINE = 60
 
 
+@work_queue.queued
+@instrumentation.instrumented
 def create(ticket_data):
     """Triggered when the issue is created."""
     # Check that the email address provided (a) exists in LDAP and (b) is a
@@ -45,7 +66,7 @@ def create(ticket_data):
         group_email_address = group_email_address["value"]
     if group_email_address is not None:
         group_email_address = group_email_address.strip().lower()
-    group_email_address, result = shared_ldap.find_group(
+    group_email_address, result = directory_replica.find_group(
         group_email_address, ['owner', 'uniqueMember'])
 
     shared_sd.set_summary(f"Delete LDAP group for {group_email_address}")
@@ -71,7 +92,7 @@ def create(ticket_data):
 
     # Need to check owners by unpacking the list as groups can be owners but
     # groups can be empty.
-    owners = shared_ldap.flatten_list(result[0].owner.values)
+    owners = group_expansion.flatten(result[0].owner.values)
     if owners is None or owners == []:
         got_owners = False
     else:
@@ -89,13 +110,13 @@ def create(ticket_data):
                 "cn=its,ou=mailing,ou=groups,dc=linaro,dc=org")
             shared_sd.assign_approvers(it_members, cf_approvers)
             shared_sd.transition_request_to("Needs approval")
-    elif shared_ldap.reporter_is_group_owner(result[0].owner.values):
+    elif group_expansion.reporter_is_owner(result[0].owner.values):
         shared_sd.transition_request_to("In progress")
     elif IT_BOT in result[0].owner.values and \
             shared_ldap.is_user_in_group("its", shared.globals.REPORTER):
         shared_sd.transition_request_to("In progress")
     else:
-        if not shared_ldap.is_user_in_group("employees", shared.globals.REPORTER):
+        if not membership_sketch.is_user_in_group("employees", shared.globals.REPORTER):
             shared_sd.post_comment(
                 "Sorry but only Linaro employees can use this Service "
                 "Request.", True)
@@ -109,6 +130,8 @@ def create(ticket_data):
         shared_sd.transition_request_to("Needs approval")
 
 
+@work_queue.queued
+@instrumentation.instrumented
 def transition(status_to, ticket_data):
     """ Handle ticket transition """
     # If the status is "In Progress", trigger the membership change. This
@@ -120,42 +143,13 @@ def transition(status_to, ticket_data):
             group_email_address = group_email_address["value"]
         if group_email_address is not None:
             group_email_address = group_email_address.strip().lower()
-        group_dn = shared_ldap.find_single_object_from_email(group_email_address)
+        group_dn = directory_replica.find_single_object_from_email(group_email_address)
         delete_group(group_dn)
 
 
 def delete_group(entry_dn):
     """ Delete both mail and security groups referenced by the mail group's dn """
-    response = ""
-
-    # Is the group a member of any other groups?
-    other_groups = shared_ldap.find_matching_objects(
-        f"(uniqueMember={entry_dn})",
-        ["cn"],
-        base="ou=mailing,ou=groups,dc=linaro,dc=org"
-    )
-    if other_groups is not None and len(other_groups) != 0:
-        for group in other_groups:
-            cn_value = group.cn.value
-            response += f"Removing group as a member of {cn_value}\r\n"
-            shared_ldap.remove_from_mailing_group(cn_value, entry_dn)
-
-    # Is the group an owner of any other groups?
-    owned_groups = shared_ldap.find_matching_objects(
-        f"(owner={entry_dn})",
-        ["cn"],
-        base="ou=security,ou=groups,dc=linaro,dc=org"
-    )
-    if owned_groups is not None and len(owned_groups) != 0:
-        for group in owned_groups:
-            cn_value = group.cn.value
-            response += f"Removing group as an owner of {cn_value}\r\n"
-            shared_ldap.remove_owner_from_security_group(cn_value, entry_dn)
-
-    count = delete_single_group(entry_dn)
-    # Replace mailing with security.
-    entry_dn = entry_dn.replace("ou=mailing", "ou=security")
-    count += delete_single_group(entry_dn)
+    count, response, timings = remove_group(entry_dn)
 
     if count != 0:
         linaro_shared.trigger_google_sync()
@@ -174,15 +168,92 @@ def delete_group(entry_dn):
         )
 
     shared_sd.post_comment(response, True)
+    shared_sd.post_comment(
+        "Timings: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings),
+        False)
     shared_sd.resolve_ticket()
 
 
+def remove_group(entry_dn):
+    """
+    Detach the group from any groups that refer to it and then delete the
+    mailing and security groups. Returns the number of groups deleted, the
+    text describing what was done and how long each phase took. Google is
+    not synced so that the caller can delete several groups first.
+    """
+    response = ""
+    timings = []
+
+    started = time.perf_counter()
+    references = find_references(entry_dn)
+    timings.append(("discovery", time.perf_counter() - started))
+
+    # The references are all independent so they are removed in parallel.
+    calls = {}
+    for cn_value in references["member"]:
+        response += f"Removing group as a member of {cn_value}\r\n"
+        calls[("member", cn_value)] = (
+            shared_ldap.remove_from_mailing_group, (cn_value, entry_dn))
+    for cn_value in references["owner"]:
+        response += f"Removing group as an owner of {cn_value}\r\n"
+        calls[("owner", cn_value)] = (
+            shared_ldap.remove_owner_from_security_group, (cn_value, entry_dn))
+    started = time.perf_counter()
+    if calls != {} and linaro_shared.run_concurrently(calls, PHASE_DEADLINE) is None:
+        # Don't delete the group while other groups may still refer to it.
+        response += "Removing the references to the group took too long.\r\n"
+        timings.append(("detach", time.perf_counter() - started))
+        return 0, response, timings
+    timings.append(("detach", time.perf_counter() - started))
+    for cn_value in references["member"] + references["owner"]:
+        directory_replica.refresh_group(cn_value)
+
+    # The security group has the same name as the mailing group.
+    security_dn = str(dn_util.parse(entry_dn).moved_to(f"ou=security,{GROUPS_BASE}"))
+    started = time.perf_counter()
+    deleted = linaro_shared.run_concurrently(
+        {
+            "mailing": (delete_single_group, (entry_dn,)),
+            "security": (delete_single_group, (security_dn,))
+        },
+        PHASE_DEADLINE)
+    timings.append(("delete", time.perf_counter() - started))
+    if deleted is None:
+        response += "Deleting the groups took too long.\r\n"
+        return 0, response, timings
+    return deleted["mailing"] + deleted["security"], response, timings
+
+
+def find_references(entry_dn):
+    """
+    Find, in one search, the mailing groups that have this group as a member
+    and the security groups that have it as an owner. Returns the CNs of
+    those groups in a dict keyed on "member" and "owner".
+    """
+    escaped_dn = escape_filter_chars(entry_dn)
+    found = shared_ldap.find_matching_objects(
+        f"(|(&(ou:dn:=mailing)(uniqueMember={escaped_dn}))"
+        f"(&(ou:dn:=security)(owner={escaped_dn})))",
+        ["cn"],
+        base=GROUPS_BASE
+    )
+    references = {"member": [], "owner": []}
+    if found is not None:
+        for group in found:
+            if ",ou=mailing," in group.entry_dn:
+                references["member"].append(group.cn.value)
+            else:
+                references["owner"].append(group.cn.value)
+    return references
+
+
 def delete_single_group(entry_dn):
     """ Delete a single group """
     # Delete either the mailing or security group, as per the dn, and return an
     # integer so that we can easily count how many groups were deleted.
     try:
         shared_ldap.delete_object(entry_dn)
+        directory_replica.forget(entry_dn)
         return 1
     except Exception as exc:
         shared_sd.post_comment(
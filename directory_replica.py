@@ -0,0 +1,379 @@
+"""
+A local SQLite mirror of the accounts and groups in Linaro Login.
+
+Most of what the handlers read from LDAP (managers, titles, email address
+to DN lookups) changes rarely but is read on every webhook. This module
+keeps a copy of those attributes in SQLite, indexed on the lookup
+attributes, and offers read-through versions of the shared_ldap functions
+that the handlers use:
+
+* if the replica is disabled, older than MAX_AGE seconds or doesn't hold an
+  answer, the call falls through to LDAP;
+* writes still go to LDAP and the handlers then call refresh() for the DNs
+  they have changed so that the replica is updated straight away.
+
+Group membership and ownership decide what people are allowed to do, so
+reads that ask for AUTHORIZATION_ATTRIBUTES always go to LDAP: a
+membership that has just been revoked must not keep its privileges until
+the next sync. Those attributes are still replicated for the membership
+filters built by membership_sketch, which can only ever rule people out.
+
+The replica is kept in sync by running this file on a schedule:
+
+    python directory_replica.py sync
+
+Normally only the entries with a modifyTimestamp later than the last sync
+are fetched. Deleted entries don't have a modifyTimestamp, so a full sync
+is done every FULL_SYNC_INTERVAL seconds to drop them.
+
+The replica is only used if "directory_replica" is set to true in the
+configuration.
+"""
+
+import contextlib
+import datetime
+import sqlite3
+import sys
+import time
+
+import shared.globals
+from shared import shared_ldap
+
+import directory_search
+import group_expansion
+import local_state
+import membership_sketch
+
+DATABASE_FILE = "directory_replica.sqlite"
+BASE = "dc=linaro,dc=org"
+MAILING_BASE = "ou=mailing,ou=groups,dc=linaro,dc=org"
+# Answers are only taken from the replica if it has been synced this recently.
+MAX_AGE = 15 * 60
+FULL_SYNC_INTERVAL = 24 * 60 * 60
+SYNC_FILTER = "(|(objectClass=groupOfUniqueNames)(objectClass=inetOrgPerson))"
+REPLICATED = [
+    "mail",
+    "uid",
+    "cn",
+    "manager",
+    "owner",
+    "uniqueMember",
+    "memberOf",
+    "title",
+    "departmentNumber",
+    "employeeType"
+]
+# Replicated attributes that hold DNs and so are compared case-insensitively
+# in the same way as the entry DNs.
+DN_ATTRIBUTES = ["manager", "owner", "uniqueMember", "memberOf"]
+# Attributes used to decide whether someone may do something. These are
+# never answered from the replica.
+AUTHORIZATION_ATTRIBUTES = ["owner", "uniqueMember", "memberOf"]
+# Set once the database has been initialised by this process.
+INITIALISED = False
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    ndn TEXT PRIMARY KEY,
+    dn TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entry_values (
+    ndn TEXT NOT NULL,
+    attribute TEXT NOT NULL,
+    value TEXT NOT NULL,
+    nvalue TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entry_values_by_dn ON entry_values (ndn);
+CREATE INDEX IF NOT EXISTS entry_values_lookup ON entry_values (attribute, nvalue);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class ReplicaAttribute:
+    """ Mimics the parts of an ldap3 attribute that the handlers use. """
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = values
+
+    @property
+    def value(self):
+        """ None, the single value or the list of values, as per ldap3. """
+        if self.values == []:
+            return None
+        if len(self.values) == 1:
+            return self.values[0]
+        return self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class ReplicaEntry:
+    """ Mimics the parts of an ldap3 entry that the handlers use. """
+
+    def __init__(self, dn, attributes):
+        self.entry_dn = dn
+        self._attributes = attributes
+
+    def __contains__(self, name):
+        return self._attributes.get(name, []) != []
+
+    def __getitem__(self, name):
+        return ReplicaAttribute(self._attributes.get(name, []))
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return ReplicaAttribute(self._attributes.get(name, []))
+
+    def __repr__(self):
+        return f"ReplicaEntry({self.entry_dn!r}, {self._attributes!r})"
+
+
+def enabled():
+    """ Is the replica turned on? """
+    return bool(shared.globals.CONFIGURATION.get("directory_replica", False))
+
+
+@contextlib.contextmanager
+def database():
+    """ Open the replica database, creating the tables if needed. """
+    global INITIALISED  # pylint: disable=global-statement
+    connection = sqlite3.connect(local_state.state_path(DATABASE_FILE), timeout=30)
+    try:
+        if not INITIALISED:
+            # WAL lets the handlers keep reading while a sync is being written.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            INITIALISED = True
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def normalise(value, attribute=None):
+    """ Normalise a DN or value for case-insensitive comparison. """
+    if attribute is None or attribute in DN_ATTRIBUTES or attribute in ("mail", "cn", "uid"):
+        return value.lower()
+    return value
+
+
+def is_fresh(connection):
+    """ Has the replica been synced recently enough to be used? """
+    row = connection.execute(
+        "SELECT value FROM sync_state WHERE key = 'synced'").fetchone()
+    return row is not None and time.time() - float(row[0]) < MAX_AGE
+
+
+def read_entry(connection, ndn):
+    """ Build a ReplicaEntry from the database, or None if it isn't there. """
+    row = connection.execute("SELECT dn FROM entries WHERE ndn = ?", (ndn,)).fetchone()
+    if row is None:
+        return None
+    attributes = {}
+    for attribute, value in connection.execute(
+            "SELECT attribute, value FROM entry_values WHERE ndn = ?", (ndn,)):
+        attributes.setdefault(attribute, []).append(value)
+    return ReplicaEntry(row[0], attributes)
+
+
+def dns_with_value(connection, attribute, value):
+    """ Return the DNs of the entries with the specified attribute value. """
+    return [
+        row[0] for row in connection.execute(
+            "SELECT entries.dn FROM entry_values JOIN entries USING (ndn) "
+            "WHERE attribute = ? AND nvalue = ?",
+            (attribute, normalise(value, attribute)))
+    ]
+
+
+def store_entry(connection, dn, attributes):
+    """ Insert or replace an entry in the replica. """
+    ndn = normalise(dn)
+    connection.execute("DELETE FROM entry_values WHERE ndn = ?", (ndn,))
+    connection.execute("INSERT OR REPLACE INTO entries (ndn, dn) VALUES (?, ?)", (ndn, dn))
+    rows = []
+    for attribute in REPLICATED:
+        values = attributes.get(attribute, [])
+        if isinstance(values, str):
+            values = [values]
+        for value in values:
+            # Empty groups hold a single empty uniqueMember, which is kept so
+            # that entries look the same as they do when read from LDAP.
+            if value is not None:
+                rows.append((ndn, attribute, value, normalise(value, attribute)))
+    connection.executemany(
+        "INSERT INTO entry_values (ndn, attribute, value, nvalue) VALUES (?, ?, ?, ?)", rows)
+
+
+def answerable(attributes):
+    """ Can a read of these attributes be answered from the replica? """
+    return (
+        enabled() and set(attributes) <= set(REPLICATED) and
+        not set(attributes) & set(AUTHORIZATION_ATTRIBUTES))
+
+
+def get_object(dn, attributes):
+    """ Read-through version of shared_ldap.get_object. """
+    if dn is not None and answerable(attributes):
+        with database() as connection:
+            if is_fresh(connection):
+                entry = read_entry(connection, normalise(dn))
+                if entry is not None:
+                    return entry
+    return shared_ldap.get_object(dn, attributes)
+
+
+def find_single_object_from_email(email_address):
+    """ Read-through version of shared_ldap.find_single_object_from_email. """
+    if enabled() and email_address is not None:
+        with database() as connection:
+            if is_fresh(connection):
+                dns = dns_with_value(connection, "mail", email_address)
+                if len(dns) == 1:
+                    return dns[0]
+    return shared_ldap.find_single_object_from_email(email_address)
+
+
+def find_from_email(email_address):
+    """ Read-through version of shared_ldap.find_from_email. """
+    if enabled() and email_address is not None:
+        with database() as connection:
+            if is_fresh(connection):
+                dns = dns_with_value(connection, "mail", email_address)
+                if len(dns) == 1:
+                    return dns[0]
+    return shared_ldap.find_from_email(email_address)
+
+
+def find_group(name, attributes):
+    """
+    Read-through version of shared_ldap.find_group. Only answers from the
+    replica when exactly one mailing group matches the name or address.
+    """
+    if name is not None and answerable(attributes):
+        attribute = "mail" if "@" in name else "cn"
+        with database() as connection:
+            if is_fresh(connection):
+                dns = [
+                    dn for dn in dns_with_value(connection, attribute, name)
+                    if dn.lower().endswith("," + MAILING_BASE)
+                ]
+                if len(dns) == 1:
+                    entry = read_entry(connection, normalise(dns[0]))
+                    mail = connection.execute(
+                        "SELECT value FROM entry_values WHERE ndn = ? AND attribute = 'mail'",
+                        (normalise(dns[0]),)).fetchone()
+                    if mail is not None:
+                        return mail[0], [entry]
+    return shared_ldap.find_group(name, attributes)
+
+
+def refresh(*dns):
+    """
+    Update the replica for entries that have just been changed in LDAP. An
+    entry that no longer exists is removed from the replica.
+    """
+    group_expansion.invalidate(*dns)
+    if not enabled():
+        return
+    fetched = [(dn, shared_ldap.get_object(dn, REPLICATED)) for dn in dns if dn is not None]
+    with database() as connection:
+        for dn, entry in fetched:
+            if entry is None:
+                forget_entry(connection, dn)
+            else:
+                store_entry(connection, entry.entry_dn, {
+                    attribute: directory_search.entry_values(entry, attribute)
+                    for attribute in REPLICATED
+                })
+    for dn, entry in fetched:
+        if entry is not None:
+            membership_sketch.record(
+                entry.entry_dn, directory_search.entry_values(entry, "uniqueMember"))
+
+
+def refresh_group(group_cn, *dns):
+    """ Refresh a group, referred to by its cn, plus any other entries that changed. """
+    refresh(
+        f"cn={group_cn},{MAILING_BASE}",
+        f"cn={group_cn},ou=security,ou=groups,dc=linaro,dc=org",
+        *dns)
+
+
+def forget(*dns):
+    """ Remove deleted entries from the replica. """
+    group_expansion.invalidate(*dns)
+    if not enabled():
+        return
+    with database() as connection:
+        for dn in dns:
+            forget_entry(connection, dn)
+
+
+def forget_entry(connection, dn):
+    """ Remove a single entry from the replica. """
+    ndn = normalise(dn)
+    connection.execute("DELETE FROM entry_values WHERE ndn = ?", (ndn,))
+    connection.execute("DELETE FROM entries WHERE ndn = ?", (ndn,))
+
+
+def ldap_timestamp(value):
+    """ Convert a modifyTimestamp value into LDAP GeneralizedTime. """
+    if isinstance(value, list):
+        value = value[0]
+    if isinstance(value, datetime.datetime):
+        return value.astimezone(datetime.timezone.utc).strftime("%Y%m%d%H%M%SZ")
+    return value
+
+
+def sync():
+    """ Bring the replica up to date, doing a full sync when one is due. """
+    with database() as connection:
+        state = dict(connection.execute("SELECT key, value FROM sync_state"))
+    full = (
+        "last_modified" not in state or
+        time.time() - float(state.get("full_sync", 0)) > FULL_SYNC_INTERVAL)
+    ldap_filter = SYNC_FILTER
+    if not full:
+        ldap_filter = f"(&{SYNC_FILTER}(modifyTimestamp>={state['last_modified']}))"
+
+    started = time.time()
+    last_modified = state.get("last_modified", "")
+    count = 0
+    with database() as connection:
+        if full:
+            connection.execute("DELETE FROM entry_values")
+            connection.execute("DELETE FROM entries")
+        for dn, attributes in directory_search.paged_search(
+                ldap_filter, REPLICATED + ["modifyTimestamp"], BASE):
+            store_entry(connection, dn, attributes)
+            modified = ldap_timestamp(attributes.get("modifyTimestamp"))
+            if modified is not None and modified > last_modified:
+                last_modified = modified
+            count += 1
+        updates = {"synced": str(started), "last_modified": last_modified}
+        if full:
+            updates["full_sync"] = str(started)
+        connection.executemany(
+            "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+            list(updates.items()))
+        membership_sketch.build(connection)
+    print(f"directory_replica: {'full' if full else 'incremental'} sync stored {count} entries")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["sync"]:
+        sys.exit("Usage: directory_replica.py sync")
+    sync()
@@ -0,0 +1,42 @@
+"""
+Helpers for reading large numbers of entries from LDAP.
+
+These are kept apart from linaro_shared so that the modules that
+linaro_shared itself uses (such as directory_replica) can use them
+without importing it.
+"""
+
+from shared import shared_ldap
+
+
+def entry_values(entry, attribute):
+    """ Return the values of an attribute, coping with it being absent from the entry. """
+    if attribute not in entry:
+        return []
+    return entry[attribute].values
+
+
+def paged_search(ldap_filter, attributes, base, page_size=500, connection=None):
+    """
+    Stream the results of a search a page at a time so that searches
+    covering the whole directory don't have to be held in memory. Yields
+    (dn, attributes) tuples where the attributes are a dict of lists.
+
+    A connection that is passed in is left open for the caller. Otherwise
+    a connection is opened for the search and closed once it is finished.
+    """
+    opened = connection is None
+    if opened:
+        connection = shared_ldap.get_ldap_connection()
+    try:
+        for entry in connection.extend.standard.paged_search(
+                search_base=base,
+                search_filter=ldap_filter,
+                attributes=attributes,
+                paged_size=page_size,
+                generator=True):
+            if entry["type"] == "searchResEntry":
+                yield entry["dn"], entry["attributes"]
+    finally:
+        if opened:
+            connection.unbind()
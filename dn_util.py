@@ -0,0 +1,147 @@
+"""
+Parsed distinguished names and a compact container for group membership.
+
+parse() turns a DN string into a DN object that has already been split
+into its parts, so that handlers don't need to pick DNs apart with
+split(). DNs are interned: parsing the same DN twice (in any case) gives
+the same object for as long as it is in use, and the parent of a DN is
+only parsed once.
+
+MemberSet holds the members of a group as a sorted list of interned,
+lower case DN strings. It uses much less memory than a set for groups
+with tens of thousands of members, and checking membership is a binary
+search rather than the linear scan of the uniqueMember list.
+"""
+
+import bisect
+import sys
+import weakref
+
+# Normalised DN -> DN for every DN that is still referenced somewhere.
+INTERNED = weakref.WeakValueDictionary()
+
+
+def normalise(dn):
+    """ Return the form of a DN used for comparisons. """
+    return sys.intern(str(dn).lower())
+
+
+def split_rdn(text):
+    """ Split off the first RDN, allowing for escaped commas. """
+    index = 0
+    while True:
+        index = text.find(",", index)
+        if index == -1:
+            return text, None
+        if index == 0 or text[index - 1] != "\\":
+            return text[:index], text[index + 1:]
+        index += 1
+
+
+class DN:
+    """
+    A distinguished name, e.g. uid=fred,ou=staff,ou=accounts,dc=linaro,dc=org
+    has the rdn "uid=fred", the attribute "uid", the value "fred" and the
+    parent ou=staff,ou=accounts,dc=linaro,dc=org. The original text is kept
+    for passing back to LDAP; comparisons ignore case.
+    """
+    __slots__ = ("text", "normalised", "rdn", "attribute", "value", "_parent", "__weakref__")
+
+    def __init__(self, text):
+        self.text = text
+        self.normalised = normalise(text)
+        self.rdn, self._parent = split_rdn(text)
+        self.attribute, _, self.value = self.rdn.partition("=")
+        self.attribute = self.attribute.lower()
+
+    @property
+    def parent(self):
+        """ The DN of the entry containing this one, or None at the top. """
+        if isinstance(self._parent, str):
+            self._parent = parse(self._parent)
+        return self._parent
+
+    @property
+    def ou(self):
+        """ The name of the OU holding this entry, e.g. "staff" or "leavers". """
+        parent = self.parent
+        if parent is None or parent.attribute != "ou":
+            return None
+        return parent.value
+
+    def moved_to(self, parent):
+        """ Return the DN this entry would have under a different parent. """
+        return parse(f"{self.rdn},{parent}")
+
+    def __eq__(self, other):
+        if isinstance(other, DN):
+            return self.normalised == other.normalised
+        if isinstance(other, str):
+            return self.normalised == other.lower()
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.normalised)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f"DN({self.text!r})"
+
+
+def parse(dn):
+    """ Return the interned DN object for a DN string. """
+    if isinstance(dn, DN):
+        return dn
+    key = normalise(dn)
+    parsed = INTERNED.get(key)
+    if parsed is None:
+        parsed = DN(dn)
+        INTERNED[key] = parsed
+    return parsed
+
+
+class MemberSet:
+    """
+    The members of a group. Accepts DN strings or DN objects and ignores the
+    empty member that LDAP groups use as a placeholder.
+    """
+    __slots__ = ("_members",)
+
+    def __init__(self, members=()):
+        self._members = sorted({normalise(member) for member in members if member != ""})
+
+    def _find(self, member):
+        """ Return the normalised member and where it is, or would be, in the list. """
+        key = normalise(member)
+        return key, bisect.bisect_left(self._members, key)
+
+    def __contains__(self, member):
+        key, index = self._find(member)
+        return index < len(self._members) and self._members[index] == key
+
+    def add(self, member):
+        """ Add a member, returning False if they were already there. """
+        key, index = self._find(member)
+        if index < len(self._members) and self._members[index] == key:
+            return False
+        self._members.insert(index, key)
+        return True
+
+    def discard(self, member):
+        """ Remove a member, returning False if they weren't there. """
+        key, index = self._find(member)
+        if index < len(self._members) and self._members[index] == key:
+            del self._members[index]
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._members)
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __repr__(self):
+        return f"MemberSet({len(self._members)} members)"
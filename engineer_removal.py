@@ -1,37 +1,58 @@
 """ This code is triggered when an Engineer Removal ticket is created """
 
 import shared.shared_sd as shared_sd
-import shared.shared_ldap as shared_ldap
 import shared.custom_fields as custom_fields
 import shared.globals
+import entry_cache
+import instrumentation
 import linaro_shared
+import prefetch
+import profiler
 
 CAPABILITIES = [
     "COMMENT",
     "CREATE"
 ]
 
+# Everything check_approval_assignee_member_engineer and create need, so
+# that it can be fetched up front.
+PREFETCH = {
+    "engineer": {
+        "person": "Assignee/Member Engineer",
+        "attributes": [
+            "description", "departmentNumber", "o", "employeeType", "manager", "secretary"
+        ],
+        "follow": {"manager": ["mail"], "secretary": ["mail"]}
+    }
+}
+
+@instrumentation.instrumented
 def comment(ticket_data):
     """ Triggered when a comment is posted """
     _, keyword = shared_sd.central_comment_handler(
-        [], ["help", "retry"])
+        [], ["help", "retry", "profile"])
 
     if keyword == "help":
         shared_sd.post_comment(("All bot commands must be internal comments and the first word/phrase in the comment.\r\n\r\n"
                                "Valid commands are:\r\n"
-                               "* retry to ask the bot to process the request again after issues have been resolved."), False)
+                               "* retry to ask the bot to process the request again after issues have been resolved.\r\n"
+                               "* profile to run the request again without making any changes and attach a performance profile."), False)
     elif keyword == "retry":
         print("engineer_removal processing retry keyword & triggering create function")
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
 
+@instrumentation.instrumented
 def create(ticket_data):
+    prefetch.context(__name__, ticket_data)
     linaro_shared.check_approval_assignee_member_engineer(ticket_data)
     cf_engineer = custom_fields.get("Assignee/Member Engineer")
     ldap_dn = linaro_shared.get_dn_from_account_id(ticket_data, cf_engineer)
     if ldap_dn is None:
         return
 
-    ldap_search = shared_ldap.get_object(
+    ldap_search = entry_cache.get_object(
         ldap_dn,
         ['employeeType', 'secretary'])
     if ldap_search is None:
@@ -53,7 +74,12 @@ def create(ticket_data):
     # participant.
     secretary = ldap_search.secretary.value
     if secretary is not None:
-        secretary = shared_ldap.get_email_address(secretary)
+        secretary = entry_cache.get_object(secretary, ['mail'])
+        # Use the first address as the secretary can have more than one.
+        if secretary is not None and secretary.mail.values != []:
+            secretary = secretary.mail.values[0]
+        else:
+            secretary = None
     print(f"engineer_removal: secretary is {secretary}")
     if secretary is not None and secretary != shared.globals.REPORTER:
         shared_sd.add_request_participant(secretary)
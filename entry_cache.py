@@ -0,0 +1,129 @@
+"""
+A cache of LDAP entries that lasts for the handling of a single webhook.
+
+Handlers often read the same entry several times while dealing with one
+ticket, each time asking for a different set of attributes. get_object()
+here remembers the attributes already fetched for each DN and only goes
+back to LDAP (via the directory replica) when an attribute that hasn't
+been fetched is asked for. It then fetches everything that has been asked
+for so far, together with anything declared up front with need(), so that
+an entry is normally only fetched once.
+
+The cache belongs to the ticket being processed: it is emptied as soon as
+the framework moves on to a different ticket, so nothing is carried from
+one webhook to the next. Handlers that change an entry should call
+forget() for it.
+"""
+
+import shared.globals
+
+import directory_replica
+
+CACHE = {
+    # The ticket data the cache was filled for.
+    "ticket": None,
+    # Normalised DN -> {"dn", "attributes", "fetched"}, or None if the
+    # entry doesn't exist.
+    "entries": {},
+    # Attribute names (lower case -> as written) fetched with every entry.
+    "needed": {},
+    # Results remembered with remember().
+    "results": {}
+}
+
+
+def current():
+    """ Return the cache, emptying it first if the ticket has changed. """
+    ticket = getattr(shared.globals, "TICKET_DATA", None)
+    if CACHE["ticket"] is not ticket:
+        CACHE["ticket"] = ticket
+        CACHE["entries"] = {}
+        CACHE["needed"] = {}
+        CACHE["results"] = {}
+    return CACHE
+
+
+def need(*attributes):
+    """ Declare attributes that will be read from entries later on. """
+    cache = current()
+    for attribute in attributes:
+        cache["needed"].setdefault(attribute.lower(), attribute)
+
+
+def get_object(dn, attributes):
+    """
+    Cached version of shared_ldap.get_object. The entry returned behaves
+    like an ldap3 entry for the attributes that were asked for.
+    """
+    if dn is None:
+        return None
+    cache = current()
+    key = dn.lower()
+    wanted = {attribute.lower(): attribute for attribute in attributes}
+    if key in cache["entries"]:
+        cached = cache["entries"][key]
+        if cached is None:
+            return None
+        if set(wanted) <= set(cached["fetched"]):
+            return directory_replica.ReplicaEntry(cached["dn"], cached["attributes"])
+        fetch = dict(cached["fetched"])
+    else:
+        fetch = {}
+    fetch.update(cache["needed"])
+    fetch.update(wanted)
+    entry = directory_replica.get_object(dn, sorted(fetch.values()))
+    if entry is None:
+        cache["entries"][key] = None
+        return None
+    values = {}
+    for lower, attribute in fetch.items():
+        found = entry[attribute].values if attribute in entry else []
+        # Keep every spelling the attribute has been asked for under so that
+        # lookups behave as they would on an ldap3 entry.
+        for spelling in {attribute, wanted.get(lower, attribute)}:
+            values[spelling] = found
+    cache["entries"][key] = {"dn": entry.entry_dn, "attributes": values, "fetched": fetch}
+    return directory_replica.ReplicaEntry(entry.entry_dn, values)
+
+
+def store(dn, values):
+    """
+    Add an entry that was fetched some other way, such as by the prefetch
+    planner. values maps each fetched attribute to its list of values.
+    """
+    cache = current()
+    key = dn.lower()
+    attributes = {}
+    fetched = {}
+    existing = cache["entries"].get(key)
+    if existing is not None:
+        attributes.update(existing["attributes"])
+        fetched.update(existing["fetched"])
+    attributes.update(values)
+    fetched.update({attribute.lower(): attribute for attribute in values})
+    cache["entries"][key] = {"dn": dn, "attributes": attributes, "fetched": fetched}
+
+
+def remember(name, function, *args):
+    """
+    Return the result of calling the function, only calling it the first
+    time it is asked for with the same name and arguments.
+    """
+    cache = current()
+    key = (name,) + args
+    if key not in cache["results"]:
+        cache["results"][key] = function(*args)
+    return cache["results"][key]
+
+
+def store_result(name, result, *args):
+    """ Provide the result that remember() would otherwise calculate. """
+    current()["results"][(name,) + args] = result
+
+
+def forget(*dns):
+    """ Drop entries that have been changed. """
+    cache = current()
+    for dn in dns:
+        if dn is not None:
+            cache["entries"].pop(dn.lower(), None)
@@ -8,11 +8,16 @@ import requests
 import json
 from shared import shared_vault
 
+import instrumentation
+import work_queue
+
 CAPABILITIES = [
     "CREATE",
     "JIRAHOOK"
 ]
 
+@work_queue.queued
+@instrumentation.instrumented
 def create(ticket_data):
     """ Ticket has been created """
     # Called when the ticket is first created and when the ticket transitions
@@ -56,6 +61,8 @@ def fire_github_workflow(ticket_data):
         f"{result.status_code} after triggering workflow for {issue_self}")
 
 
+@work_queue.queued
+@instrumentation.instrumented
 def jira_hook(ticket_data, changelog):
     """ Called when the Jira webhook fires """
     # Called whenever the ticket is updated. There are two reasons we want
@@ -0,0 +1,119 @@
+"""
+A local index of Google group aliases so that checking whether an email
+address is an alias doesn't cost an Admin API call on every ticket.
+
+The index is built by paging through every group in the Google domain and
+is kept up to date by running this file on a schedule:
+
+    python google_alias_index.py refresh
+
+Lookups are answered from the index while it is fresh. If the index is
+missing or hasn't been refreshed for STALE_AFTER seconds, the live API call
+is used instead so that a broken refresh job can't lead to bad answers.
+
+The index is only used if "google_alias_index" is present in the
+configuration, e.g.:
+
+    "google_alias_index": {
+        "secret": "secret/misc/google-directory",
+        "secret_key": "json",
+        "subject": "it-support-bot@linaro.org"
+    }
+
+where the Vault secret holds a service account key with domain-wide
+delegation for the read-only group scope.
+"""
+
+import json
+import sys
+import time
+
+import shared.globals
+from shared import shared_google, shared_vault
+
+import local_state
+
+INDEX_FILE = "google_alias_index.json"
+# The index is no longer trusted once it is this old (in seconds).
+STALE_AFTER = 60 * 60
+SCOPES = ["https://www.googleapis.com/auth/admin.directory.group.readonly"]
+PAGE_SIZE = 200
+
+# In-memory copy of the index and the time it was loaded from disk.
+INDEX = None
+INDEX_LOADED = 0
+
+
+def settings():
+    """ Return the index configuration or None if the index isn't enabled. """
+    return shared.globals.CONFIGURATION.get("google_alias_index")
+
+
+def check_group_alias(email_address):
+    """
+    Drop-in replacement for shared_google.check_group_alias. Returns the
+    group that the email address is an alias for, or None.
+    """
+    index = get_index()
+    if index is None:
+        return shared_google.check_group_alias(email_address)
+    return index["aliases"].get(email_address.lower())
+
+
+def get_index():
+    """ Return the index if it is enabled and fresh enough to be used. """
+    global INDEX, INDEX_LOADED  # pylint: disable=global-statement
+    if settings() is None:
+        return None
+    # Other processes refresh the file so re-read it every so often.
+    if INDEX is None or time.time() - INDEX_LOADED > 60:
+        INDEX = local_state.load_state(INDEX_FILE)
+        INDEX_LOADED = time.time()
+    if INDEX is None or time.time() - INDEX["refreshed"] > STALE_AFTER:
+        return None
+    return INDEX
+
+
+def directory_service():
+    """ Build an Admin SDK Directory API client from the configured credentials. """
+    # Only needed when the index is being refreshed so imported here.
+    from google.oauth2 import service_account  # pylint: disable=import-outside-toplevel
+    from googleapiclient.discovery import build  # pylint: disable=import-outside-toplevel
+
+    config = settings()
+    key = json.loads(shared_vault.get_secret(config["secret"], config["secret_key"]))
+    credentials = service_account.Credentials.from_service_account_info(
+        key, scopes=SCOPES).with_subject(config["subject"])
+    return build("admin", "directory_v1", credentials=credentials, cache_discovery=False)
+
+
+def refresh():
+    """
+    Rebuild the index by paging through all of the groups. Only the email
+    address and aliases of each group are requested to keep the pages small.
+    """
+    service = directory_service()
+    aliases = {}
+    groups = 0
+    request = service.groups().list(
+        customer=settings().get("customer", "my_customer"),
+        maxResults=PAGE_SIZE,
+        fields="nextPageToken,groups(email,aliases)")
+    while request is not None:
+        response = request.execute()
+        for group in response.get("groups", []):
+            groups += 1
+            for alias in group.get("aliases", []):
+                aliases[alias.lower()] = group["email"]
+        request = service.groups().list_next(request, response)
+    local_state.save_state(INDEX_FILE, {
+        "refreshed": time.time(),
+        "aliases": aliases
+    })
+    print(f"google_alias_index: indexed {len(aliases)} aliases for {groups} groups")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["refresh"]:
+        sys.exit("Usage: google_alias_index.py refresh")
+    refresh()
@@ -0,0 +1,139 @@
+"""
+Expand lists of DNs that can include groups into the people they cover.
+
+Group owners (and members) can be other groups, which can in turn contain
+groups. expand() works out everyone a group covers, following nested
+groups to any depth and skipping cycles, and remembers the answer for
+REFRESH_INTERVAL seconds so that a group is only expanded once however
+many ownership checks refer to it. The direct members of each group are
+cached as well, so expanding a group that contains an already expanded
+group doesn't read that group again.
+
+directory_replica.refresh() and forget() are called whenever a handler
+changes an entry, and they call invalidate() so that a change to a group
+is seen straight away by the process that made it. Other processes see it
+when their cached expansions expire.
+"""
+
+import time
+
+import shared.globals
+
+import directory_replica
+import dn_util
+import entry_cache
+
+# How long expansions are trusted for.
+REFRESH_INTERVAL = 5 * 60
+# Normalised group DN -> (time read, direct member DNs).
+MEMBERS = {}
+# Normalised group DN -> (time expanded, people covered, groups traversed).
+CLOSURES = {}
+
+
+def is_group(dn):
+    """ Is the DN a mailing or security group? """
+    return ",ou=groups," in dn.lower()
+
+
+def is_current(cached):
+    """ Is a cached value still within the refresh interval? """
+    return cached is not None and time.monotonic() - cached[0] < REFRESH_INTERVAL
+
+
+def prime(groups):
+    """
+    Remember the direct members of group entries that have already been
+    fetched with their uniqueMember attribute.
+    """
+    now = time.monotonic()
+    for group in groups:
+        MEMBERS[directory_replica.normalise(group.entry_dn)] = (
+            now, dn_util.MemberSet(group.uniqueMember.values))
+
+
+def direct_members(group_dn):
+    """ Return the DNs directly listed as members of a group. """
+    ndn = directory_replica.normalise(group_dn)
+    cached = MEMBERS.get(ndn)
+    if is_current(cached):
+        return cached[1]
+    entry = directory_replica.get_object(group_dn, ["uniqueMember"])
+    members = dn_util.MemberSet()
+    if entry is not None:
+        members = dn_util.MemberSet(entry.uniqueMember.values)
+    MEMBERS[ndn] = (time.monotonic(), members)
+    return members
+
+
+def expand(group_dn):
+    """
+    Return the normalised DNs of everyone covered by the group, directly or
+    through nested groups.
+    """
+    ndn = directory_replica.normalise(group_dn)
+    cached = CLOSURES.get(ndn)
+    if is_current(cached):
+        return cached[1]
+    people = set()
+    traversed = {ndn}
+    pending = [group_dn]
+    while pending:
+        for member in direct_members(pending.pop()):
+            member_ndn = directory_replica.normalise(member)
+            if not is_group(member):
+                people.add(member_ndn)
+                continue
+            if member_ndn in traversed:
+                # Already expanded, including when the groups form a cycle.
+                continue
+            traversed.add(member_ndn)
+            nested = CLOSURES.get(member_ndn)
+            if is_current(nested):
+                people.update(nested[1])
+                traversed.update(nested[2])
+            else:
+                pending.append(member)
+    people = frozenset(people)
+    CLOSURES[ndn] = (time.monotonic(), people, frozenset(traversed))
+    return people
+
+
+def covered(dns):
+    """
+    Return the normalised DNs of the people in the list, with any groups
+    replaced by their members.
+    """
+    people = set()
+    for dn in dns:
+        if dn == "":
+            continue
+        if is_group(dn):
+            people.update(expand(dn))
+        else:
+            people.add(directory_replica.normalise(dn))
+    return people
+
+
+def flatten(dns):
+    """ Replacement for shared_ldap.flatten_list. """
+    return sorted(covered(dns))
+
+
+def reporter_is_owner(owners):
+    """ Replacement for shared_ldap.reporter_is_group_owner. """
+    reporter_dn = entry_cache.remember(
+        "reporter", directory_replica.find_from_email, shared.globals.REPORTER)
+    if reporter_dn is None:
+        return False
+    return directory_replica.normalise(reporter_dn) in covered(owners)
+
+
+def invalidate(*dns):
+    """ Forget what is known about groups that have changed. """
+    changed = {directory_replica.normalise(dn) for dn in dns if dn is not None}
+    for ndn in changed:
+        MEMBERS.pop(ndn, None)
+    for ndn, cached in list(CLOSURES.items()):
+        if cached[2] & changed:
+            del CLOSURES[ndn]
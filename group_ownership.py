@@ -3,7 +3,15 @@ import shared.custom_fields as custom_fields
 import shared.globals
 import shared.shared_ldap as shared_ldap
 import shared.shared_sd as shared_sd
+import directory_replica
+import entry_cache
+import group_expansion
+import idempotency
+import instrumentation
 import linaro_shared
+import prefetch
+import profiler
+import work_queue
 
 CAPABILITIES = [
     "CREATE",
@@ -15,11 +23,23 @@ IT_BOT = "uid=it.support.bot,ou=mail-contacts-unsynced,ou=accounts,dc=linaro,dc=
 GROUP_EMAIL_ADDRESS = "Group Email Address"
 WONT_DO = "Won't Do"
 
+# The group and its owners' details are fetched when the ticket is created.
+PREFETCH = {
+    "group": {
+        "group": GROUP_EMAIL_ADDRESS,
+        "attributes": ["owner"],
+        "follow": {"owner": ["displayName", "mail", "givenName", "sn"]}
+    }
+}
+
+@work_queue.queued
+@instrumentation.instrumented
+@idempotency.deduplicated
 def comment(ticket_data):
     """ Comment handler """
     last_comment, keyword = shared_sd.central_comment_handler(
         ["add", "remove", "help"],  # Public comments
-        ["retry"])  # Private comments
+        ["retry", "profile"])  # Private comments
     
     print(f"group_ownership comment handler: {last_comment}, {keyword}")
 
@@ -29,9 +49,14 @@ def comment(ticket_data):
              "word/phrase in the comment.\r\n\r\n"
              "Valid commands are:\r\n"
              "* retry to ask the bot to process the request again after "
-             "issues have been resolved."), False)
+             "issues have been resolved.\r\n"
+             "* profile to run the request again without making any "
+             "changes and attach a performance profile."), False)
     elif keyword == "retry":
-        create(ticket_data)
+        if not idempotency.is_repeated_command(ticket_data, keyword):
+            create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
     elif keyword == "add" or keyword == "remove":
         # Explicitly process comment if keyword is add or remove so that this works
         # for IT staff!
@@ -60,7 +85,7 @@ def process_public_comment(ticket_data, last_comment, keyword):
         ticket_data, cf_group_email_address)
     if group_email_address is not None:
         group_email_address = group_email_address.strip().lower()
-    group_email_address, result = shared_ldap.find_group(
+    group_email_address, result = directory_replica.find_group(
         group_email_address, ['owner'])
     # Make sure that the group still exists because this is all asynchronous
     # and anything could have happened!
@@ -78,7 +103,7 @@ def process_public_comment(ticket_data, last_comment, keyword):
         return True
 
     if (result[0].owner.values != [] and
-            shared_ldap.reporter_is_group_owner(result[0].owner.values) and
+            group_expansion.reporter_is_owner(result[0].owner.values) and
             keyword in ("add", "remove")):
         grp_name = shared_ldap.extract_id_from_dn(result[0].entry_dn)
         changes = last_comment["body"].split("\n")
@@ -90,6 +115,9 @@ def process_public_comment(ticket_data, last_comment, keyword):
     return False
 
 
+@work_queue.queued
+@instrumentation.instrumented
+@idempotency.deduplicated
 def create(ticket_data):
     """Triggered when the issue is created."""
     cf_group_email_address = custom_fields.get(GROUP_EMAIL_ADDRESS)
@@ -97,8 +125,9 @@ def create(ticket_data):
         ticket_data, cf_group_email_address)
     if group_email_address is not None:
         group_email_address = group_email_address.strip().lower()
-    group_email_address, result = shared_ldap.find_group(
-        group_email_address, ['owner'])
+    result = prefetch.context(__name__, ticket_data).matches("group")
+    if len(result) == 1:
+        group_email_address = result[0].mail.value
 
     shared_sd.set_summary(
         f"View/Change group ownership for {group_email_address}")
@@ -138,7 +167,7 @@ def create(ticket_data):
     ownerchanges = shared_sd.get_field(ticket_data, cf_group_owners)
     if ownerchanges is None:
         post_owners_of_group_as_comment(result[0].entry_dn)
-        if shared_ldap.reporter_is_group_owner(result[0].owner.values):
+        if group_expansion.reporter_is_owner(result[0].owner.values):
             shared_sd.post_comment(
                 ("As you are an owner of this group, you can make changes to "
                  "the ownership by posting new comments to this ticket with "
@@ -173,7 +202,7 @@ def create(ticket_data):
                 "cn=its,ou=mailing,ou=groups,dc=linaro,dc=org")
             shared_sd.assign_approvers(it_members, cf_approvers)
             shared_sd.transition_request_to("Needs approval")
-    elif shared_ldap.reporter_is_group_owner(result[0].owner.values):
+    elif group_expansion.reporter_is_owner(result[0].owner.values):
         shared_sd.transition_request_to("In progress")
     else:
         shared_sd.post_comment(
@@ -183,6 +212,9 @@ def create(ticket_data):
         shared_sd.transition_request_to("Needs approval")
 
 
+@work_queue.queued
+@instrumentation.instrumented
+@idempotency.deduplicated
 def transition(status_to, ticket_data):
     """
     If the status is "In Progress", trigger the membership change. This
@@ -194,7 +226,7 @@ def transition(status_to, ticket_data):
             ticket_data, cf_group_email_address)
         if group_email_address is not None:
             group_email_address = group_email_address.strip().lower()
-        group_email_address, result = shared_ldap.find_group(
+        group_email_address, result = directory_replica.find_group(
             group_email_address, ['owner'])
         action_change(ticket_data, result[0])
 
@@ -217,7 +249,7 @@ def action_change(ticket_data, group_owners):
     batch_process_ownership_changes(grp_name, changes, True, changes_to_make)
     post_owners_of_group_as_comment(group_owners.entry_dn)
     if (group_owners.owner.values != [] and
-            shared_ldap.reporter_is_group_owner(group_owners.owner.values)):
+            group_expansion.reporter_is_owner(group_owners.owner.values)):
         shared_sd.post_comment(
             ("As you are an owner of this group, you can make changes to the "
              "ownership by posting new comments to this ticket with the "
@@ -291,7 +323,7 @@ def determine_change_keyword(auto, change_to_make):
 
 def get_group_owners(group_cn):
     """ Consistently return a list of owners. """
-    _, result = shared_ldap.find_group(group_cn, ["owner"])
+    _, result = directory_replica.find_group(group_cn, ["owner"])
     if len(result) == 1:
         owners = result[0].owner.values
     else:
@@ -302,7 +334,7 @@ def get_group_owners(group_cn):
 def process_change(keyword, email_address, owners, group_cn, response):
     """ Process the membership change specified. """
     email_address = linaro_shared.cleanup_if_markdown(email_address)
-    result = shared_ldap.find_single_object_from_email(email_address)
+    result = directory_replica.find_single_object_from_email(email_address)
     if result is None:
         response += (
             "Couldn't find an entry on Linaro Login with an email "
@@ -350,12 +382,14 @@ def process_keyword(keyword, result, owners, email_address, group_cn, response):
         else:
             response += f"Adding {email_address}\r\n"
             shared_ldap.add_owner_to_group(group_cn, result)
+            directory_replica.refresh_group(group_cn)
             change_made = True
     elif keyword == "remove":
         if result in owners:
             response += f"Removing {email_address}\r\n"
             shared_ldap.remove_owner_from_group(
                 group_cn, result)
+            directory_replica.refresh_group(group_cn)
             change_made = True
         else:
             response += (
@@ -375,7 +409,7 @@ def post_owners_of_group_as_comment(group_full_dn):
     # Need to re-fetch the group ownership because we may have changed it
     # since last time we queried it.
     name = shared_ldap.extract_id_from_dn(group_full_dn)
-    _, result = shared_ldap.find_group(name, ["owner"])
+    _, result = directory_replica.find_group(name, ["owner"])
     if len(result) == 1 and result[0].owner.values != []:
         response = "Here are the owners for the group:\r\n"
         for owner in result[0].owner.values:
@@ -386,7 +420,7 @@ def post_owners_of_group_as_comment(group_full_dn):
 
 def owner_and_display_name(owner):
     """ Calculate the owner's email address and display name. """
-    this_owner = shared_ldap.get_object(
+    this_owner = entry_cache.get_object(
         owner,
         ['displayName', 'mail', 'givenName', 'sn'])
     if this_owner is None:
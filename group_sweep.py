@@ -0,0 +1,208 @@
+"""
+Handler for the IT-only request to sweep the directory for groups that
+look like they can be cleaned up.
+
+Every group is streamed from LDAP a page at a time and classified as:
+
+* empty: the group has no members
+* ownerless: the group has no owners
+* bot-owned: the group is maintained by automation
+* orphan-owner: at least one owner no longer exists or has left
+
+The full report is attached to the ticket as a compressed CSV file. The
+selected groups can then be deleted by posting a private "delete" comment
+listing one group per line.
+"""
+
+import csv
+import datetime
+import gzip
+import tempfile
+
+import shared.globals
+from shared import shared_ldap, shared_sd
+
+import delete_ldap_group
+import directory_search
+import dn_util
+import instrumentation
+import linaro_shared
+import profiler
+import work_queue
+
+CAPABILITIES = [
+    "CREATE",
+    "COMMENT"
+]
+
+IT_BOT = (
+    'uid=it.support.bot,ou=mail-contacts-unsynced,'
+    'ou=accounts,dc=linaro,dc=org'
+)
+MAILING_BASE = "ou=mailing,ou=groups,dc=linaro,dc=org"
+CLASSES = ["empty", "ownerless", "bot-owned", "orphan-owner"]
+# Groups are classified in batches of this size so that the owner existence
+# checks can be batched too.
+BATCH_SIZE = 500
+
+
+@work_queue.queued
+@instrumentation.instrumented
+def comment(ticket_data):
+    """ Triggered when a comment is posted. """
+    last_comment, keyword = shared_sd.central_comment_handler(
+        [], ["help", "retry", "delete", "profile"])
+
+    if keyword == "help":
+        shared_sd.post_comment(
+            ("All bot commands must be internal comments and the first "
+             "word/phrase in the comment.\r\n\r\n"
+             "Valid commands are:\r\n"
+             "* retry to ask the bot to sweep the groups again.\r\n"
+             "* delete followed by one group name or email address per line "
+             "to delete those groups. Only groups that are still empty will "
+             "be deleted.\r\n"
+             "* profile to sweep the groups again without making any changes "
+             "and attach a performance profile."), False)
+    elif keyword == "retry":
+        create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
+    elif keyword == "delete":
+        bulk_delete(last_comment["body"].split("\n")[1:])
+    elif last_comment is not None and last_comment['public']:
+        shared_sd.deassign_ticket_if_appropriate(last_comment)
+
+
+@work_queue.queued
+@instrumentation.instrumented
+def create(ticket_data):
+    """ Triggered when the issue is created. """
+    _ = ticket_data  # keep linter happy
+    if not shared_ldap.is_user_in_group("its", shared.globals.REPORTER):
+        shared_sd.post_comment(
+            "Sorry but only IT Services can use this request.", True)
+        shared_sd.resolve_ticket("Declined")
+        return
+
+    shared_sd.assign_issue_to(shared.globals.CONFIGURATION["bot_name"])
+    counts = {name: 0 for name in CLASSES}
+    total = 0
+    filename = f"group-sweep-{datetime.date.today().isoformat()}.csv.gz"
+    with tempfile.TemporaryFile() as report:
+        with gzip.open(report, "wt", encoding="utf-8", newline="") as compressed:
+            writer = csv.writer(compressed)
+            writer.writerow(["cn", "mail", "classification", "members", "owners"])
+            batch = []
+            # The normalised DNs of the owners found to exist during this
+            # sweep. Not kept between sweeps because owners can be deleted.
+            known_owners = set()
+            for dn, attributes in directory_search.paged_search(
+                    "(objectClass=groupOfUniqueNames)",
+                    ["cn", "mail", "owner", "uniqueMember"],
+                    MAILING_BASE):
+                batch.append((dn, attributes))
+                if len(batch) == BATCH_SIZE:
+                    total += write_batch(writer, batch, counts, known_owners)
+                    batch = []
+            total += write_batch(writer, batch, counts, known_owners)
+        report.seek(0)
+        attached = linaro_shared.attach_file(filename, report)
+
+    summary = ", ".join(f"{counts[name]} {name}" for name in CLASSES)
+    response = f"Swept {total} groups: {summary}.\r\n"
+    if attached:
+        response += f"The full report is attached as {filename}.\r\n"
+    else:
+        response += "Attaching the report to the ticket failed.\r\n"
+    response += (
+        "To delete groups, post a private comment starting with *delete* "
+        "followed by one group name or email address per line.")
+    shared_sd.post_comment(response, False)
+    shared_sd.transition_request_to("Waiting for Support")
+
+
+def write_batch(writer, batch, counts, known_owners):
+    """ Classify a batch of groups and write the flagged ones to the report. """
+    # Find out which owners still exist with as few searches as possible.
+    owners = {
+        dn_util.normalise(owner): owner
+        for _, attributes in batch
+        for owner in attributes.get("owner", [])
+    }
+    unknown = {
+        owner for normalised, owner in owners.items()
+        if normalised not in known_owners and ",ou=leavers," not in normalised
+    }
+    if unknown != set():
+        for entry in linaro_shared.find_matching_any(
+                [("entryDN", owner) for owner in sorted(unknown)], ["cn"]):
+            known_owners.add(dn_util.normalise(entry.entry_dn))
+
+    for _, attributes in batch:
+        classes = classify(attributes, known_owners)
+        for name in classes:
+            counts[name] += 1
+        if classes != []:
+            members = [member for member in attributes.get("uniqueMember", []) if member != ""]
+            writer.writerow([
+                first_value(attributes, "cn"),
+                first_value(attributes, "mail"),
+                " ".join(classes),
+                len(members),
+                " ".join(attributes.get("owner", []))
+            ])
+    return len(batch)
+
+
+def classify(attributes, known_owners):
+    """
+    Return the list of classifications that apply to a group, given the
+    normalised DNs of the owners known to exist.
+    """
+    classes = []
+    members = [member for member in attributes.get("uniqueMember", []) if member != ""]
+    owners = attributes.get("owner", [])
+    if members == []:
+        classes.append("empty")
+    if owners == []:
+        classes.append("ownerless")
+    elif [dn_util.normalise(owner) for owner in owners] == [dn_util.normalise(IT_BOT)]:
+        classes.append("bot-owned")
+    if any(dn_util.normalise(owner) not in known_owners for owner in owners):
+        classes.append("orphan-owner")
+    return classes
+
+
+def first_value(attributes, name):
+    """ Return the first value of an attribute or an empty string. """
+    values = attributes.get(name, [])
+    if isinstance(values, str):
+        return values
+    return values[0] if values else ""
+
+
+def bulk_delete(groups):
+    """ Delete the listed groups, if they are still empty, with a single sync. """
+    rows = []
+    deleted = 0
+    for group in groups:
+        group = linaro_shared.cleanup_if_markdown(group.strip()).lower()
+        if group == "":
+            continue
+        _, result = shared_ldap.find_group(group, ["uniqueMember"])
+        if result is None or len(result) != 1:
+            rows.append([group, "Cannot find exactly one group with this name."])
+        elif len(dn_util.MemberSet(result[0].uniqueMember.values)) != 0:
+            rows.append([group, "Not deleted because the group has members."])
+        else:
+            count, response, _ = delete_ldap_group.remove_group(result[0].entry_dn)
+            deleted += count
+            rows.append([group, (response + f"{count} of 2 objects deleted.").replace("\r\n", " ")])
+    if deleted != 0:
+        linaro_shared.trigger_google_sync()
+    if rows == []:
+        shared_sd.post_comment("No groups were listed after the delete command.", False)
+    else:
+        shared_sd.post_comment(
+            linaro_shared.results_table(["Group", "Result"], rows), False)
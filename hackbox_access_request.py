@@ -3,6 +3,11 @@
 import shared.shared_ldap as shared_ldap
 import shared.shared_sd as shared_sd
 
+import directory_replica
+import instrumentation
+import membership_sketch
+import profiler
+
 CAPABILITIES = [
     "CREATE",
     "COMMENT"
@@ -11,22 +16,28 @@ CAPABILITIES = [
 SAVE_TICKET_DATA = False
 
 
+@instrumentation.instrumented
 def comment(ticket_data):
     """ Comment handler """
-    last_comment, keyword = shared_sd.central_comment_handler([], ["help", "retry"])
+    last_comment, keyword = shared_sd.central_comment_handler([], ["help", "retry", "profile"])
 
     if keyword == "help":
         shared_sd.post_comment("All bot commands must be internal comments and the first "
                                "word/phrase in the comment.\r\n\r\n"
                                "Valid commands are:\r\n"
                                "* retry to ask the bot to process the request again after "
-                               "problems with the request have been resolved.",
+                               "problems with the request have been resolved.\r\n"
+                               "* profile to run the request again without making any "
+                               "changes and attach a performance profile.",
                                False)
     elif keyword == "retry":
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
     elif last_comment is not None and last_comment['public']:
         shared_sd.deassign_ticket_if_appropriate(last_comment)
 
+@instrumentation.instrumented
 def create(ticket_data):
     """ Create handler. """
     # There aren't any fields in the form for us to process. This
@@ -34,9 +45,9 @@ def create(ticket_data):
     # staff and then adding them to the group that controls SSH access
     # to the system.
     email_address = shared_sd.reporter_email_address(ticket_data)
-    account_dn = shared_ldap.find_from_email(email_address)
-    valid_account = shared_ldap.is_dn_in_group("employees", account_dn) or \
-        shared_ldap.is_dn_in_group("assignees", account_dn)
+    account_dn = directory_replica.find_from_email(email_address)
+    valid_account = membership_sketch.is_dn_in_group("employees", account_dn) or \
+        membership_sketch.is_dn_in_group("assignees", account_dn)
     if not valid_account:
         shared_sd.post_comment(
             "You must be a Linaro employee or assignee to use the "
@@ -44,13 +55,14 @@ def create(ticket_data):
             True)
         shared_sd.resolve_ticket(resolution_state="Won't Do")
         return
-    if shared_ldap.is_dn_in_group("hackbox-users", account_dn):
+    if membership_sketch.is_dn_in_group("hackbox-users", account_dn):
         shared_sd.post_comment(
             "You appear to already have access.",
             True)
         shared_sd.resolve_ticket()
         return
     if shared_ldap.add_to_group("hackbox-users", account_dn):
+        directory_replica.refresh_group("hackbox-users", account_dn)
         shared_sd.post_comment(
             "Access has been granted. Please ensure you read "
             "https://collaborate.linaro.org/display/IKB/Hackbox2 "
@@ -0,0 +1,160 @@
+"""
+A small persistent store used to spot webhook deliveries that have already
+been processed.
+
+Jira redelivers webhooks that it thinks have failed and agents sometimes
+post the same bot command twice. Handler entry points decorated with
+@deduplicated skip deliveries that have already been processed so that the
+LDAP reads, writes and Google syncs are not repeated.
+
+A delivery is identified by the ticket, the event and the ticket's
+"updated" timestamp, which changes whenever a comment is posted or the
+ticket transitions but is the same in a redelivered webhook. A delivery is
+recorded as in progress while the handler runs and only as done once the
+handler has returned. If the handler raises an exception the record is
+removed, so that Jira's redelivery is processed again. A delivery left in
+progress for longer than IN_PROGRESS_TIMEOUT (because the process died) is
+also processed again. Entries are dropped after TTL seconds and the store
+never holds more than MAX_ENTRIES.
+"""
+
+import contextlib
+import functools
+import sqlite3
+import time
+
+from shared import shared_sd
+
+import local_state
+
+DATABASE_FILE = "idempotency.sqlite"
+TTL = 24 * 60 * 60
+MAX_ENTRIES = 20000
+# Repeated bot commands within this many seconds are treated as duplicates.
+COMMAND_WINDOW = 60
+# A delivery still marked as in progress after this long is assumed to have
+# been abandoned.
+IN_PROGRESS_TIMEOUT = 10 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    key TEXT PRIMARY KEY,
+    seen REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS deliveries_by_age ON deliveries (seen);
+"""
+
+# The keys recorded by each decorated call that is running, innermost last.
+# A "retry" comment calls create, so these can be nested.
+PENDING = []
+
+
+@contextlib.contextmanager
+def database():
+    """ Open the store, creating the table if needed. """
+    connection = sqlite3.connect(local_state.state_path(DATABASE_FILE), timeout=30)
+    try:
+        connection.executescript(SCHEMA)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def deduplicated(function):
+    """
+    Decorator for handler entry points. The event is the name of the
+    function followed by any string arguments (e.g. "transition:In
+    Progress") and the ticket is the argument holding the ticket data. Place
+    it below @instrumentation.instrumented.
+    """
+    @functools.wraps(function)
+    def wrapper(*args):
+        ticket_data = next(arg for arg in args if isinstance(arg, dict) and "key" in arg)
+        event = ":".join(
+            [function.__name__] + [arg for arg in args if isinstance(arg, str)])
+        PENDING.append([])
+        succeeded = False
+        try:
+            if is_duplicate(ticket_data, event):
+                succeeded = True
+                return None
+            result = function(*args)
+            succeeded = True
+            return result
+        finally:
+            finish(PENDING.pop(), succeeded)
+    return wrapper
+
+
+def is_duplicate(ticket_data, event):
+    """
+    Record this delivery as in progress and return True if exactly the same
+    delivery has already been processed or is being processed.
+    """
+    updated = ticket_data.get("fields", {}).get("updated")
+    if updated is None:
+        # Without a timestamp there's no way to tell deliveries apart.
+        return False
+    return check_and_record(f"{ticket_data['key']}:{event}:{updated}", None)
+
+
+def is_repeated_command(ticket_data, keyword):
+    """
+    Record a bot command and return True if the same command was posted on
+    the same ticket within the last COMMAND_WINDOW seconds, in which case a
+    private comment says that it has been ignored.
+    """
+    if not check_and_record(f"{ticket_data['key']}:command:{keyword}", COMMAND_WINDOW):
+        return False
+    shared_sd.post_comment(
+        f"The {keyword} command has been ignored because the same command was "
+        f"posted less than {COMMAND_WINDOW} seconds ago.", False)
+    return True
+
+
+def check_and_record(key, window):
+    """
+    Record the key as in progress now and report whether it had been seen
+    before, optionally only counting sightings within the last `window`
+    seconds. The key is marked as done, or removed, when the decorated call
+    that recorded it finishes.
+    """
+    now = time.time()
+    with database() as connection:
+        connection.execute("DELETE FROM deliveries WHERE seen < ?", (now - TTL,))
+        row = connection.execute(
+            "SELECT seen, done FROM deliveries WHERE key = ?", (key,)).fetchone()
+        duplicate = row is not None and (window is None or now - row[0] < window)
+        if duplicate and not row[1] and now - row[0] >= IN_PROGRESS_TIMEOUT:
+            print(f"idempotency: {key} was abandoned, processing it again")
+            duplicate = False
+        if not duplicate:
+            connection.execute(
+                "INSERT OR REPLACE INTO deliveries (key, seen, done) VALUES (?, ?, 0)",
+                (key, now))
+        connection.execute(
+            "DELETE FROM deliveries WHERE key IN "
+            "(SELECT key FROM deliveries ORDER BY seen DESC LIMIT -1 OFFSET ?)",
+            (MAX_ENTRIES,))
+    if duplicate:
+        print(f"idempotency: skipping duplicate delivery {key}")
+    elif PENDING:
+        PENDING[-1].append(key)
+    return duplicate
+
+
+def finish(keys, succeeded):
+    """
+    Mark the keys recorded by a call as done if it succeeded, otherwise
+    forget them so that the delivery or command can be tried again.
+    """
+    if keys == []:
+        return
+    with database() as connection:
+        for key in keys:
+            if succeeded:
+                connection.execute("UPDATE deliveries SET done = 1 WHERE key = ?", (key,))
+            else:
+                connection.execute("DELETE FROM deliveries WHERE key = ?", (key,))
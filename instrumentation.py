@@ -0,0 +1,237 @@
+"""
+Per-invocation instrumentation of the remote calls made by handlers.
+
+When "instrumentation" is set to true in the configuration, the public
+functions in shared_ldap, shared_sd, shared_google and shared_vault, SSH
+connections made through linaro_shared.ssh and HTTP requests made with
+requests are wrapped so that the number of calls and the time spent in
+them are recorded. Handler entry points decorated with @instrumented then
+print one JSON line per webhook, prefixed with "instrumentation:", giving
+the totals for each type of call and the slowest individual calls.
+
+Only the outermost call is counted, so an LDAP search made inside a
+shared_ldap function or an HTTP request made by shared_sd is attributed
+to the function that the handler called. Blocks of handler code can be
+timed as if they were a call with:
+
+    with instrumentation.timed("name"):
+        ...
+
+The same measurements feed the Prometheus metrics in the metrics module
+when "metrics_port" is configured, with or without the JSON lines.
+"""
+
+import contextlib
+import functools
+import heapq
+import inspect
+import json
+import threading
+import time
+
+import requests
+import shared.globals
+from shared import shared_google, shared_ldap, shared_sd, shared_vault
+
+import linaro_shared
+import metrics
+
+# The modules whose public functions are wrapped, and the prefix used for
+# their calls in the output.
+WRAPPED_MODULES = {
+    "ldap": shared_ldap,
+    "sd": shared_sd,
+    "google": shared_google,
+    "vault": shared_vault
+}
+# How many of the slowest calls are included in the output.
+SLOWEST = 5
+# Longest call detail (usually the first argument) that is kept.
+DETAIL_LENGTH = 80
+
+INSTALLED = False
+INSTALL_LOCK = threading.Lock()
+# Handlers deal with one ticket at a time (the framework keeps the ticket in
+# module globals) so there is only ever one invocation being recorded, but
+# calls can come from the threads used by linaro_shared.run_concurrently.
+CURRENT = None
+CURRENT_LOCK = threading.Lock()
+NESTING = threading.local()
+
+
+class Invocation:
+    """ The calls made while running one handler entry point. """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.totals = {}
+        self.slowest = []
+
+    def add(self, name, duration, detail):
+        """ Record one call. """
+        with CURRENT_LOCK:
+            total = self.totals.setdefault(name, {"count": 0, "seconds": 0.0, "max": 0.0})
+            total["count"] += 1
+            total["seconds"] += duration
+            total["max"] = max(total["max"], duration)
+            call = (duration, name, detail)
+            if len(self.slowest) < SLOWEST:
+                heapq.heappush(self.slowest, call)
+            else:
+                heapq.heappushpop(self.slowest, call)
+
+    def summary(self, outcome):
+        """ Return the record that is printed for the invocation. """
+        ticket = getattr(shared.globals, "TICKET_DATA", None) or {}
+        return {
+            "handler": self.handler,
+            "ticket": ticket.get("key"),
+            "outcome": outcome,
+            "seconds": round(time.perf_counter() - self.started, 4),
+            "calls": sum(total["count"] for total in self.totals.values()),
+            "totals": {
+                name: {
+                    "count": total["count"],
+                    "seconds": round(total["seconds"], 4),
+                    "max": round(total["max"], 4)
+                }
+                for name, total in sorted(self.totals.items())
+            },
+            "slowest": [
+                {"call": name, "seconds": round(duration, 4), "detail": detail}
+                for duration, name, detail in sorted(self.slowest, reverse=True)
+            ]
+        }
+
+
+def enabled():
+    """ Is instrumentation turned on? """
+    configuration = getattr(shared.globals, "CONFIGURATION", None) or {}
+    return bool(configuration.get("instrumentation", False))
+
+
+def describe(args):
+    """ Return a short description of a call from its first argument. """
+    if not args or not isinstance(args[0], (str, int)):
+        return None
+    return str(args[0])[:DETAIL_LENGTH]
+
+
+def record(name, function, args, kwargs, detail=None):
+    """ Call the function, recording it against the current invocation. """
+    invocation = CURRENT
+    depth = getattr(NESTING, "depth", 0)
+    if invocation is None or depth > 0:
+        return function(*args, **kwargs)
+    NESTING.depth = depth + 1
+    started = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        NESTING.depth = depth
+        duration = time.perf_counter() - started
+        detail = detail or describe(args)
+        invocation.add(name, duration, detail)
+        metrics.observe_call(name, duration, detail)
+
+
+def wrap(name, function):
+    """ Return an instrumented version of a function. """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return record(name, function, args, kwargs)
+    wrapper.instrumented = True
+    return wrapper
+
+
+def http_detail(args, kwargs):
+    """ Describe an HTTP request as "METHOD url" (args exclude the session). """
+    method = args[0] if args else kwargs.get("method", "")
+    url = args[1] if len(args) > 1 else kwargs.get("url", "")
+    return f"{str(method).upper()} {url}"[:DETAIL_LENGTH]
+
+
+def install():
+    """ Wrap the remote calls. This is only done once per process. """
+    global INSTALLED  # pylint: disable=global-statement
+    with INSTALL_LOCK:
+        if INSTALLED:
+            return
+        for prefix, module in WRAPPED_MODULES.items():
+            for attribute, value in list(vars(module).items()):
+                if (attribute.startswith("_") or
+                        not inspect.isfunction(value) or
+                        value.__module__ != module.__name__ or
+                        getattr(value, "instrumented", False)):
+                    continue
+                setattr(module, attribute, wrap(f"{prefix}.{attribute}", value))
+        linaro_shared.ssh = wrap("ssh", linaro_shared.ssh)
+        session_request = requests.Session.request
+
+        @functools.wraps(session_request)
+        def request(session, *args, **kwargs):
+            method = str(args[0] if args else kwargs.get("method", "")).upper()
+            return record(
+                f"http.{method}", session_request, (session,) + args, kwargs,
+                http_detail(args, kwargs))
+        requests.Session.request = request
+        INSTALLED = True
+
+
+@contextlib.contextmanager
+def recording(handler):
+    """ Record the calls made inside the block, yielding the Invocation. """
+    global CURRENT  # pylint: disable=global-statement
+    install()
+    invocation = Invocation(handler)
+    CURRENT = invocation
+    try:
+        yield invocation
+    finally:
+        CURRENT = None
+
+
+@contextlib.contextmanager
+def timed(name):
+    """ Record a block of code as a single call. """
+    invocation = CURRENT
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if invocation is not None:
+            invocation.add(name, time.perf_counter() - started, None)
+
+
+def instrumented(function):
+    """
+    Decorator for handler entry points. When instrumentation is enabled, the
+    remote calls made by the entry point are recorded and a summary line is
+    printed when it returns. Place it below @work_queue.queued so that it is
+    the queued call that gets measured rather than the enqueueing.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        log = enabled()
+        if CURRENT is not None or not (log or metrics.enabled()):
+            # Either not wanted or another entry point (e.g. "retry" calling
+            # create) is already being recorded.
+            return function(*args, **kwargs)
+        metrics.start()
+        outcome = "error"
+        with recording(f"{function.__module__}.{function.__name__}") as invocation:
+            try:
+                result = function(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                summary = invocation.summary(outcome)
+                metrics.HANDLER_DURATION.observe(
+                    summary["seconds"],
+                    module=function.__module__,
+                    event=function.__name__,
+                    outcome=outcome)
+                if log:
+                    print(f"instrumentation: {json.dumps(summary)}")
+    return wrapper
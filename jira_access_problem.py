@@ -8,6 +8,10 @@
 import shared.globals
 from shared import custom_fields, shared_ldap, shared_sd
 
+import instrumentation
+import membership_sketch
+
+@instrumentation.instrumented
 def create(ticket_data):
     """ React to the ticket being created """
     # Is this for the reporter or someone else?
@@ -35,9 +39,7 @@ def create(ticket_data):
             "Please submit a new ticket with a person's email address.", True)
         shared_sd.resolve_ticket()
     # Does this account have access to JIRA?
-    jira_access = shared_ldap.get_group_membership(
-        "cn=jira-users,ou=mailing,ou=groups,dc=linaro,dc=org")
-    if person_dn not in jira_access:
+    if not membership_sketch.is_dn_in_group("jira-users", person_dn):
         shared_sd.post_comment(
             f"{person} hasn't been granted access to JIRA.\r\n"
             "Please go to https://linaro-servicedesk.atlassian.net/servicedesk/customer/portal/32/group/116/create/551 "
@@ -3,7 +3,14 @@
 import shared.globals
 from shared import custom_fields, shared_ldap, shared_sd
 
+import directory_replica
+import dn_util
+import idempotency
+import instrumentation
 import linaro_shared
+import membership_sketch
+import profiler
+import work_queue
 
 CAPABILITIES = [
     "CREATE",
@@ -11,14 +18,20 @@ CAPABILITIES = [
     "TRANSITION"
 ]
 
+@work_queue.queued
+@instrumentation.instrumented
+@idempotency.deduplicated
 def comment(ticket_data):
     """Triggered when a comment is posted."""
-    this_comment, keyword = shared_sd.central_comment_handler([], ["help", "retry", "ignorequota"])
+    this_comment, keyword = shared_sd.central_comment_handler(
+        [], ["help", "retry", "ignorequota", "profile"])
 
     if keyword == "ignorequota":
         shared_sd.transition_request_to("Open")
         create(ticket_data, False)
     elif keyword == "retry":
+        if idempotency.is_repeated_command(ticket_data, keyword):
+            return
         # If the ticket has already been approved, the retry comment triggers granting of access.
         if shared_sd.get_current_status() == "In Progress":
             grant_jira_access()
@@ -26,6 +39,8 @@ def comment(ticket_data):
         # Otherwise, try starting afresh ... note that the workflow might not allow this!
         shared_sd.transition_request_to("Open")
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
     elif this_comment is None or keyword is None or keyword == "help":
         shared_sd.post_comment(
             ("All bot commands must be internal comments and the "
@@ -34,13 +49,17 @@ def comment(ticket_data):
              "* ignorequota to allow the user to be granted access "
              "regardless of quota limits)\r\n"
              "* retry to ask the bot to process the request again after issues "
-             "have been resolved."),
+             "have been resolved.\r\n"
+             "* profile to run the request again without making any changes "
+             "and attach a performance profile."),
             False)
     elif this_comment['public'] and \
             shared_sd.user_is_bot(this_comment['author']) and \
             shared_sd.get_current_status() != "Resolved":
         shared_sd.deassign_ticket_if_appropriate(this_comment)
 
+@work_queue.queued
+@instrumentation.instrumented
 def create(ticket_data, check_quota=True):
     """Triggered when a new JIRA access request issue is created."""
     cf_email_address = custom_fields.get("Email Address")
@@ -76,7 +95,7 @@ def create(ticket_data, check_quota=True):
 
     # Do they already have access?
     for grp in person.memberOf:
-        grp_name = grp.split(',', 1)[0].split('=')[1]
+        grp_name = dn_util.parse(grp).value
         if grp_name.startswith("jira-comment-") or grp_name.startswith("jira-approval-"):
             shared_sd.post_comment(
                 "It looks like this person already has access to JIRA. "
@@ -100,12 +119,13 @@ def create(ticket_data, check_quota=True):
 
     # Check the OU that this account exists in.
     person_dn = person.entry_dn
-    person_ou = person_dn.split(',', 1)[1]
+    person_ou = dn_util.parse(person_dn).parent
     if person_ou == "ou=staff,ou=accounts,dc=linaro,dc=org":
         # Contractors don't get access automatically so check for them first.
         if person.employeeType.value is not None and person.employeeType.value == "Contractor":
             # Add them to jira-linaro-users
             shared_ldap.add_member_to_group("jira-linaro-users", person_dn)
+            directory_replica.refresh_group("jira-linaro-users", person_dn)
             linaro_shared.trigger_google_sync()
             shared_sd.post_comment(
                 f"Access to JIRA has been granted for {email_address}. "
@@ -122,7 +142,7 @@ def create(ticket_data, check_quota=True):
         return
 
     # See if there is an approval group for this OU/company
-    company = person_ou.split(',', 1)[0].split('=')[1]
+    company = person_ou.value
     grp_result = shared_ldap.find_matching_objects(
         f"(cn=jira-approval-{company})",
         ["cn", "uniqueMember"],
@@ -174,7 +194,7 @@ def create(ticket_data, check_quota=True):
     # Check that we've got SC members for this company that can approve the request!
     # There must always be at least one uniqueMember - the empty one - so if we only
     # have one, it is that one.
-    if len(grp_result[0].uniqueMember.values) == 1 and grp_result[0].uniqueMember[0] == '':
+    if len(dn_util.MemberSet(grp_result[0].uniqueMember.values)) == 0:
         shared_sd.post_comment(
             "Sorry but there don't appear to be any Steering Committee members for the company "
             f"'{company}' so cannot get approval for this request. IT Services will need to "
@@ -190,9 +210,11 @@ def create(ticket_data, check_quota=True):
     shared_sd.assign_approvers(grp_result[0].uniqueMember.values, custom_field=cf_approvers)
     shared_sd.transition_request_to("Needs approval")
 
+@work_queue.queued
+@instrumentation.instrumented
+@idempotency.deduplicated
 def transition(status_to, ticket_data):
     """ Handle change of ticket status """
-    _ = ticket_data # keep linter happy
     # If the status is "In Progress", trigger the membership change.
     # This status can only be reached from Open or Needs Approval.
     if status_to == "In Progress":
@@ -205,7 +227,7 @@ def grant_jira_access():
     if email_address is not None:
         email_address = email_address.strip().lower()
 
-    user_dn = shared_ldap.find_single_object_from_email(email_address)
+    user_dn = directory_replica.find_single_object_from_email(email_address)
     if user_dn is None:
         shared_sd.post_comment(
             f"It has not been possible to find {email_address} in Linaro Login.",
@@ -214,8 +236,7 @@ def grant_jira_access():
         shared_sd.resolve_ticket("Won't Do")
         return
 
-    user_ou = user_dn.split(',', 1)[1]
-    company = user_ou.split(',', 1)[0].split('=')[1]
+    company = dn_util.parse(user_dn).ou
     if company in ["the-rest", "external-community"]:
         # For non-members, put them in the jira-users group
         company_dn = "jira-users"
@@ -231,12 +252,13 @@ def grant_jira_access():
             company_dn = member_result[0].cn.value
 
     # It shouldn't be possible for multiple approvals to happen but be cautious anyway.
-    if shared_ldap.is_user_in_group(company_dn, email_address):
+    if membership_sketch.is_user_in_group(company_dn, email_address):
         shared_sd.post_comment(
             f"Thank you for the additional approval; {email_address} has already been "
             "granted access to JIRA.", True)
     else:
         shared_ldap.add_member_to_group(company_dn, user_dn)
+        directory_replica.refresh_group(company_dn, user_dn)
         linaro_shared.trigger_google_sync()
         shared_sd.post_comment(
             f"Access to JIRA has been granted for {email_address}. Please note it may take "
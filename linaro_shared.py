@@ -11,12 +11,31 @@ import io
 import random
 import re
 import select
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import paramiko
+import requests
 import shared.globals
+from ldap3.utils.conv import escape_filter_chars
 from shared import custom_fields, shared_ldap, shared_sd, shared_vault
 
+import directory_replica
+import entry_cache
+import metrics
+
 MAILTO = "mailto:"
+# How many (attribute=value) clauses go into a single OR filter when
+# batching LDAP lookups.
+LDAP_FILTER_BATCH = 50
+# The OU for a domain rarely changes so the lookups are cached for an hour.
+OU_CACHE_TTL = 3600
+OU_CACHE = {}
+# Comment authors' email addresses and whether they are in IT Services are
+# cached for this long (in seconds) when checking public comments.
+COMMENT_CACHE_TTL = 15 * 60
+COMMENT_AUTHORS = {}
+ITS_MEMBERS = {}
 
 HOST_KEYS = {
     "login-us-east-1.linaro.org": (
@@ -26,8 +45,15 @@ HOST_KEYS = {
         "TkyRA+atYxYZHVEdvuwkGoCtpX4YXGov5VsqoCipEB7soYOAXtHw4gbMOj5JjTaEgjse46eW4E842mlVTxck0"
         "t6nqooQWigV8QVlMAoTu7PrtdjYnF9L1")
 }
-
-def ssh(host, user, key, timeout, command):
+# Where GCDS is triggered from.
+GCDS_HOST = "login-us-east-1.linaro.org"
+GCDS_PORT = 22
+# The most calls that run_concurrently runs at once. Callers pass lists
+# whose size comes from the ticket, and each call may open its own LDAP or
+# Service Desk connection.
+CONCURRENT_CALLS = 8
+
+def ssh(host, user, key, timeout, command, port=22):
     """ Connect to the defined SSH host. """
     # Start by converting the (private) key into a RSAKey object. Use
     # StringIO to fake a file ...
@@ -35,9 +61,12 @@ def ssh(host, user, key, timeout, command):
     ssh_key = paramiko.RSAKey.from_private_key(keyfile)
     host_key = paramiko.RSAKey(data=base64.b64decode(HOST_KEYS[host]))
     client = paramiko.SSHClient()
-    client.get_host_keys().add(host, "ssh-rsa", host_key)
+    # Host keys for servers on other ports are recorded as [host]:port.
+    known_as = host if port == 22 else f"[{host}]:{port}"
+    client.get_host_keys().add(known_as, "ssh-rsa", host_key)
     print(f"Connecting to {host} to send command '{command}'")
-    client.connect(host, username=user, pkey=ssh_key, allow_agent=False, look_for_keys=False)
+    client.connect(
+        host, port=port, username=user, pkey=ssh_key, allow_agent=False, look_for_keys=False)
     stdout, stderr, result_code = exec_command(client, command, timeout)
     client.close()
     return (stdout, stderr, result_code)
@@ -103,10 +132,14 @@ def exec_command(ssh_client, command, timeout):
 
 
 def trigger_google_sync(level=""):
-    """Connect to Linaro Login over SSH to trigger GCDS."""
+    """
+    Connect to Linaro Login over SSH to trigger GCDS. Returns True if the
+    sync was triggered.
+    """
     pem = shared_vault.get_secret("secret/misc/it-support-bot.pem")
     stdout_data, stderr_data, status_code = ssh(
-        "login-us-east-1.linaro.org", "it-support-bot", pem, 100, level)
+        GCDS_HOST, "it-support-bot", pem, 100, level, GCDS_PORT)
+    metrics.GCDS_TRIGGERS.inc(result="ok" if status_code == 0 else "failed")
     if status_code == 0:
         shared_sd.post_comment(
             "Synchronisation to Google triggered. It may take up to 15 "
@@ -118,6 +151,7 @@ def trigger_google_sync(level=""):
             shared_sd.post_comment(f"stdout:\r\n{stdout_data}", False)
         if stderr_data != "":
             shared_sd.post_comment(f"stderr:\r\n{stderr_data}", False)
+    return status_code == 0
 
 
 def cleanup_if_markdown(email_address):
@@ -161,17 +195,17 @@ def get_exec_from_dn(ldap_entry_dn):
 
     # Get the membership of the Exec group. Use the mailing list so that
     # we get the full DNs, thus making it easier to check.
-    _, memb_result = shared_ldap.find_group("exec", ["uniqueMember"])
+    _, memb_result = directory_replica.find_group("exec", ["uniqueMember"])
     members = memb_result[0].uniqueMember.values
 
     # Walk up the tree ...
     searching = True
     while searching:
-        result = shared_ldap.get_object(ldap_entry_dn, ["manager"])
+        result = directory_replica.get_object(ldap_entry_dn, ["manager"])
         if result is not None and result.manager.value is not None:
             ldap_entry_dn = result.manager.value
             if ldap_entry_dn in members:
-                mgr_email = shared_ldap.get_object(result.manager.value, ["mail"])
+                mgr_email = directory_replica.get_object(result.manager.value, ["mail"])
                 if mgr_email is None:
                     return None
                 return mgr_email.mail.values[0]
@@ -221,7 +255,7 @@ def get_director(dept_team):
             return None
 
         # Walk up the tree
-        result = shared_ldap.get_object(manager, ['manager', 'title', 'mail'])
+        result = directory_replica.get_object(manager, ['manager', 'title', 'mail'])
         # ... and loop
 
 
@@ -255,17 +289,179 @@ def response_split(response):
     return re.split("[\r\n, \xa0]+", response)
 
 
+def find_matching_any(clauses, attributes, base=None):
+    """
+    Find the LDAP objects that match any of the (attribute, value) clauses.
+    The clauses are batched into OR filters so that checking many values
+    only takes a handful of round trips.
+    """
+    clauses = list(clauses)
+    matches = []
+    for index in range(0, len(clauses), LDAP_FILTER_BATCH):
+        batch = clauses[index:index + LDAP_FILTER_BATCH]
+        terms = "".join(
+            f"({attribute}={escape_filter_chars(value)})" for attribute, value in batch)
+        ldap_filter = f"(|{terms})"
+        if base is None:
+            result = shared_ldap.find_matching_objects(ldap_filter, attributes)
+        else:
+            result = shared_ldap.find_matching_objects(ldap_filter, attributes, base=base)
+        if result is not None:
+            matches.extend(result)
+    return matches
+
+
+def find_best_ou_for_email(email_address):
+    """
+    Cached version of shared_ldap.find_best_ou_for_email. The best OU only
+    depends on the domain so the cache is keyed on that.
+    """
+    domain = email_address.lower().split("@")[-1]
+    cached = OU_CACHE.get(domain)
+    if cached is not None and time.monotonic() - cached[0] < OU_CACHE_TTL:
+        return cached[1]
+    org_unit = shared_ldap.find_best_ou_for_email(email_address)
+    OU_CACHE[domain] = (time.monotonic(), org_unit)
+    return org_unit
+
+
+def run_concurrently(calls, deadline):
+    """
+    Run independent calls at the same time. The calls are a dict mapping a
+    name onto a (function, args) tuple. Returns a dict of the results keyed
+    by the same names or None if they did not all finish within the deadline
+    (in seconds). Exceptions raised by the calls are passed on to the caller.
+    No more than CONCURRENT_CALLS run at once.
+    """
+    pool = ThreadPoolExecutor(max_workers=max(min(len(calls), CONCURRENT_CALLS), 1))
+    futures = {
+        name: pool.submit(function, *args)
+        for name, (function, args) in calls.items()
+    }
+    _, not_done = wait(futures.values(), timeout=deadline)
+    # Don't hang around for anything that has overrun the deadline, and
+    # don't start the calls that are still waiting for a thread.
+    pool.shutdown(wait=False, cancel_futures=True)
+    if not_done:
+        return None
+    return {name: future.result() for name, future in futures.items()}
+
+
+def attach_file(filename, file_object):
+    """ Attach a file to the ticket currently being processed. """
+    issue_self = shared.globals.TICKET_DATA["self"]
+    base_url = issue_self.split("/rest/")[0]
+    key = shared.globals.TICKET_DATA["key"]
+    result = requests.post(
+        f"{base_url}/rest/api/2/issue/{key}/attachments",
+        auth=(
+            shared.globals.CONFIGURATION["bot_name"],
+            shared.globals.CONFIGURATION["bot_password"]),
+        headers={"X-Atlassian-Token": "no-check"},
+        files={"file": (filename, file_object)},
+        timeout=120)
+    print(f"attach_file: got {result.status_code} after attaching {filename} to {key}")
+    return result.status_code == 200
+
+
+def get_csv_attachment(ticket_data):
+    """ Return the first CSV file attached to the ticket, if there is one. """
+    attachments = ticket_data["fields"].get("attachment")
+    if attachments is None:
+        return None
+    for attachment in attachments:
+        if attachment["filename"].lower().endswith(".csv"):
+            return attachment
+    return None
+
+
+def read_attachment(attachment):
+    """ Download a ticket attachment and return it as text. """
+    result = shared_sd.service_desk_request_get(attachment["content"])
+    if result.status_code != 200:
+        print(f"read_attachment: got {result.status_code} for {attachment['content']}")
+        return None
+    # Spreadsheet exports often start with a byte order mark.
+    return result.content.decode("utf-8-sig")
+
+
+def results_table(headings, rows):
+    """ Format rows of results as a Jira table. """
+    table = "||" + "||".join(headings) + "||\r\n"
+    for row in rows:
+        # An empty cell or a pipe character would break the table markup.
+        cells = [str(cell).replace("|", "/") if cell not in (None, "") else " " for cell in row]
+        table += "|" + "|".join(cells) + "|\r\n"
+    return table
+
+
+def comment_is_internal(comment):
+    """ Is the comment only visible to agents? """
+    return not comment["public"]
+
+
+def ticket_is_resolved(_):
+    """
+    Has the ticket been resolved? The webhook's ticket data has the status
+    at the time of the comment, so the Service Desk is only asked if it is
+    missing, and then only once per ticket.
+    """
+    status = (shared.globals.TICKET_DATA or {}).get("fields", {}).get("status")
+    if status is not None and "name" in status:
+        return status["name"] == "Resolved"
+    return entry_cache.remember("status", shared_sd.get_current_status) == "Resolved"
+
+
+def comment_is_from_bot(comment):
+    """ Was the comment posted by the bot? """
+    return shared_sd.user_is_bot(comment["author"])
+
+
+def cached_lookup(cache, key, function, *args):
+    """ Return function(*args), reusing the result for COMMENT_CACHE_TTL seconds. """
+    if key is None:
+        return function(*args)
+    cached = cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < COMMENT_CACHE_TTL:
+        return cached[1]
+    result = function(*args)
+    cache[key] = (time.monotonic(), result)
+    return result
+
+
+def comment_is_from_its(comment):
+    """
+    Was the comment posted by IT Services? They could be replying to a
+    comment from a user.
+    """
+    author = comment["author"]
+    commentator = author.get("emailAddress")
+    if commentator is None:
+        commentator = cached_lookup(
+            COMMENT_AUTHORS, author.get("accountId"),
+            shared_sd.get_user_field, author, "emailAddress")
+    return cached_lookup(
+        ITS_MEMBERS, commentator, shared_ldap.is_user_in_group, "its", commentator)
+
+
+# The checks made by ok_to_process_public_comment, cheapest first. The
+# first one that matches stops the comment from being processed.
+COMMENT_CHECKS = [
+    ("internal", comment_is_internal),
+    ("resolved", ticket_is_resolved),
+    ("bot", comment_is_from_bot),
+    ("its", comment_is_from_its)
+]
+
+
 def ok_to_process_public_comment(comment):
     """ Performs common checks to make sure the comment needs to be processed """
-    if (shared_sd.get_current_status() == "Resolved" or
-            not comment['public'] or
-            shared_sd.user_is_bot(comment['author'])):
-        return False
-
-    # Ignore comments made by IT Services since they could be replying to
-    # a comment from a user.
-    commentator = shared_sd.get_user_field(comment["author"], "emailAddress")
-    return not shared_ldap.is_user_in_group("its", commentator)
+    for stage, check in COMMENT_CHECKS:
+        if check(comment):
+            metrics.COMMENT_CHECKS.inc(outcome=stage)
+            return False
+    metrics.COMMENT_CHECKS.inc(outcome="processed")
+    return True
 
 
 def get_dn_from_account_id(ticket_data, custom_field):
@@ -275,10 +471,12 @@ def get_dn_from_account_id(ticket_data, custom_field):
     ldap_dn = None
     if person_anonymised is not None:
         account_id = person_anonymised["accountId"]
-        person = shared_sd.find_account_from_id(account_id)
+        person = entry_cache.remember(
+            "account", shared_sd.find_account_from_id, account_id)
         if person is not None:
             person_email = person["emailAddress"]
-            ldap_dn = shared_ldap.find_single_object_from_email(person_email)
+            ldap_dn = entry_cache.remember(
+                "email", directory_replica.find_single_object_from_email, person_email)
     return ldap_dn
 
 
@@ -292,7 +490,7 @@ def check_approval_assignee_member_engineer(ticket_data):
             "Cannot find this person in Linaro Login", True)
         return
 
-    ldap_search = shared_ldap.get_object(
+    ldap_search = entry_cache.get_object(
         ldap_dn,
         ['description', 'departmentNumber', 'o', 'employeeType', 'manager'])
     if ldap_search is None:
@@ -327,7 +525,12 @@ def check_approval_assignee_member_engineer(ticket_data):
             shared_sd.set_summary(f"{summary}: {name}")
 
     # Get the manager for this person
-    mgr_email = shared_ldap.get_manager_from_dn(ldap_dn)
+    mgr_email = None
+    if ldap_search.manager.value is not None:
+        manager = entry_cache.get_object(ldap_search.manager.value, ['mail'])
+        # Use the first address as the manager can have more than one.
+        if manager is not None and manager.mail.values != []:
+            mgr_email = manager.mail.values[0]
     if mgr_email is None:
         # Fall back to getting Diane to approve the ticket
         mgr_email = "diane.cheshire@linaro.org"
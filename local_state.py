@@ -0,0 +1,52 @@
+"""
+Files used to keep state between webhook calls, such as the local indexes,
+the work queue and the step journals.
+
+These are kept apart from linaro_shared so that the modules that
+linaro_shared itself uses (such as directory_replica) can store state
+without importing it.
+"""
+
+import json
+import os
+import tempfile
+
+import shared.globals
+
+
+def state_path(name):
+    """
+    Return the path for a file used to keep state between webhook calls. The
+    directory can be set with "state_directory" in the configuration.
+    """
+    directory = shared.globals.CONFIGURATION.get(
+        "state_directory",
+        os.path.join(tempfile.gettempdir(), "sd-webhook-handlers"))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+def save_state(name, data):
+    """ Atomically write JSON state so that readers never see a partial file. """
+    path = state_path(name)
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(handle, "w", encoding="utf-8") as state_file:
+        json.dump(data, state_file)
+    os.replace(temp_path, path)
+
+
+def load_state(name):
+    """ Read JSON state written by save_state, returning None if there isn't any. """
+    try:
+        with open(state_path(name), "r", encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def delete_state(name):
+    """ Remove state written by save_state, if there is any. """
+    try:
+        os.remove(state_path(name))
+    except FileNotFoundError:
+        pass
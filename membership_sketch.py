@@ -0,0 +1,214 @@
+"""
+Bloom filters for the membership of the largest groups.
+
+Checking whether someone is in a big group such as employees or jira-users
+is one of the most frequent questions the handlers ask. When the directory
+replica is synced, a Bloom filter is built for every mailing group with at
+least MIN_MEMBERS members. A Bloom filter can say for certain that a DN is
+not in the group, so is_dn_in_group() and is_user_in_group() only go on to
+the exact check in LDAP when the filter says the DN might be a member.
+About FALSE_POSITIVE_RATE of non-members still need the exact check.
+
+A filter can't have members removed from it, but that only means a
+removed member gets an exact check. Adding a member must not be missed,
+so directory_replica.refresh() passes the new membership of any refreshed
+group to record(). The filters are only used for as long as the replica
+itself would be trusted after the sync that built them.
+
+The filters are only used if "membership_sketch" is set to true in the
+configuration, which also needs the replica to be enabled.
+"""
+
+import base64
+import contextlib
+import fcntl
+import hashlib
+import math
+import os
+import time
+
+import shared.globals
+from shared import shared_ldap
+
+import directory_replica
+import dn_util
+import local_state
+
+SKETCH_FILE = "membership_sketch.json"
+LOCK_FILE = "membership_sketch.lock"
+# Groups smaller than this are checked exactly.
+MIN_MEMBERS = 500
+FALSE_POSITIVE_RATE = 0.01
+# Room for the group to grow between syncs before the false positive rate
+# goes up noticeably.
+HEADROOM = 1.25
+
+# In-memory copy of the filters and the modification time of the file they
+# were loaded from.
+SKETCHES = None
+SKETCHES_MTIME = None
+
+
+class BloomFilter:
+    """ A Bloom filter over normalised DNs. """
+    __slots__ = ("bits", "hashes")
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+
+    @classmethod
+    def sized_for(cls, count):
+        """ Return an empty filter sized for count members at FALSE_POSITIVE_RATE. """
+        count = max(int(count * HEADROOM), 1)
+        size = math.ceil(-count * math.log(FALSE_POSITIVE_RATE) / math.log(2) ** 2)
+        hashes = max(round(size / count * math.log(2)), 1)
+        return cls(bytearray((size + 7) // 8), hashes)
+
+    def positions(self, dn):
+        """ The bits used for a DN, by double hashing one digest. """
+        digest = hashlib.blake2b(directory_replica.normalise(dn).encode("utf-8")).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:16], "little") | 1
+        size = len(self.bits) * 8
+        return [(first + index * second) % size for index in range(self.hashes)]
+
+    def add(self, dn):
+        """ Add a DN to the filter. """
+        for position in self.positions(dn):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, dn):
+        return all(
+            self.bits[position // 8] & (1 << (position % 8)) for position in self.positions(dn))
+
+    def to_json(self):
+        """ Return the filter in the form saved to the state file. """
+        return {"hashes": self.hashes, "bits": base64.b64encode(bytes(self.bits)).decode("ascii")}
+
+    @classmethod
+    def from_json(cls, data):
+        """ Rebuild a filter saved with to_json. """
+        return cls(bytearray(base64.b64decode(data["bits"])), data["hashes"])
+
+
+def enabled():
+    """ Are the filters turned on? """
+    return (
+        bool(shared.globals.CONFIGURATION.get("membership_sketch", False)) and
+        directory_replica.enabled())
+
+
+def load():
+    """ Return the saved filters, re-reading the file if another process has changed it. """
+    global SKETCHES, SKETCHES_MTIME  # pylint: disable=global-statement
+    try:
+        mtime = os.path.getmtime(local_state.state_path(SKETCH_FILE))
+    except FileNotFoundError:
+        return None
+    if mtime != SKETCHES_MTIME:
+        data = local_state.load_state(SKETCH_FILE)
+        SKETCHES = None
+        if data is not None:
+            SKETCHES = {
+                "built": data["built"],
+                "groups": {
+                    group_cn: BloomFilter.from_json(sketch)
+                    for group_cn, sketch in data["groups"].items()
+                }
+            }
+        SKETCHES_MTIME = mtime
+    return SKETCHES
+
+
+@contextlib.contextmanager
+def locked():
+    """ Stop other processes changing the filters at the same time. """
+    with open(local_state.state_path(LOCK_FILE), "w", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def save(sketches):
+    """ Write the filters out for other processes. """
+    local_state.save_state(SKETCH_FILE, {
+        "built": sketches["built"],
+        "groups": {
+            group_cn: sketch.to_json() for group_cn, sketch in sketches["groups"].items()
+        }
+    })
+
+
+def sketch_for(group_cn):
+    """ Return the filter for a mailing group, or None if the exact check must be used. """
+    if not enabled() or group_cn is None:
+        return None
+    sketches = load()
+    if sketches is None or time.time() - sketches["built"] > directory_replica.MAX_AGE:
+        return None
+    return sketches["groups"].get(group_cn.lower())
+
+
+def is_dn_in_group(group_cn, dn):
+    """ Version of shared_ldap.is_dn_in_group that checks the filter first. """
+    sketch = sketch_for(group_cn)
+    if sketch is not None and dn is not None and dn not in sketch:
+        return False
+    return shared_ldap.is_dn_in_group(group_cn, dn)
+
+
+def is_user_in_group(group_cn, email_address):
+    """ Version of shared_ldap.is_user_in_group that checks the filter first. """
+    sketch = sketch_for(group_cn)
+    if sketch is not None and email_address is not None:
+        dn = directory_replica.find_from_email(email_address)
+        if dn is not None and dn not in sketch:
+            return False
+    return shared_ldap.is_user_in_group(group_cn, email_address)
+
+
+def build(connection):
+    """
+    Rebuild the filters from the replica database. Called by
+    directory_replica.sync() once the entries have been stored.
+    """
+    if not enabled():
+        return
+    # Hold the lock while reading the replica so that a group changed in
+    # the meantime is either read here or recorded after the save.
+    with locked():
+        members = {}
+        for ndn, nvalue in connection.execute(
+                "SELECT ndn, nvalue FROM entry_values WHERE attribute = 'uniqueMember' "
+                "AND ndn LIKE ?", ("%," + directory_replica.MAILING_BASE,)):
+            if nvalue != "":
+                members.setdefault(ndn, []).append(nvalue)
+        sketches = {"built": time.time(), "groups": {}}
+        for ndn, dns in members.items():
+            if len(dns) >= MIN_MEMBERS:
+                sketch = BloomFilter.sized_for(len(dns))
+                for dn in dns:
+                    sketch.add(dn)
+                sketches["groups"][dn_util.parse(ndn).value] = sketch
+        save(sketches)
+    print(f"membership_sketch: built filters for {len(sketches['groups'])} groups")
+
+
+def record(group_dn, members):
+    """ Add the current members of a group that has just changed to its filter. """
+    if not enabled() or not group_dn.lower().endswith("," + directory_replica.MAILING_BASE):
+        return
+    group_cn = dn_util.parse(group_dn).value.lower()
+    with locked():
+        # Reload under the lock so that another process's additions aren't lost.
+        sketches = load()
+        if sketches is None or group_cn not in sketches["groups"]:
+            return
+        sketch = sketches["groups"][group_cn]
+        for member in members:
+            if member != "":
+                sketch.add(member)
+        save(sketches)
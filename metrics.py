@@ -0,0 +1,247 @@
+"""
+An in-process registry of handler metrics, exposed in the Prometheus text
+format.
+
+When "metrics_port" is set in the configuration, the first instrumented
+handler call starts a small HTTP server on that port that serves the
+metrics at /metrics. The server only listens on localhost unless
+"metrics_address" is set. Work queue workers each serve their own metrics
+on metrics_port + 1, metrics_port + 2 and so on, because they are separate
+processes with separate registries. If the port is already in use, for
+example because the webhook is served by several processes, the server
+listens on a port chosen by the operating system instead and says which in
+the log.
+
+The metrics recorded are:
+
+* handler_duration_seconds: end-to-end time of each handler entry point,
+  by module, event (create, comment, transition, jira_hook) and outcome.
+* ldap_operations_total: calls to shared_ldap, by function.
+* ssh_duration_seconds: time taken by SSH commands, by host.
+* gcds_triggers_total: Google syncs triggered, by result.
+* queue_wait_seconds: time calls spent in the work queue, by module.
+* public_comment_checks_total: public comment checks, by the check that
+  rejected the comment or "processed".
+
+Only the standard library is used so that nothing extra needs to be
+installed to get the metrics.
+"""
+
+import errno
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import shared.globals
+
+# Histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Added to metrics_port by processes that need their own endpoint.
+PORT_OFFSET = 0
+# Where the metrics are served unless "metrics_address" is configured.
+DEFAULT_ADDRESS = "127.0.0.1"
+
+REGISTRY = {}
+REGISTRY_LOCK = threading.Lock()
+SERVER = None
+
+
+def format_labels(names, values, extra=None):
+    """ Return the {name="value",...} part of a sample line. """
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if pairs == []:
+        return ""
+    escaped = [
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    """ A count that only goes up, optionally split by labels. """
+
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        register(self)
+
+    def inc(self, amount=1, **labels):
+        """ Add to the count for the given label values. """
+        key = tuple(labels[name] for name in self.labels)
+        with REGISTRY_LOCK:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        """ Return the sample lines for the counter. """
+        return [
+            f"{self.name}{format_labels(self.labels, key)} {value}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Histogram:
+    """ Observed values counted into cumulative buckets, optionally split by labels. """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # Each value is [bucket counts..., sum, count].
+        self.values = {}
+        register(self)
+
+    def observe(self, value, **labels):
+        """ Record one observation for the given label values. """
+        key = tuple(labels[name] for name in self.labels)
+        with REGISTRY_LOCK:
+            series = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        """ Return the sample lines for the histogram. """
+        lines = []
+        for key, series in sorted(self.values.items()):
+            for index, bound in enumerate(self.buckets):
+                labels = format_labels(self.labels, key, ("le", repr(float(bound))))
+                lines.append(f"{self.name}_bucket{labels} {series[index]}")
+            labels = format_labels(self.labels, key, ("le", "+Inf"))
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+def register(metric):
+    """ Add a metric to the registry. """
+    with REGISTRY_LOCK:
+        REGISTRY[metric.name] = metric
+
+
+def render():
+    """ Return all of the metrics in the Prometheus text format. """
+    lines = []
+    with REGISTRY_LOCK:
+        for name, metric in sorted(REGISTRY.items()):
+            lines.append(f"# HELP {name} {metric.description}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+HANDLER_DURATION = Histogram(
+    "handler_duration_seconds",
+    "Time taken by handler entry points.",
+    ("module", "event", "outcome"))
+LDAP_OPERATIONS = Counter(
+    "ldap_operations_total",
+    "Calls made to shared_ldap functions.",
+    ("operation",))
+SSH_DURATION = Histogram(
+    "ssh_duration_seconds",
+    "Time taken to run commands over SSH.",
+    ("host",))
+GCDS_TRIGGERS = Counter(
+    "gcds_triggers_total",
+    "Google syncs triggered.",
+    ("result",))
+QUEUE_WAIT = Histogram(
+    "queue_wait_seconds",
+    "Time calls spent waiting in the work queue.",
+    ("module",))
+COMMENT_CHECKS = Counter(
+    "public_comment_checks_total",
+    "Outcome of checking whether a public comment needs processing.",
+    ("outcome",))
+
+
+def observe_call(name, duration, detail):
+    """ Update the metrics for a remote call recorded by the instrumentation. """
+    if name.startswith("ldap."):
+        LDAP_OPERATIONS.inc(operation=name[len("ldap."):])
+    elif name == "ssh":
+        SSH_DURATION.observe(duration, host=detail or "")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serve the registry at /metrics. """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Return the metrics. """
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """ Don't log every scrape. """
+
+
+def port():
+    """ Return the port this process should serve metrics on, or None. """
+    configuration = getattr(shared.globals, "CONFIGURATION", None) or {}
+    base = configuration.get("metrics_port")
+    if base is None:
+        return None
+    return int(base) + PORT_OFFSET
+
+
+def address():
+    """ Return the address to serve metrics on. """
+    configuration = getattr(shared.globals, "CONFIGURATION", None) or {}
+    return configuration.get("metrics_address", DEFAULT_ADDRESS)
+
+
+def enabled():
+    """ Are metrics turned on? """
+    return port() is not None
+
+
+def listen():
+    """
+    Create the server on the configured port or, if another process is
+    already using it, on a port chosen by the operating system.
+    """
+    try:
+        return ThreadingHTTPServer((address(), port()), MetricsHandler)
+    except OSError as error:
+        if error.errno != errno.EADDRINUSE:
+            raise
+        print(f"metrics: port {port()} is in use by another process, using a free port instead")
+    return ThreadingHTTPServer((address(), 0), MetricsHandler)
+
+
+def start():
+    """ Start serving the metrics, if enabled and not already started. """
+    global SERVER  # pylint: disable=global-statement
+    with REGISTRY_LOCK:
+        if SERVER is not None or not enabled():
+            return
+        try:
+            SERVER = listen()
+        except OSError as error:
+            print(f"metrics: unable to listen on {address()} port {port()}: {error}")
+            # Don't keep trying on every call.
+            SERVER = False
+            return
+    threading.Thread(target=SERVER.serve_forever, daemon=True).start()
+    listening, listening_port = SERVER.server_address[:2]
+    print(f"metrics: serving on {listening} port {listening_port}")
@@ -8,27 +8,33 @@
 
 import shared.custom_fields as custom_fields
 import shared.globals
-import shared.shared_ldap as shared_ldap
 import shared.shared_sd as shared_sd
-import linaro_shared
+import approval_chain
+import directory_replica
+import instrumentation
+import profiler
 
 CAPABILITIES = [
     "COMMENT",
     "CREATE"
 ]
 
+@instrumentation.instrumented
 def comment(ticket_data):
     """ Triggered when a comment is posted """
     _, keyword = shared_sd.central_comment_handler(
-        [], ["help", "retry"])
+        [], ["help", "retry", "profile"])
 
     if keyword == "help":
         shared_sd.post_comment(("All bot commands must be internal comments and the first word/phrase in the comment.\r\n\r\n"
                                "Valid commands are:\r\n"
-                               "* retry to ask the bot to process the request again after issues have been resolved."), False)
+                               "* retry to ask the bot to process the request again after issues have been resolved.\r\n"
+                               "* profile to run the request again without making any changes and attach a performance profile."), False)
     elif keyword == "retry":
         print("modify_staff processing retry keyword & triggering create function")
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
 
 
 def get_affected_person(ticket_data):
@@ -40,11 +46,12 @@ def get_affected_person(ticket_data):
     return who
 
 
+@instrumentation.instrumented
 def create(ticket_data):
     """Triggered when the issue is created."""
     # Who is this ticket about?
     person = get_affected_person(ticket_data)
-    person_dn = shared_ldap.find_single_object_from_email(person["emailAddress"])
+    person_dn = directory_replica.find_single_object_from_email(person["emailAddress"])
     if person_dn is None:
         # Shouldn't happen because we use a people picker
         shared_sd.post_comment(
@@ -98,22 +105,27 @@ def create(ticket_data):
     # Create an internal comment for HR that specifies all of the bits that
     # need to be done.
     post_hr_guidance(new_department, reports_to, new_mgr, ticket_data)
-    # Get their manager
-    mgr_email = shared_ldap.get_manager_from_dn(person_dn)
+    # Get their manager and Exec
+    chain = approval_chain.lookup(person_dn)
+    mgr_email = chain.manager
     if mgr_email is None:
         # Fall back to getting Diane to approve the ticket
-        mgr_email = "diane.cheshire@linaro.org"
+        mgr_email = chain.fallback
         shared_sd.post_comment(
             "Cannot find a manager for %s, defaulting to Diane." % person_dn,
             False
         )
-    # Get their Exec
-    exec_email = linaro_shared.get_exec_from_dn(person_dn)
+    exec_email = chain.exec
     # This can fail if an intermediate manager is leaving Linaro, in
     # which case find the Exec for the proposed new manager.
+    if exec_email is None and chain.leaver is not None:
+        shared_sd.post_comment(
+            "%s, in the reporting line for %s, is leaving Linaro."
+            % (chain.leaver, person_dn), False
+        )
     if exec_email is None and new_mgr is not None:
-        new_mgr_dn = shared_ldap.find_single_object_from_email(new_mgr)
-        exec_email = linaro_shared.get_exec_from_dn(new_mgr_dn)
+        new_mgr_dn = directory_replica.find_single_object_from_email(new_mgr)
+        exec_email = approval_chain.lookup(new_mgr_dn).exec
     if exec_email is not None:
         cf_approvers = custom_fields.get("Executive Approvers")
         shared_sd.assign_approvers([exec_email], cf_approvers)
@@ -4,6 +4,10 @@ import shared.globals
 import shared.shared_ldap as shared_ldap
 import shared.shared_sd as shared_sd
 
+import dn_util
+import group_expansion
+import instrumentation
+
 CAPABILITIES = [
     "CREATE"
 ]
@@ -22,6 +26,7 @@ def group_name_lower(ldap_obj):
     return ldap_obj.displayName.value.lower()
 
 
+@instrumentation.instrumented
 def create(ticket_data):
     """ Triggered when the issue is created """
     shared_sd.assign_issue_to(shared.globals.CONFIGURATION["bot_name"])
@@ -32,10 +37,13 @@ def create(ticket_data):
         "(objectClass=groupOfUniqueNames)",
         ["owner", "displayName", "cn", "uniqueMember"]
     )
+    # Owners can be groups, so let the expansion use the membership that
+    # has just been fetched rather than reading each group again.
+    group_expansion.prime(all_groups)
     owned_groups = []
     for group in all_groups:
         owners = group.owner.values
-        if shared_ldap.reporter_is_group_owner(owners):
+        if group_expansion.reporter_is_owner(owners):
             owned_groups.append(group)
     if owned_groups == []:
         shared_sd.post_comment(
@@ -61,9 +69,7 @@ def create(ticket_data):
 
 def check_if_group_has_members(group):
     """ See if this group has any members """
-    memb = group.uniqueMember.values
-    # It can't be an empty list so an empty group should
-    # just be a single empty member.
-    if memb == ['']:
+    # An empty group just has a single empty member.
+    if len(dn_util.MemberSet(group.uniqueMember.values)) == 0:
         return " (empty)"
     return ""
@@ -0,0 +1,171 @@
+"""
+Fetch the LDAP entries a handler is going to need at the start of the
+webhook, in as few searches as possible.
+
+A handler declares what it needs next to CAPABILITIES, for example:
+
+    PREFETCH = {
+        "reporter": {"reporter": True, "attributes": ["manager"]},
+        "engineer": {
+            "person": "Assignee/Member Engineer",
+            "attributes": ["employeeType", "secretary"],
+            "follow": {"secretary": ["mail"]}
+        },
+        "group": {
+            "group": "Group Email Address",
+            "attributes": ["owner"],
+            "follow": {"owner": ["displayName", "mail"]}
+        }
+    }
+
+Each entry names one object: the reporter, the person chosen in an
+account picker field ("person" gives the field name) or the mailing group
+named in a text field ("group" gives the field name, which can hold the
+group's name or email address). "attributes" are the attributes to fetch
+for it and "follow" fetches the entries that the given attributes refer
+to, with the attributes listed.
+
+context() finds all of the declared objects with a single search and the
+entries they refer to with a second one. The entries are added to the
+entry cache, so the handler's later entry_cache.get_object() calls (and
+the account lookups in linaro_shared) are answered without going back to
+LDAP, and are returned as a read-only Context.
+"""
+
+import sys
+
+import shared.globals
+from shared import custom_fields, shared_ldap, shared_sd
+
+import directory_replica
+import entry_cache
+import linaro_shared
+
+
+class Context:
+    """
+    Read-only view of the prefetched objects. Each declared name is an
+    attribute holding the entry found for it, or None if there wasn't
+    exactly one match.
+    """
+    __slots__ = ("_matches",)
+
+    def __init__(self, matches):
+        object.__setattr__(self, "_matches", matches)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name not in self._matches:
+            raise AttributeError(name)
+        matches = self._matches[name]
+        if len(matches) != 1:
+            return None
+        return matches[0]
+
+    def __setattr__(self, name, value):
+        raise AttributeError("prefetched entries can't be changed")
+
+    def matches(self, name):
+        """ Return every entry that matched the named object. """
+        return list(self._matches[name])
+
+
+def context(handler, ticket_data):
+    """
+    Return the Context for the handler module (normally passed as
+    __name__), prefetching its PREFETCH declaration the first time it is
+    asked for while handling this ticket.
+    """
+    declaration = getattr(sys.modules[handler], "PREFETCH", {})
+    return entry_cache.remember(
+        "prefetch", lambda _: Context(prefetch(declaration, ticket_data)), handler)
+
+
+def identify(name, spec, ticket_data):
+    """
+    Return the (attribute, value) clause that finds the declared object, or
+    None if the ticket doesn't say who or what it is.
+    """
+    if spec.get("reporter"):
+        return ("mail", shared.globals.REPORTER)
+    if "person" in spec:
+        person = shared_sd.get_field(ticket_data, custom_fields.get(spec["person"]))
+        if person is None:
+            return None
+        account = entry_cache.remember(
+            "account", shared_sd.find_account_from_id, person["accountId"])
+        if account is None:
+            return None
+        return ("mail", account["emailAddress"])
+    if "group" in spec:
+        group = shared_sd.get_field(ticket_data, custom_fields.get(spec["group"]))
+        if group is None:
+            return None
+        group = group.strip().lower()
+        return ("mail" if "@" in group else "cn", group)
+    raise ValueError(f"prefetch: don't know how to find '{name}'")
+
+
+def values_of(entry, attributes):
+    """ Return the entry's values for the attributes as a dict of lists. """
+    return {
+        attribute: entry[attribute].values if attribute in entry else []
+        for attribute in attributes
+    }
+
+
+def search(clauses, attributes):
+    """ Find the entries matching any of the clauses, keyed by lower case DN. """
+    found = {}
+    if clauses:
+        for entry in linaro_shared.find_matching_any(
+                sorted(set(clauses)), sorted(attributes), base=directory_replica.BASE):
+            found[entry.entry_dn.lower()] = entry
+    return found
+
+
+def prefetch(declaration, ticket_data):
+    """ Fetch the declared objects, returning the entries matched for each name. """
+    clauses = {}
+    attributes = {"mail", "cn"}
+    for name, spec in declaration.items():
+        clause = identify(name, spec, ticket_data)
+        if clause is not None:
+            clauses[name] = clause
+        attributes.update(spec.get("attributes", []))
+        attributes.update(spec.get("follow", {}))
+    found = search(clauses.values(), attributes)
+
+    matches = {}
+    followed = {}
+    for name, spec in declaration.items():
+        matches[name] = []
+        if name not in clauses:
+            continue
+        attribute, value = clauses[name]
+        for dn, entry in found.items():
+            is_group = dn.endswith("," + directory_replica.MAILING_BASE)
+            if ("group" in spec) != is_group:
+                continue
+            if value.lower() in [str(item).lower() for item in entry[attribute].values]:
+                matches[name].append(entry)
+        wanted = spec.get("attributes", []) + list(spec.get("follow", {}))
+        for entry in matches[name]:
+            entry_cache.store(entry.entry_dn, values_of(entry, wanted))
+            for reference, follow_attributes in spec.get("follow", {}).items():
+                for dn in entry[reference].values if reference in entry else []:
+                    followed.setdefault(dn, set()).update(follow_attributes)
+        if "group" not in spec and attribute == "mail" and len(matches[name]) == 1:
+            # Answers linaro_shared.get_dn_from_account_id's lookup.
+            entry_cache.store_result("email", matches[name][0].entry_dn, value)
+
+    if followed:
+        clauses = [
+            (dn.split("=", 1)[0], shared_ldap.extract_id_from_dn(dn)) for dn in followed
+        ]
+        wanted = set().union(*followed.values())
+        found = search(clauses, wanted)
+        for dn, follow_attributes in followed.items():
+            entry = found.get(dn.lower())
+            if entry is not None:
+                entry_cache.store(entry.entry_dn, values_of(entry, follow_attributes))
+    return {name: tuple(entries) for name, entries in matches.items()}
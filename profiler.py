@@ -0,0 +1,157 @@
+"""
+Profile a handler on demand without changing anything.
+
+Handlers accept a private "profile" comment that runs the handler's create
+function again under cProfile. While it runs, every function that changes
+LDAP, the ticket, Google or the local state is replaced with one that does
+nothing, so only the reads (and the handler's own processing) happen and
+are measured. The raw profile is attached to the ticket as a pstats file,
+which can be loaded with pstats or turned into a flame graph with tools
+such as snakeviz or flameprof, and the functions with the highest
+cumulative time are posted in a private comment.
+
+cProfile only sees the thread that calls create, so work done by
+linaro_shared.run_concurrently shows up as time spent waiting for it.
+"""
+
+import cProfile
+import io
+import pstats
+import tempfile
+import time
+
+import shared.email
+import shared.globals
+from shared import shared_ldap, shared_sd
+
+import directory_replica
+import idempotency
+import linaro_shared
+import step_journal
+
+# The number of functions listed in the comment.
+TOP_FUNCTIONS = 25
+# A DN for create_account to return so that handlers carry on after it.
+DRY_RUN_DN = "uid=profile.dry.run,ou=accounts,dc=linaro,dc=org"
+
+# The functions that make changes and what they return while profiling.
+# Most LDAP write functions report success with True; create_group reports
+# success with None.
+DRY_RUN = {
+    shared_ldap: {
+        "add_member_to_group": True,
+        "add_owner_to_group": True,
+        "add_to_group": True,
+        "create_account": DRY_RUN_DN,
+        "create_group": None,
+        "delete_object": True,
+        "move_object": True,
+        "remove_from_group": True,
+        "remove_from_mailing_group": True,
+        "remove_owner_from_group": True,
+        "remove_owner_from_security_group": True,
+        "replace_attribute_value": True
+    },
+    shared_sd: {
+        "add_request_participant": None,
+        "assign_approvers": None,
+        "assign_issue_to": None,
+        "deassign_ticket_if_appropriate": None,
+        "post_comment": None,
+        "resolve_ticket": None,
+        "set_customfield": None,
+        "set_summary": None,
+        "transition_request_to": None
+    },
+    shared.email: {
+        "send_email_parts": None
+    },
+    linaro_shared: {
+        "attach_file": True,
+        "ssh": ("", "", 0),
+        "trigger_google_sync": True
+    },
+    directory_replica: {
+        "forget": None,
+        "refresh": None,
+        "refresh_group": None
+    },
+    idempotency: {
+        "check_and_record": False,
+        "finish": None
+    },
+    step_journal.Journal: {
+        "finish": None,
+        "record": None
+    }
+}
+
+
+def dry_run_function(name, result, suppressed):
+    """ Return a replacement for a function that only counts the calls. """
+    def replacement(*_args, **_kwargs):
+        suppressed[name] = suppressed.get(name, 0) + 1
+        return result
+    return replacement
+
+
+def patch_writes(suppressed):
+    """ Replace the write functions, returning what is needed to put them back. """
+    originals = []
+    for owner, functions in DRY_RUN.items():
+        for name, result in functions.items():
+            if not hasattr(owner, name):
+                continue
+            originals.append((owner, name, getattr(owner, name)))
+            setattr(owner, name, dry_run_function(
+                f"{owner.__name__}.{name}", result, suppressed))
+    return originals
+
+
+def restore(originals):
+    """ Put back the functions replaced by patch_writes. """
+    for owner, name, function in originals:
+        setattr(owner, name, function)
+
+
+def profile(create, ticket_data):
+    """
+    Run the create function under cProfile without making any changes, then
+    attach the profile and summarise it in a private comment.
+    """
+    profiler = cProfile.Profile()
+    suppressed = {}
+    error = None
+    originals = patch_writes(suppressed)
+    started = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            create(ticket_data)
+        finally:
+            profiler.disable()
+    except Exception as caught:  # pylint: disable=broad-except
+        error = caught
+    finally:
+        elapsed = time.perf_counter() - started
+        restore(originals)
+
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+    with tempfile.NamedTemporaryFile(suffix=".pstats") as dump:
+        stats.dump_stats(dump.name)
+        dump.seek(0)
+        attached = linaro_shared.attach_file(f"profile-{ticket_data['key']}.pstats", dump)
+
+    reply = f"Profiled a dry run of {create.__module__}.create in {elapsed:.2f} seconds.\r\n"
+    if error is not None:
+        reply += f"The dry run stopped with an error: {error!r}\r\n"
+    if suppressed:
+        reply += "Changes that were skipped:\r\n"
+        for name, count in sorted(suppressed.items()):
+            reply += f"* {name} x {count}\r\n"
+    if not attached:
+        reply += "The profile could not be attached to the ticket.\r\n"
+    reply += f"{{noformat}}{output.getvalue()}{{noformat}}"
+    shared_sd.post_comment(reply, False)
@@ -0,0 +1,62 @@
+"""
+A per-ticket journal of the steps that a handler has completed.
+
+When a handler hits a problem part way through, IT Services fix it and
+post "retry", which runs the handler's create function again. Without a
+record of what has already been done, everything is repeated: expensive
+checks, account changes, Google syncs and emails, some of which then fail
+because the earlier attempt already made the change.
+
+Handlers record each completed step in the journal and skip steps that
+are already recorded, so a retry picks up from the first step that
+failed. Once the handler has finished, it calls finish() to remove the
+journal so that any later retry starts from scratch.
+"""
+
+import local_state
+
+
+class Journal:
+    """ The completed steps for one ticket. """
+
+    def __init__(self, ticket_key):
+        self.name = f"journal-{ticket_key}.json"
+        self.steps = local_state.load_state(self.name) or {}
+
+    def done(self, step):
+        """ Has this step already been completed? """
+        return step in self.steps
+
+    def result(self, step):
+        """ Return the value recorded when the step was completed. """
+        return self.steps.get(step)
+
+    def record(self, step, result=None):
+        """ Record that a step has been completed, with an optional JSON-able result. """
+        self.steps[step] = result
+        local_state.save_state(self.name, self.steps)
+
+    def run(self, step, function, *args):
+        """
+        Call the function unless the step has already been completed, in
+        which case the previously recorded result is returned instead. A
+        function that returns False has failed, so the step isn't recorded
+        and is tried again by the next retry.
+        """
+        if self.done(step):
+            print(f"step_journal: skipping completed step {step}")
+            return self.result(step)
+        result = function(*args)
+        if result is not False:
+            self.record(step, result)
+        return result
+
+    def finish(self):
+        """ All of the steps are complete so the journal is no longer needed. """
+        self.steps = {}
+        local_state.delete_state(self.name)
+
+
+def journal(ticket_data):
+    """ Return the journal for the ticket. """
+    return Journal(ticket_data["key"])
@@ -19,6 +19,13 @@ import shared.custom_fields as custom_fields
 import shared.shared_ldap as shared_ldap
 import shared.shared_sd as shared_sd
 
+import directory_replica
+import dn_util
+import instrumentation
+import profiler
+import step_journal
+import work_queue
+
 RESULT_STATE = Enum("ResultState", "Done IT Customer")
 
 CAPABILITIES = [
@@ -29,29 +36,37 @@ CAPABILITIES = [
 SAVE_TICKET_DATA = False
 
 
+@work_queue.queued
+@instrumentation.instrumented
 def comment(ticket_data):
     """ Comment handler """
-    last_comment, keyword = shared_sd.central_comment_handler([], ["help", "retry"])
+    last_comment, keyword = shared_sd.central_comment_handler([], ["help", "retry", "profile"])
 
     if keyword == "help":
         shared_sd.post_comment("All bot commands must be internal comments and the first "
                                "word/phrase in the comment.\r\n\r\n"
                                "Valid commands are:\r\n"
                                "* retry to ask the bot to process the request again after "
-                               "problems with the request have been resolved.",
+                               "problems with the request have been resolved.\r\n"
+                               "* profile to run the request again without making any "
+                               "changes and attach a performance profile.",
                                False)
     elif keyword == "retry":
         create(ticket_data)
+    elif keyword == "profile":
+        profiler.profile(create, ticket_data)
     elif last_comment is not None and last_comment["public"]:
         shared_sd.deassign_ticket_if_appropriate(last_comment)
 
 
+@work_queue.queued
+@instrumentation.instrumented
 def create(ticket_data):
     """ Create handler. """
     # Start by making sure that the requester is in IT or HR.
     email_address = shared_sd.reporter_email_address(ticket_data)
     print(f"transition_user_account: reporter email address = {email_address}")
-    account_dn = shared_ldap.find_from_email(email_address)
+    account_dn = directory_replica.find_from_email(email_address)
     print(f"transition_user_account: account DN = {account_dn}")
     valid_account = shared_ldap.is_dn_in_group("hr", account_dn) or \
         shared_ldap.is_dn_in_group("its", account_dn)
@@ -75,16 +90,25 @@ def create(ticket_data):
         shared_sd.resolve_ticket(resolution_state="Won't Do")
         return
     addresses = addresses.split("\r\n")
+    # If this is a retry, skip the accounts that were transitioned last time.
+    journal = step_journal.journal(ticket_data)
     for address in addresses:
         # Clean up by trimming white space.
         clean = address.strip().lower()
         if clean != "":
-            result = transition_user_account(clean)
+            step = f"transition:{clean}"
+            if journal.done(step):
+                print(f"transition_user_account: {clean} already transitioned")
+                continue
+            result = transition_user_account(clean, journal)
+            if result == RESULT_STATE.Done:
+                journal.record(step)
             if (result == RESULT_STATE.IT or
                     (result == RESULT_STATE.Customer and outcome == RESULT_STATE.Done)):
                 outcome = result
     # Did all of the accounts transition?
     if outcome == RESULT_STATE.Done:
+        journal.finish()
         shared_sd.resolve_ticket()
     elif outcome == RESULT_STATE.Customer:
         shared_sd.post_comment(
@@ -98,17 +122,17 @@ def create(ticket_data):
         shared_sd.transition_request_to("Waiting for Support")
 
 
-def transition_user_account(email_address):
+def transition_user_account(email_address, journal):
     """ Transition the account corresponding to the email address. """
     account_dn = shared_ldap.find_from_email(email_address)
     if account_dn is None:
         shared_sd.post_comment("Cannot find '%s'" % email_address, True)
         return RESULT_STATE.Customer
 
-    parts = account_dn.split(",", 2)
-    if parts[1] == "ou=leavers":
-        return transition_leaver(account_dn, email_address)
-    elif parts[1] == "ou=staff":
+    account_ou = dn_util.parse(account_dn).ou
+    if account_ou == "leavers":
+        return transition_leaver(account_dn, email_address, journal)
+    elif account_ou == "staff":
         shared_sd.post_comment(
             "Cannot transition '%s' because this is an active Linaro account. "
             "It is only possible to transition leaving Linaro accounts." % email_address,
@@ -116,10 +140,10 @@ def transition_user_account(email_address):
         )
         return RESULT_STATE.Customer
 
-    return transition_member(account_dn, email_address)
+    return transition_member(account_dn, email_address, journal)
 
 
-def transition_leaver(account_dn, email_address):
+def transition_leaver(account_dn, email_address, journal):
     """ Transition a leaver account back to a Member account. """
     account = shared_ldap.get_object(
         account_dn,
@@ -135,14 +159,14 @@ def transition_leaver(account_dn, email_address):
         )
         return RESULT_STATE.Customer
 
-    clean_up_account(account)
+    clean_up_account(account, journal)
     return transition_account(
         account,
         account["passwordSelfResetBackupMail"].value,
         email_address)
 
 
-def transition_member(account_dn, email_address):
+def transition_member(account_dn, email_address, journal):
     """ Transition a Member account to be a Staff account. """
     account = shared_ldap.get_object(
         account_dn,
@@ -172,16 +196,21 @@ def transition_member(account_dn, email_address):
         shared_sd.post_comment(check[0].entry_dn, False)
         return RESULT_STATE.Customer
     # Good to go ...
-    clean_up_account(account)
+    clean_up_account(account, journal)
     return transition_account(account, new_email, email_address)
 
 
-def clean_up_account(account):
+def clean_up_account(account, journal):
     """Remove the account from any groups."""
     if "memberOf" in account:
         sd_comment = ""
         for grp in account["memberOf"].values:
+            step = f"remove:{account.entry_dn}:{grp}"
+            if journal.done(step):
+                continue
             if shared_ldap.remove_from_group(grp, account.entry_dn):
+                journal.record(step)
+                directory_replica.refresh(grp)
                 sd_comment += "Removed from %s\r\n" % grp
             else:
                 sd_comment += "Failed to remove from %s\r\n" % grp
@@ -196,7 +225,8 @@ def transition_account(account, new_email, old_email):
     new_ou = shared_ldap.find_best_ou_for_email(new_email)
     print(f"transition_account: proposed new OU={new_ou}")
     # Make sure we're actually moving the account! Check against existing OU.
-    old_ou = account.entry_dn.split(",", 1)[1]
+    account_dn = dn_util.parse(account.entry_dn)
+    old_ou = account_dn.parent
     print(f"transition_account: comparing against old_ou={old_ou}")
     print(f"transition_account: derived from DN {account.entry_dn}")
     if old_ou == new_ou:
@@ -229,6 +259,8 @@ def transition_account(account, new_email, old_email):
     # Finally, rename and move the account
     result = shared_ldap.move_object(account.entry_dn, new_ou)
     if result is None:
+        directory_replica.forget(account.entry_dn)
+        directory_replica.refresh(str(account_dn.moved_to(new_ou)))
         shared_sd.post_comment(
             "Successfully transitioned %s to %s.\r\n"
             "Please note that the account does not have a password set, nor is it in any "
@@ -239,6 +271,8 @@ def transition_account(account, new_email, old_email):
         "Got error when trying to move %s to %s. IT Services needs to investigate "
         "further." % (old_email, new_ou), True)
     shared_sd.post_comment("The error was: %s" % result, False)
+    # The account is still where it was but its attributes have been removed.
+    directory_replica.refresh(account.entry_dn)
     return RESULT_STATE.IT
 
 
@@ -0,0 +1,325 @@
+"""
+A persistent local work queue for handlers that take a long time to run.
+
+Some handlers (anything that triggers a Google sync, transitions accounts
+or deletes groups) can take many seconds, during which the webhook call is
+left waiting. Jira retries webhooks that are slow to respond, which then
+causes the same work to be done twice.
+
+Handler entry points decorated with @work_queue.queued are, when the queue
+is enabled, recorded in a SQLite queue and the webhook returns straight
+away. A pool of worker processes, started with:
+
+    python work_queue.py run [--workers N] [--state-directory DIR]
+
+then runs the queued calls. Calls for different tickets run in parallel
+but calls for the same ticket are run one at a time, in the order they
+arrived. Worker processes are used rather than threads because the
+framework keeps the details of the ticket being processed in module
+globals. If a worker dies, the job it was running is put back in the queue
+when the worker is replaced.
+
+The queue is only used if "work_queue" is set to true in the
+configuration. Queue depth and latency can be checked with:
+
+    python work_queue.py stats
+"""
+
+import argparse
+import contextlib
+import functools
+import importlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+import traceback
+
+import shared.globals
+
+import local_state
+import metrics
+
+DATABASE_FILE = "work_queue.sqlite"
+# How long an idle worker waits before checking the queue again.
+POLL_INTERVAL = 0.5
+# Finished jobs are kept for this long so that latency can be reported.
+RETENTION = 7 * 24 * 60 * 60
+# Set in worker processes so that queued functions run rather than queue.
+IN_WORKER = False
+# The framework globals that describe the ticket being handled. Only these
+# are stored with a job: the configuration holds secrets, so the workers
+# load their own.
+TICKET_GLOBALS = ("TICKET_DATA", "TICKET", "PROJECT", "REPORTER", "ROOT_URL")
+# Set once the database has been created and initialised by this process.
+INITIALISED = False
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ticket TEXT NOT NULL,
+    module TEXT NOT NULL,
+    function TEXT NOT NULL,
+    arguments TEXT NOT NULL,
+    globals TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker INTEGER,
+    enqueued REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, id);
+CREATE INDEX IF NOT EXISTS jobs_by_ticket ON jobs (ticket, status);
+"""
+
+
+def enabled():
+    """ Is the work queue turned on? """
+    return bool(shared.globals.CONFIGURATION.get("work_queue", False))
+
+
+@contextlib.contextmanager
+def database():
+    """ Open the queue database in autocommit mode, creating the tables if needed. """
+    global INITIALISED  # pylint: disable=global-statement
+    path = local_state.state_path(DATABASE_FILE)
+    if not INITIALISED:
+        # The jobs include ticket details so only the owner may read them.
+        # SQLite gives the journal files the same permissions.
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        if not INITIALISED:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(jobs)")]
+            if "worker" not in columns:
+                # Queues created before jobs recorded the worker running them.
+                connection.execute("ALTER TABLE jobs ADD COLUMN worker INTEGER")
+            INITIALISED = True
+        yield connection
+    finally:
+        connection.close()
+
+
+def queued(function):
+    """
+    Decorator for handler entry points. When the queue is enabled, the call
+    is added to the queue and None is returned immediately; otherwise the
+    function is called as normal.
+    """
+    @functools.wraps(function)
+    def wrapper(*args):
+        if IN_WORKER or not enabled():
+            return function(*args)
+        enqueue(function.__module__, function.__name__, args)
+        return None
+    return wrapper
+
+
+def ticket_key(args):
+    """ Work out which ticket a call is for from its arguments. """
+    for arg in args:
+        if isinstance(arg, dict) and "key" in arg:
+            return arg["key"]
+    return shared.globals.TICKET_DATA["key"]
+
+
+def globals_snapshot():
+    """ Capture the per-ticket framework globals so that they can be restored in the worker. """
+    return {
+        name: getattr(shared.globals, name)
+        for name in TICKET_GLOBALS
+        if getattr(shared.globals, name, None) is not None
+    }
+
+
+def enqueue(module, function, args):
+    """ Add a call to the queue. """
+    key = ticket_key(args)
+    with database() as connection:
+        connection.execute(
+            "INSERT INTO jobs (ticket, module, function, arguments, globals, enqueued) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                module,
+                function,
+                json.dumps(list(args)),
+                json.dumps(globals_snapshot()),
+                time.time()
+            ))
+    print(f"work_queue: queued {module}.{function} for {key}")
+
+
+def claim(connection, slot):
+    """
+    Claim the oldest pending job for a ticket that doesn't already have a
+    job running, recording the slot of the worker running it. Returns the
+    job row or None if there is nothing to do.
+    """
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        job = connection.execute(
+            "SELECT id, ticket, module, function, arguments, globals, enqueued FROM jobs "
+            "WHERE status = 'pending' AND ticket NOT IN "
+            "(SELECT ticket FROM jobs WHERE status = 'running') "
+            "ORDER BY id LIMIT 1").fetchone()
+        if job is not None:
+            connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started = ? WHERE id = ?",
+                (slot, time.time(), job[0]))
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return job
+
+
+def run_job(job):
+    """ Run a claimed job with the framework globals it was queued with. """
+    job_id, key, module, function, arguments, snapshot, enqueued = job
+    for name in TICKET_GLOBALS:
+        setattr(shared.globals, name, None)
+    for name, value in json.loads(snapshot).items():
+        if name in TICKET_GLOBALS:
+            setattr(shared.globals, name, value)
+    metrics.QUEUE_WAIT.observe(time.time() - enqueued, module=module)
+    metrics.start()
+    print(f"work_queue: running {module}.{function} for {key} "
+          f"after waiting {time.time() - enqueued:.2f}s")
+    error = None
+    try:
+        handler = importlib.import_module(module)
+        getattr(handler, function)(*json.loads(arguments))
+    except Exception:  # pylint: disable=broad-except
+        error = traceback.format_exc()
+        print(f"work_queue: {module}.{function} for {key} failed:\n{error}")
+    with database() as connection:
+        connection.execute(
+            "UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?",
+            ("failed" if error is not None else "done", time.time(), error, job_id))
+
+
+def worker_loop(state_directory, slot):
+    """ Keep running jobs until the process is stopped. """
+    global IN_WORKER  # pylint: disable=global-statement
+    IN_WORKER = True
+    # Each worker has its own metrics registry so needs its own port.
+    metrics.PORT_OFFSET = slot + 1
+    configure(state_directory)
+    while True:
+        with database() as connection:
+            job = claim(connection, slot)
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+        else:
+            run_job(job)
+
+
+def configure(state_directory):
+    """
+    Load the handlers' configuration, which isn't stored with the jobs, and
+    make sure the state directory can be found before any job has run.
+    """
+    if not isinstance(getattr(shared.globals, "CONFIGURATION", None), dict):
+        shared.globals.initialise_config()
+    if state_directory is not None:
+        shared.globals.CONFIGURATION["state_directory"] = state_directory
+
+
+def release(slot):
+    """
+    Put the job that a worker which has died was running back in the queue,
+    otherwise its ticket's later jobs would never be claimed.
+    """
+    with database() as connection:
+        released = connection.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL, started = NULL "
+            "WHERE status = 'running' AND worker = ?", (slot,)).rowcount
+    print(f"work_queue: worker {slot} died, returned {released} job(s) to the queue")
+
+
+def run(workers, state_directory):
+    """ Start the worker processes and restart any that die. """
+    configure(state_directory)
+    with database() as connection:
+        # No workers are running yet so anything marked as running was
+        # interrupted and needs to be run again.
+        connection.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL WHERE status = 'running'")
+    # Workers are kept in numbered slots so that a replacement for a worker
+    # that died serves its metrics on the same port.
+    processes = {}
+    while True:
+        for slot in range(workers):
+            if slot not in processes or not processes[slot].is_alive():
+                if slot in processes:
+                    release(slot)
+                process = multiprocessing.Process(
+                    target=worker_loop, args=(state_directory, slot), daemon=True)
+                process.start()
+                processes[slot] = process
+        with database() as connection:
+            connection.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?",
+                (time.time() - RETENTION,))
+        print(f"work_queue: {json.dumps(stats())}")
+        time.sleep(60)
+
+
+def percentile(values, fraction):
+    """ Return the requested percentile of a list of numbers. """
+    if values == []:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def stats(recent=500):
+    """ Report the queue depth and the latency of recently finished jobs. """
+    now = time.time()
+    with database() as connection:
+        pending, oldest = connection.execute(
+            "SELECT COUNT(*), MIN(enqueued) FROM jobs WHERE status = 'pending'").fetchone()
+        running = connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+        finished = connection.execute(
+            "SELECT started - enqueued, finished - started, status FROM jobs "
+            "WHERE status IN ('done', 'failed') ORDER BY finished DESC LIMIT ?",
+            (recent,)).fetchall()
+    waits = [row[0] for row in finished]
+    durations = [row[1] for row in finished]
+    return {
+        "pending": pending,
+        "running": running,
+        "oldest_pending_age": None if oldest is None else round(now - oldest, 3),
+        "recent_jobs": len(finished),
+        "recent_failures": len([row for row in finished if row[2] == "failed"]),
+        "wait_p50": percentile(waits, 0.5),
+        "wait_p95": percentile(waits, 0.95),
+        "run_p50": percentile(durations, 0.5),
+        "run_p95": percentile(durations, 0.95)
+    }
+
+
+def main():
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(description="Run or inspect the handler work queue.")
+    parser.add_argument("command", choices=["run", "stats"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--state-directory")
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.workers, args.state_directory)
+    else:
+        configure(args.state_directory)
+        print(json.dumps(stats(), indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())